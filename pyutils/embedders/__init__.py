@@ -1,4 +1,33 @@
-from .embedder import QwenEmbedder
-from .rag import RAGPipeline
+"""
+Qwen3 embeddings, late chunking and FAISS retrieval.
 
-__all__ = ["QwenEmbedder", "RAGPipeline"]
+Names are imported on first access, so `import pyutils.embedders` stays
+cheap: torch and transformers load only when a QwenEmbedder first needs its
+model, and faiss only when the rag module is used.
+"""
+
+from importlib import import_module
+
+_EXPORTS = {
+    "EmbedderPool": ".pool",
+    "EmbeddingCache": ".cache",
+    "QueryMicrobatcher": ".microbatch",
+    "QwenEmbedder": ".embedder",
+    "QwenReranker": ".reranker",
+    "RAGPipeline": ".rag",
+    "ShardedStore": ".sharded",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(import_module(_EXPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,574 @@
+"""
+bench.py — measurements behind the tuning knobs.
+
+Each benchmark is a plain function returning rows of numbers, so it can be
+called from a notebook or a test; `python -m pyutils.embedders.bench <name>`
+runs it from the command line and prints a table.
+
+Benchmarks:
+    mrl       — retrieval recall of Matryoshka-truncated vectors vs full 1024-d
+    backends  — texts/sec of each QwenEmbedder backend, and how closely its
+                vectors agree with the fp32 torch path
+    chunks    — memory held by chunk records: List[Chunk] vs ChunkTable
+    index     — recall@k, p50/p99 latency, build time and memory of each
+                FAISSStore index type across its tuning parameters
+    build     — FAISSStore.build() time and recall with the IVF training set
+                capped vs the whole corpus, across thread counts
+    ingest    — RAGPipeline.index() docs/sec with its tokenize / forward /
+                index stages run in turn vs pipelined
+
+Requirements:
+    pip install transformers>=4.51.0 torch numpy faiss-cpu
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from .embedder import EMBEDDING_DIM, _mrl_truncate
+
+
+# ---------------------------------------------------------------------------
+# Recall helpers
+# ---------------------------------------------------------------------------
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Brute-force inner-product top-k ids, (n_queries, k), best first."""
+    scores = queries @ vectors.T
+    k = min(k, vectors.shape[0])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    """
+    Fraction of true neighbours present in the found lists.
+
+    Args:
+        truth: (n_queries, k) ids from exact search
+        found: (n_queries, k') ids from the method under test; -1 = no result
+    """
+    hits = sum(len(set(t) & set(f[f >= 0])) for t, f in zip(truth, found))
+    return hits / truth.size
+
+
+def print_table(rows: List[Dict], columns: Sequence[str]) -> None:
+    """Print rows as a fixed-width table, floats to 4 significant digits."""
+    def fmt(v):
+        return f"{v:.4g}" if isinstance(v, float) else str(v)
+
+    cells = [[fmt(r.get(c, "")) for c in columns] for r in rows]
+    widths = [max(len(c), *(len(row[i]) for row in cells)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    print("  ".join("-" * w for w in widths))
+    for row in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+# ---------------------------------------------------------------------------
+# MRL recall
+# ---------------------------------------------------------------------------
+
+def mrl_recall(
+    doc_vecs: np.ndarray,
+    query_vecs: np.ndarray,
+    dims: Sequence[int] = (64, 128, 256, 512),
+    k: int = 10,
+) -> List[Dict]:
+    """
+    Recall@k of truncated vectors against full-dimension search.
+
+    Both sides are truncated to each dim and re-normalised, exactly as
+    QwenEmbedder(output_dim=dim) would produce them; the ground truth is the
+    top-k at full dimension.
+
+    Returns:
+        One row per dim: dim, recall, bytes_per_vector.
+    """
+    truth = exact_top_k(doc_vecs, query_vecs, k)
+    rows = []
+    for dim in list(dims) + [doc_vecs.shape[1]]:
+        found = exact_top_k(
+            _mrl_truncate(doc_vecs, dim), _mrl_truncate(query_vecs, dim), k,
+        )
+        rows.append({
+            "dim": dim,
+            "recall": recall_at_k(truth, found),
+            "bytes_per_vector": 4 * dim,
+        })
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Backend throughput
+# ---------------------------------------------------------------------------
+
+def backend_throughput(
+    texts: List[str],
+    backends: Sequence[str] = ("torch", "int8", "onnx"),
+    repeats: int = 3,
+    **embedder_kwargs,
+) -> List[Dict]:
+    """
+    Encode `texts` with each backend; report speed and agreement with fp32.
+
+    The first backend is the reference for cosine agreement (normally
+    "torch"). Each backend gets one untimed warm-up pass, then the best of
+    `repeats` timed passes.
+
+    Returns:
+        One row per backend: backend, texts_per_sec, speedup, cos_min,
+        cos_mean.
+    """
+    from .embedder import QwenEmbedder
+
+    rows, reference = [], None
+    for backend in backends:
+        embedder = QwenEmbedder(device="cpu", backend=backend, **embedder_kwargs)
+        vecs = embedder.encode(texts)                       # warm-up
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            embedder.encode(texts)
+            best = min(best, time.perf_counter() - start)
+
+        if reference is None:
+            reference = vecs
+        cos = (vecs * reference).sum(axis=1)
+        rows.append({
+            "backend": backend,
+            "texts_per_sec": len(texts) / best,
+            "cos_min": float(cos.min()),
+            "cos_mean": float(cos.mean()),
+        })
+    for row in rows:
+        row["speedup"] = row["texts_per_sec"] / rows[0]["texts_per_sec"]
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Chunk record memory
+# ---------------------------------------------------------------------------
+
+def _synthetic_chunks(n_chunks: int, chunks_per_doc: int, text_chars: int):
+    """Chunks as RAGPipeline.index makes them: one shared metadata dict per doc."""
+    from .rag import Chunk
+
+    filler = "lorem ipsum dolor sit amet " * (text_chars // 27 + 1)
+    meta = None
+    for i in range(n_chunks):
+        doc, j = divmod(i, chunks_per_doc)
+        if j == 0:
+            meta = {"source": f"source_{doc % 50}", "year": 2000 + doc % 25}
+        yield Chunk(f"{i} {filler}"[:text_chars], f"doc_{doc}", j, meta)
+
+
+def chunk_memory(
+    n_chunks: int = 1_000_000,
+    chunks_per_doc: int = 20,
+    text_chars: int = 400,
+) -> List[Dict]:
+    """
+    Python heap held by `n_chunks` chunk records in each storage layout.
+
+    Measured with tracemalloc while the records are built from a generator,
+    so only the retained structure is counted. Text is ASCII; `text_chars`
+    sets its size (the text bytes themselves are the same in both layouts).
+
+    Returns:
+        One row per layout: storage, total_mb, bytes_per_chunk,
+        overhead_per_chunk (bytes beyond the UTF-8 text).
+    """
+    from .rag import ChunkTable
+
+    def measure(build):
+        tracemalloc.start()
+        try:
+            held = build()
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del held
+        return size
+
+    def as_list():
+        return list(_synthetic_chunks(n_chunks, chunks_per_doc, text_chars))
+
+    def as_table():
+        table = ChunkTable()
+        batch = []
+        for chunk in _synthetic_chunks(n_chunks, chunks_per_doc, text_chars):
+            batch.append(chunk)
+            if len(batch) == chunks_per_doc:
+                table.append(batch)
+                batch = []
+        table.append(batch)
+        return table
+
+    text_bytes = n_chunks * text_chars
+    rows = []
+    for name, build in (("List[Chunk]", as_list), ("ChunkTable", as_table)):
+        size = measure(build)
+        rows.append({
+            "storage": name,
+            "total_mb": size / 2**20,
+            "bytes_per_chunk": size / n_chunks,
+            "overhead_per_chunk": (size - text_bytes) / n_chunks,
+        })
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Index sweep
+# ---------------------------------------------------------------------------
+
+# Build-time settings (one index each) → search-time knob and values swept.
+DEFAULT_SWEEP: Dict[str, Tuple[List[Dict], str | None, List[int]]] = {
+    "flat": ([{}], None, [0]),
+    "ivf": ([{}], "nprobe", [1, 4, 16, 64, 256]),
+    "hnsw": ([{"hnsw_m": 16}, {"hnsw_m": 32}], "hnsw_ef_search", [16, 32, 64, 128, 256]),
+    "ivfpq": ([{"pq_m": 16}, {"pq_m": 32}, {"pq_m": 64}], "nprobe", [4, 16, 64]),
+    "sq8": ([{}], None, [0]),
+    "binary": ([{"binary_rescore": "sq8"}, {"binary_rescore": "sq4"}],
+               "binary_oversample", [4, 10, 40, 100]),
+}
+
+
+def synthetic_vectors(
+    n: int,
+    dim: int,
+    n_clusters: int = 100,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    L2-normalised vectors drawn around `n_clusters` random centres.
+
+    Real embeddings are clustered by topic; uniformly random vectors are
+    not, and make every approximate index look worse than it is.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((n_clusters, dim), dtype=np.float32)
+    vecs = centres[rng.integers(0, n_clusters, n)]
+    vecs += 0.6 * rng.standard_normal((n, dim), dtype=np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+def _set_search_knob(index, knob: str | None, value: int) -> None:
+    import faiss
+
+    if knob == "nprobe":
+        faiss.extract_index_ivf(index).nprobe = value
+    elif knob == "hnsw_ef_search":
+        faiss.downcast_index(index.index).hnsw.efSearch = value
+    elif knob == "binary_oversample":
+        index.oversample = value
+
+
+def index_sweep(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    sweep: Dict[str, Tuple[List[Dict], str | None, List[int]]] | None = None,
+) -> List[Dict]:
+    """
+    Recall and speed of every FAISSStore index type over a parameter grid.
+
+    Indexes are built exactly as FAISSStore builds them. Ground truth is
+    exact search. Recall uses one batched search; latency is measured per
+    query (batch of one, as a live service sees it).
+
+    Args:
+        vectors: (N, dim) L2-normalised corpus
+        queries: (Q, dim) L2-normalised queries
+        k:       neighbours per query
+        sweep:   {index_type: (build settings list, search knob, values)};
+                 default DEFAULT_SWEEP
+
+    Returns:
+        One row per (index, build settings, knob value): index, params,
+        recall, p50_ms, p99_ms, build_s, memory_mb.
+    """
+    import faiss
+    from .rag import FAISSStore
+
+    sweep = DEFAULT_SWEEP if sweep is None else sweep
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    truth = exact_top_k(vectors, queries, k)
+    ids = np.arange(len(vectors), dtype=np.int64)
+
+    rows = []
+    for index_type, (builds, knob, values) in sweep.items():
+        for settings in builds:
+            if "pq_m" in settings and vectors.shape[1] % settings["pq_m"]:
+                continue                                   # pq_m must divide dim
+            store = FAISSStore(vectors.shape[1], index_type, **settings)
+            start = time.perf_counter()
+            index = store._make_index(len(vectors))
+            if not index.is_trained:
+                index.train(vectors)
+            index.add_with_ids(vectors, ids)
+            build_s = time.perf_counter() - start
+            if hasattr(index, "nbytes"):                   # binary: codes + rescoring copy
+                memory_mb = index.nbytes() / 2**20
+            else:
+                memory_mb = len(faiss.serialize_index(index)) / 2**20
+
+            for value in values:
+                _set_search_knob(index, knob, value)
+                _, found = index.search(queries, k)
+                latencies = []
+                for q in queries:
+                    t0 = time.perf_counter()
+                    index.search(q[None], k)
+                    latencies.append(time.perf_counter() - t0)
+                params = dict(settings, **({knob: value} if knob else {}))
+                rows.append({
+                    "index": index_type,
+                    "params": " ".join(f"{n}={v}" for n, v in params.items()) or "-",
+                    "recall": recall_at_k(truth, found),
+                    "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+                    "p99_ms": 1000 * float(np.percentile(latencies, 99)),
+                    "build_s": build_s,
+                    "memory_mb": memory_mb,
+                })
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Build timings
+# ---------------------------------------------------------------------------
+
+def build_timings(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    index_types: Sequence[str] = ("ivf", "ivfpq"),
+    train_per_list: Sequence[int | None] = (None, 256),
+    threads: Sequence[int | None] = (None,),
+    k: int = 10,
+    **settings,
+) -> List[Dict]:
+    """
+    Time FAISSStore.build() over a buffered corpus.
+
+    Args:
+        vectors:        (N, dim) L2-normalised corpus
+        queries:        (Q, dim) L2-normalised queries, for recall@k
+        index_types:    FAISSStore index types to build
+        train_per_list: training-set caps (vectors per cluster); None trains
+                        on the whole corpus
+        threads:        FAISSStore n_threads values; None → FAISS default
+        **settings:     passed to every FAISSStore (nlist, pq_m, nprobe, ...)
+
+    Returns:
+        One row per combination: index, train_vectors, threads, build_s,
+        recall, peak_mb (Python-side allocations during build, from
+        tracemalloc; FAISS's own memory is not counted).
+    """
+    from .rag import Chunk, FAISSStore
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    truth = exact_top_k(vectors, queries, k)
+    chunks = [Chunk("", "d", 0)] * len(vectors)
+    rows = []
+    for index_type in index_types:
+        for cap in train_per_list:
+            for n_threads in threads:
+                store = FAISSStore(
+                    vectors.shape[1], index_type,
+                    train_per_list=cap or len(vectors), n_threads=n_threads,
+                    **settings,
+                )
+                for start in range(0, len(vectors), 100_000):   # as add() calls arrive
+                    store.add(chunks[start : start + 100_000], vectors[start : start + 100_000])
+                tracemalloc.start()
+                start = time.perf_counter()
+                store.build()
+                build_s = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                _, found = store._index.search(queries, k)
+                nlist = store._index.nlist
+                rows.append({
+                    "index": index_type,
+                    "train_vectors": min(len(vectors), (cap or len(vectors)) * nlist),
+                    "threads": n_threads or "default",
+                    "build_s": build_s,
+                    "recall": recall_at_k(truth, found),
+                    "peak_mb": peak / 2**20,
+                })
+                del store
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Ingestion throughput
+# ---------------------------------------------------------------------------
+
+def ingest_throughput(
+    documents: List[str],
+    workers: Sequence[int] = (0, 2),
+    batch_docs: int = 64,
+    chunk_tokens: int = 512,
+    repeats: int = 3,
+    **embedder_kwargs,
+) -> List[Dict]:
+    """
+    Index `documents` into a fresh flat store with each `workers` setting of
+    RAGPipeline.index(); 0 runs tokenize, forward, decode and add one after
+    another. One untimed warm-up pass, then the best of `repeats`.
+
+    Returns:
+        One row per setting: workers, docs_per_sec, chunks, speedup (vs the
+        first setting).
+    """
+    from .embedder import QwenEmbedder
+    from .rag import FAISSStore, RAGPipeline
+
+    embedder = QwenEmbedder(device="cpu", **embedder_kwargs)
+    embedder.encode_documents(documents[:batch_docs], chunk_tokens=chunk_tokens)  # warm-up
+    rows = []
+    for n_workers in workers:
+        best, chunks = float("inf"), 0
+        for _ in range(repeats):
+            rag = RAGPipeline(embedder=embedder, store=FAISSStore(dim=embedder.dim),
+                              chunk_tokens=chunk_tokens)
+            start = time.perf_counter()
+            rag.index(documents, batch_docs=batch_docs, workers=n_workers)
+            best = min(best, time.perf_counter() - start)
+            chunks = len(rag)
+        rows.append({
+            "workers": n_workers,
+            "docs_per_sec": len(documents) / best,
+            "chunks": chunks,
+        })
+    for row in rows:
+        row["speedup"] = row["docs_per_sec"] / rows[0]["docs_per_sec"]
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Command line
+# ---------------------------------------------------------------------------
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("mrl", help="recall of truncated vs full-dim vectors")
+    p.add_argument("--docs", required=True, help="text file, one passage per line")
+    p.add_argument("--queries", required=True, help="text file, one query per line")
+    p.add_argument("--dims", type=int, nargs="+", default=[64, 128, 256, 512])
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--json", help="also write the rows to this file")
+
+    p = sub.add_parser("backends", help="speed and agreement of CPU backends")
+    p.add_argument("--texts", required=True, help="text file, one passage per line")
+    p.add_argument("--backends", nargs="+", default=["torch", "int8", "onnx"])
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--json", help="also write the rows to this file")
+
+    p = sub.add_parser("chunks", help="memory of chunk records by layout")
+    p.add_argument("--n-chunks", type=int, default=1_000_000)
+    p.add_argument("--chunks-per-doc", type=int, default=20)
+    p.add_argument("--text-chars", type=int, default=400)
+    p.add_argument("--json", help="also write the rows to this file")
+
+    p = sub.add_parser("index", help="recall/latency sweep over index types")
+    p.add_argument("--vectors", help=".npy corpus vectors (default: synthetic)")
+    p.add_argument("--queries", help=".npy query vectors (default: held-out synthetic)")
+    p.add_argument("--n", type=int, default=100_000, help="synthetic corpus size")
+    p.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="synthetic dimension")
+    p.add_argument("--n-queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--types", nargs="+", default=list(DEFAULT_SWEEP))
+    p.add_argument("--json", help="also write the rows to this file")
+
+    p = sub.add_parser("build", help="FAISSStore.build() time by training cap and threads")
+    p.add_argument("--n", type=int, default=1_000_000, help="synthetic corpus size")
+    p.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="synthetic dimension")
+    p.add_argument("--n-queries", type=int, default=100)
+    p.add_argument("--types", nargs="+", default=["ivf", "ivfpq"])
+    p.add_argument("--caps", type=int, nargs="+", default=[0, 256],
+                   help="train_per_list values; 0 = whole corpus")
+    p.add_argument("--threads", type=int, nargs="+", default=[0],
+                   help="n_threads values; 0 = FAISS default")
+    p.add_argument("--pq-m", type=int, default=64)
+    p.add_argument("--json", help="also write the rows to this file")
+
+    p = sub.add_parser("ingest", help="RAGPipeline.index() docs/sec, sequential vs pipelined")
+    p.add_argument("--docs", required=True, help="text file, one document per line")
+    p.add_argument("--workers", type=int, nargs="+", default=[0, 2],
+                   help="tokenizer/decoder threads; 0 = stages in turn")
+    p.add_argument("--batch-docs", type=int, default=64)
+    p.add_argument("--chunk-tokens", type=int, default=512)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--json", help="also write the rows to this file")
+
+    args = parser.parse_args(argv)
+
+    if args.bench == "mrl":
+        from .embedder import QwenEmbedder
+        embedder = QwenEmbedder(output_dim=EMBEDDING_DIM)
+        docs = embedder.encode(_read_lines(args.docs))
+        queries = embedder.encode(_read_lines(args.queries), is_query=True)
+        rows = mrl_recall(docs, queries, args.dims, args.k)
+        print_table(rows, ["dim", "recall", "bytes_per_vector"])
+
+    elif args.bench == "backends":
+        rows = backend_throughput(_read_lines(args.texts), args.backends, args.repeats)
+        print_table(rows, ["backend", "texts_per_sec", "speedup", "cos_min", "cos_mean"])
+
+    elif args.bench == "chunks":
+        rows = chunk_memory(args.n_chunks, args.chunks_per_doc, args.text_chars)
+        print_table(rows, ["storage", "total_mb", "bytes_per_chunk", "overhead_per_chunk"])
+
+    elif args.bench == "index":
+        if args.vectors:
+            vectors = np.load(args.vectors)
+            queries = (np.load(args.queries) if args.queries
+                       else vectors[np.random.default_rng(1).choice(len(vectors), args.n_queries)])
+        else:
+            both = synthetic_vectors(args.n + args.n_queries, args.dim)
+            vectors, queries = both[: args.n], both[args.n :]
+        sweep = {t: DEFAULT_SWEEP[t] for t in args.types}
+        rows = index_sweep(vectors, queries, args.k, sweep)
+        print_table(rows, ["index", "params", "recall", "p50_ms", "p99_ms",
+                           "build_s", "memory_mb"])
+
+    elif args.bench == "build":
+        both = synthetic_vectors(args.n + args.n_queries, args.dim)
+        vectors, queries = both[: args.n], both[args.n :]
+        del both
+        rows = build_timings(
+            vectors, queries, args.types,
+            [c or None for c in args.caps], [t or None for t in args.threads],
+            pq_m=args.pq_m,
+        )
+        print_table(rows, ["index", "train_vectors", "threads", "build_s",
+                           "recall", "peak_mb"])
+
+    elif args.bench == "ingest":
+        rows = ingest_throughput(_read_lines(args.docs), args.workers, args.batch_docs,
+                                 args.chunk_tokens, args.repeats)
+        print_table(rows, ["workers", "docs_per_sec", "chunks", "speedup"])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+cache.py — persistent, content-addressed cache of embeddings.
+
+Re-indexing a corpus mostly re-embeds text that has not changed. The cache
+keys every result by a hash of everything that determines it — model id,
+text, query/document mode, task instruction and chunk size — so unchanged
+text is read back from disk instead of going through the model again.
+
+Layout (one directory):
+    vectors.f32   float32 rows, stored back to back and memory-mapped.
+                  An entry is a contiguous run of rows: one row for encode(),
+                  one row per chunk for late chunking.
+    index.sqlite  key → (first row, #rows, chunk texts, last use), plus a
+                  little bookkeeping.
+
+Size cap:
+    `max_rows` bounds the live rows. Past it, the least recently used
+    entries are dropped. Their rows become dead space in vectors.f32, which
+    is reclaimed by rewriting the file once dead rows outnumber live ones.
+
+Compaction is crash-safe: the rewritten file (vectors.f32.tmp) is synced,
+then the new row offsets are committed together with a "compacting" flag,
+and only then is the file renamed into place. A cache opened with the flag
+set finishes the rename; a leftover .tmp without it is discarded. The
+index and the vector file therefore never disagree on where rows are.
+
+One cache directory should be written by one process at a time; threads
+within that process may share it.
+
+Requirements:
+    pip install numpy
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    On-disk LRU cache of float32 embedding arrays.
+
+    Usage:
+        cache = EmbeddingCache("~/.cache/qwen-embeddings")
+        embedder = QwenEmbedder(cache=cache)
+
+        # or directly:
+        key = cache.key(MODEL_ID, "some text", is_query=False)
+        if (hit := cache.get(key)) is None:
+            cache.put(key, vecs)
+
+    Args:
+        path:     cache directory (created if missing)
+        dim:      row width; must match what the directory was created with
+        max_rows: LRU cap on live rows
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dim: int = 1024,
+        max_rows: int = 1_000_000,
+    ) -> None:
+        self.path = os.path.expanduser(path)
+        self.dim = dim
+        self.max_rows = max_rows
+        os.makedirs(self.path, exist_ok=True)
+
+        self._vectors_path = os.path.join(self.path, "vectors.f32")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(self.path, "index.sqlite"), check_same_thread=False,
+        )
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key       TEXT PRIMARY KEY,
+                row       INTEGER NOT NULL,
+                n_rows    INTEGER NOT NULL,
+                texts     TEXT,
+                last_used INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+            """
+        )
+        stored_dim = self._meta("dim")
+        if stored_dim is None:
+            self._set_meta("dim", dim)
+            self._db.commit()
+        elif stored_dim != dim:
+            raise ValueError(f"cache at {self.path} holds dim={stored_dim}, not {dim}")
+
+        self._renaming = False               # offsets committed, file not yet renamed
+        self._recover()
+        if not os.path.exists(self._vectors_path):
+            open(self._vectors_path, "wb").close()
+        self._mmap: np.memmap | None = None
+        self._clock = self._meta("clock") or 0
+
+    # ------------------------------------------------------------------
+    # Keys
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def key(
+        model_id: str,
+        text: str,
+        is_query: bool = False,
+        task: str | None = None,
+        chunk_tokens: int | None = None,
+    ) -> str:
+        """
+        Content hash of everything that determines an embedding.
+
+        `task` only matters for queries and `chunk_tokens` only for late
+        chunking; pass None where they do not apply.
+        """
+        payload = json.dumps(
+            [model_id, text, bool(is_query), task, chunk_tokens],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def get(self, key: str) -> tuple[List[str] | None, np.ndarray] | None:
+        """Return (texts, vectors) for `key`, or None on a miss."""
+        return self.get_many([key])[0]
+
+    def get_many(
+        self,
+        keys: Sequence[str],
+    ) -> List[tuple[List[str] | None, np.ndarray] | None]:
+        """
+        Look up several keys at once; hits are marked as recently used.
+
+        Returns:
+            One entry per key: (texts, vectors) on a hit — texts is None for
+            entries stored without them — or None on a miss. Vectors are
+            (n_rows, dim) float32 copies, safe to keep.
+        """
+        if not keys:
+            return []
+        with self._lock:
+            found: Dict[str, tuple] = {}
+            unique = list(dict.fromkeys(keys))
+            for i in range(0, len(unique), 500):          # SQLite variable limit
+                part = unique[i : i + 500]
+                rows = self._db.execute(
+                    "SELECT key, row, n_rows, texts FROM entries "
+                    f"WHERE key IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall()
+                found.update((r[0], r[1:]) for r in rows)
+            if not found:
+                return [None] * len(keys)
+            if self._renaming:
+                self._recover()
+
+            vectors = self._vectors()
+            self._clock += 1
+            self._db.executemany(
+                "UPDATE entries SET last_used = ? WHERE key = ?",
+                [(self._clock, k) for k in found],
+            )
+            self._set_meta("clock", self._clock)
+            self._db.commit()
+
+            results = []
+            for k in keys:
+                if k not in found:
+                    results.append(None)
+                    continue
+                row, n_rows, texts = found[k]
+                results.append((
+                    json.loads(texts) if texts is not None else None,
+                    np.array(vectors[row : row + n_rows], dtype=np.float32),
+                ))
+            return results
+
+    def put(
+        self,
+        key: str,
+        vectors: np.ndarray,
+        texts: List[str] | None = None,
+    ) -> None:
+        """Store `vectors` (n, dim) — and optionally one text per row — under `key`."""
+        self.put_many([(key, vectors, texts)])
+
+    def put_many(
+        self,
+        items: Sequence[tuple[str, np.ndarray, List[str] | None]],
+    ) -> None:
+        """
+        Store several (key, vectors, texts) entries with one file append.
+
+        Existing keys are overwritten. Evicts least-recently-used entries if
+        the cap is exceeded.
+        """
+        if not items:
+            return
+        with self._lock:
+            if self._renaming:
+                self._recover()
+            # Append offsets come from the file size, so rows orphaned by an
+            # interrupted put can never be overwritten by a later one.
+            next_row = self._file_rows()
+            blocks, records = [], []
+            self._clock += 1
+            for key, vecs, texts in items:
+                vecs = np.ascontiguousarray(vecs, dtype=np.float32).reshape(-1, self.dim)
+                if texts is not None and len(texts) != len(vecs):
+                    raise ValueError(f"{len(texts)} texts for {len(vecs)} vectors")
+                blocks.append(vecs)
+                records.append((
+                    key, next_row, len(vecs),
+                    json.dumps(texts, ensure_ascii=False) if texts is not None else None,
+                    self._clock,
+                ))
+                next_row += len(vecs)
+
+            with open(self._vectors_path, "ab") as f:
+                for vecs in blocks:
+                    f.write(vecs.tobytes())
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", records,
+            )
+            self._set_meta("clock", self._clock)
+            self._evict()
+            self._db.commit()
+
+    def clear(self) -> None:
+        """Drop every entry and truncate the vector file."""
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.execute("DELETE FROM meta WHERE name = 'compacting'")
+            self._db.commit()
+            self._renaming = False
+            if os.path.exists(self._vectors_path + ".tmp"):
+                os.remove(self._vectors_path + ".tmp")
+            self._mmap = None
+            open(self._vectors_path, "wb").close()
+
+    def __len__(self) -> int:
+        """Number of cached entries."""
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    @property
+    def n_rows(self) -> int:
+        """Live vector rows (what `max_rows` caps)."""
+        return self._db.execute(
+            "SELECT COALESCE(SUM(n_rows), 0) FROM entries"
+        ).fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # Internals (callers hold self._lock)
+    # ------------------------------------------------------------------
+
+    def _meta(self, name: str) -> int | None:
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name: str, value: int) -> None:
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    def _file_rows(self) -> int:
+        return os.path.getsize(self._vectors_path) // (4 * self.dim)
+
+    def _vectors(self) -> np.ndarray:
+        """Memory map of vectors.f32, re-opened whenever the file has grown."""
+        n_rows = self._file_rows()
+        if self._mmap is None or self._mmap.shape[0] != n_rows:
+            if n_rows == 0:
+                return np.zeros((0, self.dim), dtype=np.float32)
+            self._mmap = np.memmap(
+                self._vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim),
+            )
+        return self._mmap
+
+    def _evict(self) -> None:
+        """Drop LRU entries over the cap; compact once dead rows dominate."""
+        live = self.n_rows
+        if live > self.max_rows:
+            excess = live - self.max_rows
+            dropped = 0
+            for key, n_rows in self._db.execute(
+                "SELECT key, n_rows FROM entries ORDER BY last_used"
+            ).fetchall():
+                if dropped >= excess:
+                    break
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                dropped += n_rows
+            live -= dropped
+            logger.info("EmbeddingCache: evicted %d rows.", dropped)
+
+        if self._file_rows() - live > max(live, 1024):
+            self._compact()
+
+    def _recover(self) -> None:
+        """Finish or discard a compaction interrupted by a crash."""
+        tmp_path = self._vectors_path + ".tmp"
+        if self._meta("compacting"):
+            if os.path.exists(tmp_path):       # offsets committed, rename not done
+                os.replace(tmp_path, self._vectors_path)
+            self._db.execute("DELETE FROM meta WHERE name = 'compacting'")
+            self._db.commit()
+            logger.info("EmbeddingCache: finished an interrupted compaction.")
+        elif os.path.exists(tmp_path):         # offsets never committed
+            os.remove(tmp_path)
+        self._renaming = False
+
+    def _compact(self) -> None:
+        """
+        Rewrite vectors.f32 with live rows only, most recently used last.
+        Commits the open transaction along with the new offsets.
+        """
+        entries = self._db.execute(
+            "SELECT key, row, n_rows FROM entries ORDER BY last_used"
+        ).fetchall()
+        vectors = self._vectors()
+        tmp_path = self._vectors_path + ".tmp"
+        next_row, moves = 0, []
+        with open(tmp_path, "wb") as f:
+            for key, row, n_rows in entries:
+                f.write(np.ascontiguousarray(vectors[row : row + n_rows]).tobytes())
+                moves.append((next_row, key))
+                next_row += n_rows
+            f.flush()
+            os.fsync(f.fileno())
+        self._db.executemany("UPDATE entries SET row = ? WHERE key = ?", moves)
+        self._set_meta("compacting", 1)
+        self._db.commit()
+
+        self._mmap = None
+        del vectors
+        self._renaming = True                # until then, lookups retry the rename
+        os.replace(tmp_path, self._vectors_path)
+        self._renaming = False
+        self._db.execute("DELETE FROM meta WHERE name = 'compacting'")
+        self._db.commit()
+        logger.info("EmbeddingCache: compacted to %d rows.", next_row)
@@ -0,0 +1,219 @@
+"""
+dedup.py — near-duplicate chunk bookkeeping for FAISSStore.
+
+Real corpora repeat themselves: licence footers, cookie banners, "Contact
+us" blocks, the same disclaimer under every page. Indexed as-is, each copy
+costs a vector and a text record, and a query that hits the boilerplate
+gets top_k copies of it. With `FAISSStore(dedup=True)` only the first copy
+(the survivor) is indexed; later copies become references to it.
+
+Two tests, cheapest first:
+    exact   a 64-bit hash of the normalised text (Unicode NFKC, case-folded,
+            whitespace collapsed) — catches copies that differ only in
+            spacing or case
+    near    cosine similarity to the nearest stored chunk at or above the
+            store's `dedup_threshold` — catches copies with a changed date,
+            name or typo. FAISSStore runs it as one top-1 search per batch.
+
+This module holds the bookkeeping only; FAISSStore does the searching:
+
+    hash ──▶ survivor id           (exact test)
+    survivor id ──▶ [(doc_id, chunk_idx), ...]   references to it
+    doc_id ──▶ [survivor id, ...]  references a document holds
+
+Deleting a document drops the references it holds. Deleting a survivor
+keeps its references under its text hash, so when the same text is added
+again (as in an upsert) the new chunk takes them over; until then those
+references have no chunk to point at and are counted as orphaned.
+
+Requirements:
+    pip install numpy
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Text as compared by the exact test: NFKC, case-folded, single spaces."""
+    return _SPACE.sub(" ", unicodedata.normalize("NFKC", text).casefold()).strip()
+
+
+def text_hash(text: str) -> int:
+    """Signed 64-bit hash of `normalize(text)`."""
+    digest = hashlib.blake2b(normalize(text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class ChunkDeduplicator:
+    """
+    Survivors, references and counts for a deduplicating FAISSStore.
+
+    Usage (FAISSStore does this on every add and delete):
+        dedup = ChunkDeduplicator()
+        dedup.survivor(text_hash("Cookie policy"))          # → None: new text
+        dedup.register(ids, hashes)                         # after indexing
+        dedup.refer([("d9", 3)], [survivor_id], n_exact=1)  # a copy seen later
+        dedup.stats()
+
+    Memory: two dict entries per indexed chunk (about 150 bytes) plus one
+    tuple per reference — small next to a 1024-dim vector, but not free.
+    """
+
+    def __init__(self) -> None:
+        self._by_hash: Dict[int, int] = {}
+        self._refs: Dict[int, List[Tuple[str, int]]] = {}
+        self._ref_docs: Dict[str, List[int]] = {}
+        self._orphans: Dict[int, List[Tuple[str, int]]] = {}   # hash → references
+        self.n_seen = 0
+        self.n_exact = 0
+        self.n_near = 0
+
+    # ------------------------------------------------------------------
+    # Adds
+    # ------------------------------------------------------------------
+
+    def survivor(self, h: int) -> int | None:
+        """Id of the indexed chunk whose text hashes to `h`, if any."""
+        return self._by_hash.get(h)
+
+    def register(self, ids: np.ndarray, hashes: Sequence[int]) -> None:
+        """Record newly indexed chunks; each adopts orphaned references to its text."""
+        for id_, h in zip(ids.tolist(), hashes):
+            self._by_hash.setdefault(h, id_)
+            orphans = self._orphans.pop(h, None)
+            if orphans and self._by_hash[h] == id_:
+                self._link(id_, orphans)
+        self.n_seen += len(ids)
+
+    def refer(
+        self,
+        refs: Sequence[Tuple[str, int]],
+        survivors: Sequence[int],
+        n_exact: int,
+    ) -> None:
+        """Record duplicates `refs` of `survivors`, `n_exact` of them found by hash."""
+        for ref, id_ in zip(refs, survivors):
+            self._link(id_, [ref])
+        self.n_seen += len(refs)
+        self.n_exact += n_exact
+        self.n_near += len(refs) - n_exact
+
+    def _link(self, id_: int, refs: List[Tuple[str, int]]) -> None:
+        self._refs.setdefault(id_, []).extend(refs)
+        for doc_id, _ in refs:
+            self._ref_docs.setdefault(doc_id, []).append(id_)
+
+    # ------------------------------------------------------------------
+    # Deletes
+    # ------------------------------------------------------------------
+
+    def delete(self, doc_id: str, ids: np.ndarray, hashes: Sequence[int]) -> int:
+        """
+        Forget document `doc_id`: its references, and its chunks `ids` (with
+        text hashes `hashes`) as survivors. Returns the references dropped.
+        """
+        dropped = 0
+        for id_ in set(self._ref_docs.pop(doc_id, ())):
+            kept = [r for r in self._refs[id_] if r[0] != doc_id]
+            dropped += len(self._refs[id_]) - len(kept)
+            if kept:
+                self._refs[id_] = kept
+            else:
+                del self._refs[id_]
+        for id_, h in zip(ids.tolist(), hashes):
+            if self._by_hash.get(h) == id_:
+                del self._by_hash[h]
+            refs = self._refs.pop(id_, None)
+            if refs:
+                self._orphans.setdefault(h, []).extend(refs)
+                for ref_doc, _ in refs:
+                    self._ref_docs[ref_doc].remove(id_)
+        for h in list(self._orphans):          # few: survivors rarely go first
+            kept = [r for r in self._orphans[h] if r[0] != doc_id]
+            dropped += len(self._orphans[h]) - len(kept)
+            if kept:
+                self._orphans[h] = kept
+            else:
+                del self._orphans[h]
+        return dropped
+
+    # ------------------------------------------------------------------
+    # Lookups and counts
+    # ------------------------------------------------------------------
+
+    def references(self, id_: int) -> List[Tuple[str, int]]:
+        """(doc_id, chunk_idx) of the duplicates folded into chunk `id_`."""
+        return self._refs.get(id_, [])
+
+    def stats(self) -> Dict[str, float]:
+        """
+        How much deduplication saved since the store was created:
+            chunks_seen       chunks handed to add()
+            exact_duplicates  folded by the text hash
+            near_duplicates   folded by cosine similarity
+            references        live references (after deletes)
+            orphaned          references whose survivor was deleted
+            reduction         share of chunks_seen not indexed
+        """
+        duplicates = self.n_exact + self.n_near
+        return {
+            "chunks_seen": self.n_seen,
+            "exact_duplicates": self.n_exact,
+            "near_duplicates": self.n_near,
+            "references": sum(len(r) for r in self._refs.values()),
+            "orphaned": sum(len(r) for r in self._orphans.values()),
+            "reduction": duplicates / self.n_seen if self.n_seen else 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """
+        Write the state into directory `path`:
+            dedup.json          counts, references and orphans
+            dedup_hashes.npy    (N, 2) int64 rows of (hash, survivor id)
+        """
+        os.makedirs(path, exist_ok=True)
+        pairs = np.array(list(self._by_hash.items()), dtype=np.int64).reshape(-1, 2)
+        tmp = os.path.join(path, "dedup_hashes.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, pairs)
+        os.replace(tmp, os.path.join(path, "dedup_hashes.npy"))
+        tmp = os.path.join(path, "dedup.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "counts": [self.n_seen, self.n_exact, self.n_near],
+                "refs": [[id_, refs] for id_, refs in self._refs.items()],
+                "orphans": [[h, refs] for h, refs in self._orphans.items()],
+            }, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, "dedup.json"))
+
+    @classmethod
+    def load(cls, path: str) -> ChunkDeduplicator:
+        """Read state written by `save()`."""
+        with open(os.path.join(path, "dedup.json"), encoding="utf-8") as f:
+            state = json.load(f)
+        dedup = cls()
+        pairs = np.load(os.path.join(path, "dedup_hashes.npy"))
+        dedup._by_hash = dict(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()))
+        for id_, refs in state["refs"]:
+            dedup._link(id_, [(doc_id, idx) for doc_id, idx in refs])
+        dedup._orphans = {h: [(d, i) for d, i in refs] for h, refs in state["orphans"]}
+        dedup.n_seen, dedup.n_exact, dedup.n_near = state["counts"]
+        return dedup
@@ -3,7 +3,7 @@ embedder.py — Qwen3-Embedding-0.6B text embedder with late chunking.
 
 Model facts (HuggingFace model card, June 2025):
     Model       : Qwen/Qwen3-Embedding-0.6B (0.6B params, 28 layers)
-    Output dim  : 1024  (MRL: truncatable to 32–1024)
+    Output dim  : 1024  (MRL: truncatable to 32–1024 — see `output_dim`)
     Context     : 32 768 tokens
     Pooling     : last-token pool (EOS position) — decoder architecture
     Norm        : L2 required → cosine ≡ dot product
@@ -11,8 +11,32 @@ Model facts (HuggingFace model card, June 2025):
     Documents   : no instruction prefix
 
 Two encoding modes:
-    encode()           — standard batched encoding, last-token pool
+    encode()           — standard encoding, last-token pool, length-bucketed
+                         batches packed to a padded-token budget
     encode_document()  — late chunking: one forward pass, last-token pool per window
+    encode_documents() — late chunking for many documents, packed into padded
+                         multi-document forward passes
+    encode_document_batches()
+                       — encode_documents() over a stream of batches, with
+                         tokenizing and decoding on worker threads so the
+                         model runs back-to-back
+    encode_document_stream()
+                       — late chunking past 32k tokens: overlapping windows,
+                         chunk vectors yielded one window at a time
+
+Results can be persisted in an EmbeddingCache (cache.py): re-encoding
+unchanged text then costs a disk read instead of a forward pass.
+
+Inference backends (CPU speed-ups, same API and outputs up to rounding):
+    "torch"  — the fp32 HuggingFace model (default, any device)
+    "int8"   — torch dynamic quantisation: Linear weights stored as int8,
+               activations quantised on the fly. CPU only.
+    "onnx"   — the model exported once to ONNX and run by ONNX Runtime.
+               CPU only; needs `pip install onnx onnxruntime`.
+
+Loading is lazy: importing this module pulls in only numpy, and the model
+weights are read on the first call that needs them (or on `warmup()`).
+torch and transformers are imported at that point too.
 
 Requirements:
     pip install transformers>=4.51.0 torch numpy
@@ -21,18 +45,28 @@ Requirements:
 from __future__ import annotations
 
 import logging
-from typing import List
+import os
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Iterable, Iterator, List
 
 import numpy as np
-import torch
-import torch.nn.functional as F
-from transformers import AutoModel, AutoTokenizer
+
+if TYPE_CHECKING:
+    import torch
+
+    from .cache import EmbeddingCache
 
 logger = logging.getLogger(__name__)
 
 MODEL_ID = "Qwen/Qwen3-Embedding-0.6B"
 EMBEDDING_DIM = 1024
 MAX_SEQ_TOKENS = 32_768
+MIN_OUTPUT_DIM = 32                      # smallest MRL-trained prefix
+BACKENDS = ("torch", "int8", "onnx")
 
 
 # ---------------------------------------------------------------------------
@@ -53,6 +87,8 @@ def _last_token_pool(
 
     Directly from the model card.
     """
+    import torch
+
     left_padding = attention_mask[:, -1].sum() == attention_mask.shape[0]
     if left_padding:
         return hidden_states[:, -1]
@@ -61,11 +97,99 @@ def _last_token_pool(
     return hidden_states[batch_idx, lengths]
 
 
+# ---------------------------------------------------------------------------
+# Matryoshka truncation
+# ---------------------------------------------------------------------------
+
+def _mrl_truncate(vecs: np.ndarray, dim: int) -> np.ndarray:
+    """
+    Keep the first `dim` components of each row and re-normalise.
+
+    Qwen3-Embedding is trained with Matryoshka Representation Learning: the
+    leading components carry the most information, so a prefix is itself a
+    usable (smaller) embedding. It must be re-normalised for dot product to
+    stay equal to cosine.
+    """
+    if dim >= vecs.shape[1]:
+        return vecs
+    head = np.ascontiguousarray(vecs[:, :dim])
+    norms = np.linalg.norm(head, axis=1, keepdims=True)
+    return head / np.maximum(norms, 1e-12)
+
+
+# ---------------------------------------------------------------------------
+# Batching
+# ---------------------------------------------------------------------------
+
+def _token_budget_batches(
+    lengths: List[int],
+    max_tokens: int,
+    max_count: int,
+) -> List[List[int]]:
+    """
+    Group sequence indices into batches whose padded size fits a token budget.
+
+    A padded batch costs (#sequences × longest sequence) tokens, so mixing one
+    long text with several short ones wastes most of the forward pass on
+    padding. Sorting by length first puts similar lengths together; batches
+    are then packed greedily until adding the next sequence would exceed
+    `max_tokens` padded tokens or `max_count` sequences.
+
+    A sequence longer than the budget on its own still gets a batch (of one).
+
+    Returns:
+        List of batches, each a list of indices into `lengths`. Longest
+        sequences come first.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches: List[List[int]] = []
+    current: List[int] = []
+    width = 0                                   # longest length in `current`
+    for i in order:
+        n = max(lengths[i], 1)
+        if current and (
+            max(width, n) * (len(current) + 1) > max_tokens
+            or len(current) >= max_count
+        ):
+            batches.append(current)
+            current, width = [], 0
+        current.append(i)
+        width = max(width, n)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _left_pad(
+    sequences: List[List[int]],
+    pad_id: int,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Left-pad token id lists into (input_ids, attention_mask) tensors.
+
+    Left padding keeps the last position real for every row, which is what
+    `_last_token_pool` expects.
+    """
+    import torch
+
+    width = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), width), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+    for row, seq in enumerate(sequences):
+        if seq:
+            input_ids[row, width - len(seq):] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[row, width - len(seq):] = 1
+    return input_ids, attention_mask
+
+
 # ---------------------------------------------------------------------------
 # Device helper
 # ---------------------------------------------------------------------------
 
 def _auto_device() -> str:
+    import torch
+
     if torch.cuda.is_available():
         return "cuda"
     if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
@@ -73,13 +197,97 @@ def _auto_device() -> str:
     return "cpu"
 
 
+# ---------------------------------------------------------------------------
+# CPU backends
+# ---------------------------------------------------------------------------
+
+def _quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantisation of every Linear layer (weights int8, fp32 I/O)."""
+    import torch
+
+    with warnings.catch_warnings():
+        # torch.ao.quantization warns that it is moving to torchao; the eager
+        # dynamic path is still the one that needs no extra dependency.
+        warnings.simplefilter("ignore")
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8,
+        )
+
+
+def _export_onnx(model: torch.nn.Module, path: str) -> None:
+    """Export `model` to ONNX with dynamic batch and sequence axes."""
+    import torch
+
+    class _HiddenStates(torch.nn.Module):
+        """Export wrapper: (input_ids, attention_mask) → last_hidden_state."""
+
+        def __init__(self, model: torch.nn.Module) -> None:
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(
+                input_ids=input_ids, attention_mask=attention_mask, use_cache=False,
+            ).last_hidden_state
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    example = torch.ones((2, 8), dtype=torch.long)
+    axes = {0: "batch", 1: "seq"}
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter("ignore")     # tracer chatter about constant folding
+        torch.onnx.export(
+            _HiddenStates(model), (example, torch.ones_like(example)), path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": axes, "attention_mask": axes, "last_hidden_state": axes,
+            },
+            opset_version=17,
+            dynamo=False,                   # TorchScript exporter: works on torch 2.x
+        )
+    logger.info("Exported ONNX model to %s", path)
+
+
+class _OnnxModel:
+    """
+    ONNX Runtime session behind the same call the torch model gets:
+    model(input_ids=..., attention_mask=...).last_hidden_state.
+    """
+
+    def __init__(self, path: str) -> None:
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "backend='onnx' needs onnxruntime: pip install onnx onnxruntime"
+            ) from e
+        self._session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        import torch
+
+        hidden = self._session.run(
+            ["last_hidden_state"],
+            {
+                "input_ids": input_ids.cpu().numpy(),
+                "attention_mask": attention_mask.cpu().numpy(),
+            },
+        )[0]
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(hidden))
+
+
+def _default_onnx_path(model_id: str) -> str:
+    name = model_id.strip("/").replace("/", "__")
+    return os.path.join(os.path.expanduser("~/.cache/pyutils/onnx"), f"{name}.onnx")
+
+
 # ---------------------------------------------------------------------------
 # Embedder
 # ---------------------------------------------------------------------------
 
 class QwenEmbedder:
     """
-    Encodes text → L2-normalised 1024-d float32 vectors.
+    Encodes text → L2-normalised 1024-d float32 vectors (or `output_dim`-d).
 
     Standard mode (queries & short texts):
         vecs = embedder.encode(["query 1", "query 2"], is_query=True)
@@ -89,33 +297,125 @@ class QwenEmbedder:
         # texts[i] = decoded chunk string
         # vecs.shape = (n_chunks, 1024)
 
+    Construction is cheap: tokenizer and weights load on first use. Call
+    `warmup()` to pay that cost up front, e.g. before serving traffic.
+
     Args:
-        device:     "cuda" | "mps" | "cpu" | None (auto)
-        batch_size: texts per forward pass for encode()
+        device:           "cuda" | "mps" | "cpu" | None (auto, resolved at load)
+        batch_size:       max texts per forward pass for encode()
+        max_batch_tokens: max padded tokens per forward pass for encode();
+                          texts are sorted by length and packed up to this
+                          budget, so short texts are not padded to long ones
+        model_id:         HuggingFace model id or local path
+        cache:            optional EmbeddingCache; encode(), encode_document()
+                          and encode_documents() then only run the model on
+                          text they have not seen before
+        output_dim:       MRL output size, 32–1024. Vectors are cut to their
+                          first `output_dim` components and re-normalised
+                          (256 → 4x smaller index). The cache always stores
+                          full 1024-d vectors, so changing this needs no
+                          re-encoding.
+        backend:          "torch" | "int8" | "onnx" (see module docstring);
+                          "int8" and "onnx" run on CPU only
+        onnx_path:        where the ONNX export is written and reused from;
+                          defaults to ~/.cache/pyutils/onnx/<model>.onnx.
+                          Delete it after changing the model weights.
     """
 
     def __init__(
         self,
         device: str | None = None,
         batch_size: int = 8,
+        max_batch_tokens: int = 16_384,
+        model_id: str = MODEL_ID,
+        cache: EmbeddingCache | None = None,
+        output_dim: int = EMBEDDING_DIM,
+        backend: str = "torch",
+        onnx_path: str | None = None,
     ) -> None:
-        self.device = device or _auto_device()
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {list(BACKENDS)}, got {backend!r}")
+        if not MIN_OUTPUT_DIM <= output_dim <= EMBEDDING_DIM:
+            raise ValueError(
+                f"output_dim must be in [{MIN_OUTPUT_DIM}, {EMBEDDING_DIM}], got {output_dim}"
+            )
+        if backend != "torch":
+            device = device or "cpu"
+            if device != "cpu":
+                raise ValueError(f"backend={backend!r} runs on CPU only, got device={device!r}")
+        self._device = device
         self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.model_id = model_id
+        self.cache = cache
+        self.output_dim = output_dim
+        self.backend = backend
+        self.onnx_path = onnx_path
 
-        self._tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_ID, padding_side="left",
-        )
-        self._model = AutoModel.from_pretrained(MODEL_ID)
-        self._model.to(self.device).eval()
+        self._tokenizer = None
+        self._model = None
+        self._load_lock = threading.Lock()
 
-        logger.info("QwenEmbedder ready — device=%s", self.device)
+    # ------------------------------------------------------------------
+    # Lazy loading
+    # ------------------------------------------------------------------
+
+    @property
+    def device(self) -> str:
+        if self._device is None:
+            self._device = _auto_device()
+        return self._device
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def _ensure_loaded(self) -> None:
+        """Load tokenizer and weights (and set up the backend) once."""
+        if self._model is not None:
+            return
+        with self._load_lock:
+            if self._model is not None:
+                return
+            from transformers import AutoModel, AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(self.model_id, padding_side="left")
+            model = AutoModel.from_pretrained(self.model_id)
+            model.to(self.device).eval()
+
+            if self.backend == "int8":
+                model = _quantize_int8(model)
+            elif self.backend == "onnx":
+                onnx_path = self.onnx_path or _default_onnx_path(self.model_id)
+                if not os.path.exists(onnx_path):
+                    _export_onnx(model, onnx_path)
+                model = _OnnxModel(onnx_path)
+
+            self._tokenizer = tokenizer
+            self._model = model
+            logger.info(
+                "QwenEmbedder ready — device=%s backend=%s", self.device, self.backend,
+            )
+
+    def warmup(self) -> None:
+        """
+        Load the weights now and run one small forward pass, so the first real
+        request does not pay for loading or first-call kernel setup.
+        """
+        self._ensure_loaded()
+        self._encode_uncached(["warmup"], is_query=False, task="")
+
+    @property
+    def _cache_model_id(self) -> str:
+        """Model id for cache keys; other backends give slightly different vectors."""
+        return self.model_id if self.backend == "torch" else f"{self.model_id}#{self.backend}"
 
     @property
     def dim(self) -> int:
-        return EMBEDDING_DIM
+        return self.output_dim
 
     # ------------------------------------------------------------------
-    # Standard encode — batched, last-token pool
+    # Standard encode — length-bucketed batches, last-token pool
     # ------------------------------------------------------------------
 
     def encode(
@@ -127,39 +427,87 @@ class QwenEmbedder:
         """
         Encode texts with last-token pooling.
 
+        Texts are tokenized once, sorted by length and packed into batches
+        of at most `max_batch_tokens` padded tokens (and `batch_size` texts),
+        so a long text is never padded against many short ones. Rows come
+        back in input order.
+
         Args:
             texts:    one string or list of strings
             is_query: if True, prepend the task instruction (improves retrieval 1-5%)
             task:     instruction string (only used when is_query=True)
 
         Returns:
-            (N, 1024) float32, L2-normalised.
+            (N, dim) float32, L2-normalised.
         """
         if isinstance(texts, str):
             texts = [texts]
 
+        if self.cache is None:
+            return _mrl_truncate(self._encode_uncached(texts, is_query, task), self.dim)
+
+        keys = [
+            self.cache.key(self._cache_model_id, t, is_query, task if is_query else None)
+            for t in texts
+        ]
+        hits = self.cache.get_many(keys)
+        misses = [i for i, hit in enumerate(hits) if hit is None]
+
+        out_vecs = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for i, hit in enumerate(hits):
+            if hit is not None:
+                out_vecs[i] = hit[1][0]
+        if misses:
+            fresh = self._encode_uncached([texts[i] for i in misses], is_query, task)
+            out_vecs[misses] = fresh
+            self.cache.put_many(
+                [(keys[i], fresh[j : j + 1], None) for j, i in enumerate(misses)]
+            )
+        return _mrl_truncate(out_vecs, self.dim)
+
+    def _encode_uncached(
+        self,
+        texts: List[str],
+        is_query: bool,
+        task: str,
+    ) -> np.ndarray:
+        import torch
+        import torch.nn.functional as F
+
         if is_query:
             texts = [f"Instruct: {task}\nQuery: {t}" for t in texts]
 
-        parts: List[np.ndarray] = []
-        for i in range(0, len(texts), self.batch_size):
-            batch = texts[i : i + self.batch_size]
-            encoded = self._tokenizer(
-                batch,
-                padding=True,
-                truncation=True,
-                max_length=MAX_SEQ_TOKENS,
-                return_tensors="pt",
-            ).to(self.device)
+        out_vecs = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        if not texts:
+            return out_vecs
+        self._ensure_loaded()
+
+        token_ids = self._tokenizer(
+            texts,
+            truncation=True,
+            max_length=MAX_SEQ_TOKENS,
+        )["input_ids"]
+        batches = _token_budget_batches(
+            [len(ids) for ids in token_ids],
+            max_tokens=self.max_batch_tokens,
+            max_count=self.batch_size,
+        )
+
+        for batch in batches:
+            input_ids, attention_mask = _left_pad(
+                [token_ids[i] for i in batch], self._tokenizer.pad_token_id,
+            )
+            input_ids = input_ids.to(self.device)
+            attention_mask = attention_mask.to(self.device)
 
             with torch.no_grad():
-                out = self._model(**encoded)
+                out = self._model(input_ids=input_ids, attention_mask=attention_mask)
 
-            pooled = _last_token_pool(out.last_hidden_state, encoded["attention_mask"])
+            pooled = _last_token_pool(out.last_hidden_state, attention_mask)
             normed = F.normalize(pooled, p=2, dim=1)
-            parts.append(normed.float().cpu().numpy())
+            out_vecs[batch] = normed.float().cpu().numpy()   # restore input order
 
-        return np.vstack(parts).astype(np.float32)
+        return out_vecs
 
     # ------------------------------------------------------------------
     # Late chunking — one forward pass, contextual chunk embeddings
@@ -195,50 +543,397 @@ class QwenEmbedder:
             context from earlier ones — the whole point of late chunking.
 
         Args:
-            text:          raw document string (truncated at 32k tokens)
+            text:          raw document string (truncated at 32k tokens; use
+                           encode_document_stream() to embed all of it)
             chunk_tokens:  tokens per chunk window (no overlap needed — the
                            model's causal attention provides cross-chunk context)
 
         Returns:
             (chunk_texts, embeddings) where
                 chunk_texts : list[str] — decoded text per chunk
-                embeddings  : (n_chunks, 1024) float32, L2-normalised.
-                              Empty input → ([], zeros (0, 1024)).
+                embeddings  : (n_chunks, dim) float32, L2-normalised.
+                              Empty input → ([], zeros (0, dim)).
         """
-        encoded = self._tokenizer(
+        import torch
+
+        self._ensure_loaded()
+        token_ids = self._tokenizer(
             text,
             add_special_tokens=False,
-            truncation=True,
-            max_length=MAX_SEQ_TOKENS,
             return_tensors="pt",
-        ).to(self.device)
-
-        token_ids = encoded["input_ids"][0]           # (seq_len,)
+        )["input_ids"][0]
+        truncated = token_ids.size(0) > MAX_SEQ_TOKENS
+        token_ids = token_ids[:MAX_SEQ_TOKENS]        # (seq_len,)
         seq_len = token_ids.size(0)
 
         if seq_len == 0:                              # empty / whitespace text
-            return [], np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
-
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+
+        # Cache entries hold whole-document results, so a truncated pass
+        # neither reads nor writes one.
+        key = None
+        if self.cache is not None and not truncated:
+            key = self.cache.key(self._cache_model_id, text, chunk_tokens=chunk_tokens)
+            hit = self.cache.get(key)
+            if hit is not None:
+                return hit[0], _mrl_truncate(hit[1], self.dim)
+
+        input_ids = token_ids.unsqueeze(0).to(self.device)
         with torch.no_grad():
-            out = self._model(**encoded)
+            out = self._model(
+                input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+            )
         hidden = out.last_hidden_state[0]             # (seq_len, 1024)
 
-        chunk_texts: List[str] = []
-        chunk_vecs: List[torch.Tensor] = []
+        chunk_texts, embeddings = self._pool_windows(hidden, token_ids, chunk_tokens)
+        if key is not None:
+            self.cache.put(key, embeddings, chunk_texts)
+        return chunk_texts, _mrl_truncate(embeddings, self.dim)
+
+    def encode_documents(
+        self,
+        texts: List[str],
+        chunk_tokens: int = 512,
+    ) -> List[tuple[List[str], np.ndarray]]:
+        """
+        Late chunking for many documents, several per forward pass.
 
-        for start in range(0, seq_len, chunk_tokens):
-            end = min(start + chunk_tokens, seq_len)
+        Documents are sorted by length and packed into left-padded batches
+        under the same `max_batch_tokens` / `batch_size` limits as encode().
+        Padding sits before each document and is masked out, so the real
+        tokens attend exactly as they would alone; each document's windows
+        are then cut from its own unpadded tail of the batch output.
 
-            # Represent the window by its last token (matches query pooling).
-            chunk_vecs.append(hidden[end - 1])
+        Documents longer than MAX_SEQ_TOKENS go through
+        encode_document_stream() instead of being truncated.
+
+        Args:
+            texts:         raw document strings
+            chunk_tokens:  tokens per chunk window
 
-            # Decode this window's tokens back to readable text.
-            ids = token_ids[start:end]
-            chunk_texts.append(
-                self._tokenizer.decode(ids, skip_special_tokens=True).strip()
+        Returns:
+            One (chunk_texts, embeddings) pair per input text, in input order,
+            each as returned by encode_document().
+        """
+        if self.cache is None:
+            results = self._encode_documents_uncached(texts, chunk_tokens)
+            return [(t, _mrl_truncate(v, self.dim)) for t, v in results]
+
+        keys = [
+            self.cache.key(self._cache_model_id, t, chunk_tokens=chunk_tokens)
+            for t in texts
+        ]
+        results = self.cache.get_many(keys)
+        misses = [i for i, hit in enumerate(results) if hit is None]
+        if misses:
+            fresh = self._encode_documents_uncached(
+                [texts[i] for i in misses], chunk_tokens,
             )
+            for i, result in zip(misses, fresh):
+                results[i] = result
+            self.cache.put_many([
+                (keys[i], vecs, chunk_texts)
+                for i, (chunk_texts, vecs) in zip(misses, fresh)
+                if chunk_texts
+            ])
+        return [(t, _mrl_truncate(v, self.dim)) for t, v in results]
+
+    def encode_document_batches(
+        self,
+        batches: Iterable[List[str]],
+        chunk_tokens: int = 512,
+        workers: int = 2,
+        depth: int = 2,
+    ) -> Iterator[List[tuple[List[str], np.ndarray]]]:
+        """
+        encode_documents() over a stream of batches, with its stages overlapped.
+
+            tokenize (pool) ──▶ forward (this thread) ──▶ decode + cache (pool)
 
-        embeddings = torch.stack(chunk_vecs)
-        embeddings = F.normalize(embeddings, p=2, dim=1)
+        While the model runs batch n, worker threads tokenize the batches
+        after it and decode the chunk texts of the ones before it. The fast
+        tokenizer does both in Rust without holding the GIL, so the model
+        goes from one forward pass straight to the next instead of waiting
+        for the tokenizer on either side.
 
-        return chunk_texts, embeddings.float().cpu().numpy()
\ No newline at end of file
+        Args:
+            batches:      lists of raw document strings, consumed lazily
+            chunk_tokens: tokens per chunk window
+            workers:      threads for tokenizing and decoding
+            depth:        batches tokenized ahead of the model, and batches
+                          left decoding behind it; bounds the memory held
+
+        Yields:
+            encode_documents(batch, chunk_tokens) for each batch, in order.
+        """
+        self._ensure_loaded()
+        batches = iter(batches)
+        ahead: deque = deque()                 # futures of _prepare_batch()
+        behind: deque = deque()                # futures of _finish_batch()
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="embedder") as pool:
+            def read_ahead() -> None:
+                while len(ahead) < depth:
+                    texts = next(batches, None)
+                    if texts is None:
+                        return
+                    ahead.append(pool.submit(self._prepare_batch, texts, chunk_tokens))
+
+            read_ahead()
+            while ahead:
+                texts, keys, results, misses, token_ids = ahead.popleft().result()
+                read_ahead()
+                windows = self._forward_documents(
+                    [texts[i] for i in misses], token_ids, chunk_tokens,
+                ) if misses else []
+                behind.append(pool.submit(self._finish_batch, keys, results, misses, windows))
+                if len(behind) > depth:
+                    yield behind.popleft().result()
+            while behind:
+                yield behind.popleft().result()
+
+    def _prepare_batch(self, texts: List[str], chunk_tokens: int):
+        """Cache lookup and tokenization of one encode_document_batches() batch."""
+        keys = None
+        results: List[tuple[List[str], np.ndarray] | None] = [None] * len(texts)
+        if self.cache is not None:
+            keys = [
+                self.cache.key(self._cache_model_id, t, chunk_tokens=chunk_tokens)
+                for t in texts
+            ]
+            results = self.cache.get_many(keys)
+        misses = [i for i, hit in enumerate(results) if hit is None]
+        token_ids = self._tokenize([texts[i] for i in misses]) if misses else []
+        return texts, keys, results, misses, token_ids
+
+    def _finish_batch(
+        self,
+        keys: List[str] | None,
+        results: List[tuple[List[str], np.ndarray] | None],
+        misses: List[int],
+        windows: List[tuple[List[List[int]], np.ndarray]],
+    ) -> List[tuple[List[str], np.ndarray]]:
+        """Decode, cache and truncate one encode_document_batches() batch."""
+        for i, (window_ids, vecs) in zip(misses, windows):
+            results[i] = self._decode_windows(window_ids), vecs
+        if keys is not None and misses:
+            self.cache.put_many([
+                (keys[i], results[i][1], results[i][0])
+                for i in misses
+                if results[i][0]
+            ])
+        return [(t, _mrl_truncate(v, self.dim)) for t, v in results]
+
+    def _encode_documents_uncached(
+        self,
+        texts: List[str],
+        chunk_tokens: int,
+    ) -> List[tuple[List[str], np.ndarray]]:
+        if not texts:
+            return []
+        windows = self._forward_documents(texts, self._tokenize(texts), chunk_tokens)
+        return [(self._decode_windows(w), vecs) for w, vecs in windows]
+
+    # The three stages of _encode_documents_uncached(), apart so that
+    # encode_document_batches() can overlap them.
+
+    def _tokenize(self, texts: List[str]) -> List[List[int]]:
+        """Token ids of each text, no special tokens, untruncated."""
+        self._ensure_loaded()
+        return self._tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    def _forward_documents(
+        self,
+        texts: List[str],
+        token_ids: List[List[int]],
+        chunk_tokens: int,
+    ) -> List[tuple[List[List[int]], np.ndarray]]:
+        """
+        Run the model over tokenized documents; one (window token ids,
+        full-dim vectors) pair per document, texts not yet decoded.
+        """
+        import torch
+
+        self._ensure_loaded()
+        results: List[tuple[List[List[int]], np.ndarray] | None] = [None] * len(texts)
+
+        fits: List[int] = []
+        for i, ids in enumerate(token_ids):
+            if not ids:                                       # empty / whitespace
+                results[i] = [], np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+            elif len(ids) > MAX_SEQ_TOKENS:
+                windows = list(self._stream_window_vectors(texts[i], chunk_tokens))
+                results[i] = (
+                    [w for window_ids, _ in windows for w in window_ids],
+                    np.vstack([vecs for _, vecs in windows]),
+                )
+            else:
+                fits.append(i)
+
+        batches = _token_budget_batches(
+            [len(token_ids[i]) for i in fits],
+            max_tokens=self.max_batch_tokens,
+            max_count=self.batch_size,
+        )
+        for batch in batches:
+            docs = [fits[j] for j in batch]
+            input_ids, attention_mask = _left_pad(
+                [token_ids[i] for i in docs], self._tokenizer.pad_token_id,
+            )
+            with torch.no_grad():
+                out = self._model(
+                    input_ids=input_ids.to(self.device),
+                    attention_mask=attention_mask.to(self.device),
+                )
+
+            width = input_ids.size(1)
+            for row, i in enumerate(docs):
+                pad = width - len(token_ids[i])
+                results[i] = self._window_vectors(
+                    out.last_hidden_state[row, pad:], input_ids[row, pad:], chunk_tokens,
+                )
+
+        return results
+
+    def encode_document_stream(
+        self,
+        text: str,
+        chunk_tokens: int = 512,
+        context_tokens: int = 1024,
+        window_tokens: int = MAX_SEQ_TOKENS,
+    ) -> Iterator[tuple[List[str], np.ndarray]]:
+        """
+        Late chunking for documents of any length, one window at a time.
+
+        The document is tokenized in full and run through the model in
+        windows of at most `window_tokens`. Every window after the first
+        starts with the last `context_tokens` tokens of the previous one as a
+        carry-over prefix: those tokens are read for context but produce no
+        chunks, so chunks never repeat and each one still sees the text just
+        before it.
+
+            window 1:  [ chunk | chunk | ... | chunk ]
+            window 2:            [ prefix | chunk | ... | chunk ]
+            window 3:                       [ prefix | chunk | ... ]
+
+        Window bodies are whole multiples of `chunk_tokens`, so chunk
+        boundaries fall exactly where a single pass would put them. A
+        document that fits in one window gives the same result as
+        encode_document().
+
+        Yields (chunk_texts, embeddings) per window, as soon as it is done —
+        peak memory is one window's activations, not the whole document's.
+
+        Args:
+            text:           raw document string (any length)
+            chunk_tokens:   tokens per chunk
+            context_tokens: carry-over prefix read before each later window
+            window_tokens:  tokens per forward pass (model limit by default)
+
+        Yields:
+            (chunk_texts, embeddings) with embeddings (n, dim) float32,
+            L2-normalised. Chunks across all yields are in document order.
+        """
+        for chunk_texts, embeddings in self._stream_windows(
+            text, chunk_tokens, context_tokens, window_tokens,
+        ):
+            yield chunk_texts, _mrl_truncate(embeddings, self.dim)
+
+    def _stream_windows(
+        self,
+        text: str,
+        chunk_tokens: int,
+        context_tokens: int = 1024,
+        window_tokens: int = MAX_SEQ_TOKENS,
+    ) -> Iterator[tuple[List[str], np.ndarray]]:
+        """encode_document_stream() at full 1024-d."""
+        for windows, vecs in self._stream_window_vectors(
+            text, chunk_tokens, context_tokens, window_tokens,
+        ):
+            yield self._decode_windows(windows), vecs
+
+    def _stream_window_vectors(
+        self,
+        text: str,
+        chunk_tokens: int,
+        context_tokens: int = 1024,
+        window_tokens: int = MAX_SEQ_TOKENS,
+    ) -> Iterator[tuple[List[List[int]], np.ndarray]]:
+        """_stream_windows() with the chunk texts left as token ids."""
+        first_body = (window_tokens // chunk_tokens) * chunk_tokens
+        body = ((window_tokens - context_tokens) // chunk_tokens) * chunk_tokens
+        if context_tokens < 0 or body <= 0:
+            raise ValueError(
+                f"window_tokens={window_tokens} leaves no room for a "
+                f"{chunk_tokens}-token chunk after a {context_tokens}-token prefix"
+            )
+        import torch
+
+        self._ensure_loaded()
+        token_ids = self._tokenizer(
+            text,
+            add_special_tokens=False,
+            return_tensors="pt",
+        )["input_ids"][0]                             # (seq_len,), untruncated
+        seq_len = token_ids.size(0)
+
+        start = 0
+        while start < seq_len:
+            end = min(start + (first_body if start == 0 else body), seq_len)
+            prefix_start = max(0, start - context_tokens)
+
+            window = token_ids[prefix_start:end].unsqueeze(0).to(self.device)
+            with torch.no_grad():
+                out = self._model(
+                    input_ids=window, attention_mask=torch.ones_like(window),
+                )
+            hidden = out.last_hidden_state[0, start - prefix_start:]
+
+            yield self._window_vectors(hidden, token_ids[start:end], chunk_tokens)
+            start = end
+
+    def _pool_windows(
+        self,
+        hidden: torch.Tensor,
+        token_ids: torch.Tensor,
+        chunk_tokens: int,
+    ) -> tuple[List[str], np.ndarray]:
+        """
+        Split aligned (hidden, token_ids) into chunk_tokens windows; keep
+        each window's last-token state and decoded text.
+        """
+        windows, embeddings = self._window_vectors(hidden, token_ids, chunk_tokens)
+        return self._decode_windows(windows), embeddings
+
+    def _window_vectors(
+        self,
+        hidden: torch.Tensor,
+        token_ids: torch.Tensor,
+        chunk_tokens: int,
+    ) -> tuple[List[List[int]], np.ndarray]:
+        """_pool_windows() without the decoding: window token ids, vectors."""
+        import torch.nn.functional as F
+
+        ids = token_ids.tolist()
+        starts = range(0, len(ids), chunk_tokens)
+        windows = [ids[start : start + chunk_tokens] for start in starts]
+
+        # Represent each window by its last token (matches query pooling).
+        last = [start + len(window) - 1 for start, window in zip(starts, windows)]
+        embeddings = F.normalize(hidden[last], p=2, dim=1)
+        return windows, embeddings.float().cpu().numpy()
+
+    def _decode_windows(self, windows: List[List[int]]) -> List[str]:
+        """
+        Decode windows of token ids back to readable, stripped text.
+
+        A fast tokenizer decodes the whole list in one Rust call that runs
+        without the GIL, so decoding on a worker thread overlaps the next
+        forward pass instead of stalling it.
+        """
+        tokenizer = self._tokenizer
+        if getattr(tokenizer, "is_fast", False) and not tokenizer.clean_up_tokenization_spaces:
+            texts = tokenizer.backend_tokenizer.decode_batch(windows, skip_special_tokens=True)
+        else:
+            texts = [tokenizer.decode(ids, skip_special_tokens=True) for ids in windows]
+        return [t.strip() for t in texts]
@@ -5,11 +5,11 @@ Install:
     pip install transformers>=4.51.0 torch numpy faiss-cpu
 
 Run:
-    python example.py
+    python -m pyutils.embedders.example
 """
 
-from embedder import QwenEmbedder
-from rag import RAGPipeline
+from .embedder import QwenEmbedder
+from .rag import RAGPipeline
 
 # ------------------------------------------------------------------
 # 1. Bare embedder
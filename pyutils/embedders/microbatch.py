@@ -0,0 +1,181 @@
+"""
+microbatch.py — asyncio micro-batching of query encodes.
+
+A query service that encodes each request on its own runs the model with a
+batch of one, over and over. QueryMicrobatcher sits in front of an embedder
+and merges concurrent requests: the first request opens a short window
+(`max_wait_ms`); everything that arrives before it closes, up to
+`max_batch`, is encoded in one forward pass, and each caller gets its own
+row back.
+
+    caller A ─┐
+    caller B ─┼─▶ [ wait ≤ max_wait_ms | ≤ max_batch ] ─▶ encode(batch) ─▶ rows
+    caller C ─┘
+
+The model runs in a single background thread, so the event loop stays
+responsive during a forward pass; queries that arrive meanwhile are queued
+and form the next batch.
+
+Requirements:
+    pip install numpy
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class QueryMicrobatcher:
+    """
+    Batches concurrent `encode(..., is_query=True)` calls on one embedder.
+
+    Usage (inside a running event loop):
+        batcher = QueryMicrobatcher(embedder, max_batch=32, max_wait_ms=2)
+        vec = await batcher.encode("what is gamma exposure?")   # (dim,)
+        ...
+        await batcher.close()
+
+    Args:
+        embedder:    anything with encode(texts, is_query, task) → (N, dim)
+        max_batch:   most queries per forward pass
+        max_wait_ms: longest a query waits for others to join its batch
+        task:        default instruction for queries (None → the embedder's)
+    """
+
+    def __init__(
+        self,
+        embedder,
+        max_batch: int = 32,
+        max_wait_ms: float = 2.0,
+        task: str | None = None,
+    ) -> None:
+        self.embedder = embedder
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.task = task
+
+        self.n_batches = 0
+        self.n_queries = 0
+
+        self._queue: asyncio.Queue | None = None
+        self._runner: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None   # the runner's
+        self._batch: List[Tuple[str, str | None, asyncio.Future]] = []   # taken off the queue
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="microbatch")
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    async def encode(self, text: str, task: str | None = None) -> np.ndarray:
+        """
+        Encode one query; resolves once its batch has run. Returns (dim,).
+
+        The batching task lives on the event loop that first called this.
+        Calls from a new loop (e.g. a second `asyncio.run()`) start a fresh
+        one, unless the old loop is still running, which raises.
+        """
+        if self._closed:
+            raise RuntimeError("QueryMicrobatcher is closed")
+        loop = asyncio.get_running_loop()
+        if self._runner is None or self._runner.done() or self._loop is not loop:
+            if self._loop not in (None, loop) and self._loop.is_running():
+                raise RuntimeError(
+                    "QueryMicrobatcher is in use on another running event loop"
+                )
+            self._queue = asyncio.Queue()
+            self._batch = []
+            self._runner = loop.create_task(self._run())
+            self._loop = loop
+        future = loop.create_future()
+        await self._queue.put((text, task or self.task, future))
+        return await future
+
+    async def close(self) -> None:
+        """
+        Stop the batching task; queries still waiting, including the batch
+        being encoded, get CancelledError. encode() raises afterwards.
+        """
+        self._closed = True
+        if self._runner is not None and self._loop is asyncio.get_running_loop():
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+        self._runner = None
+        for _, _, future in self._batch:
+            future.cancel()
+        self._batch = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, future = self._queue.get_nowait()
+                future.cancel()
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> QueryMicrobatcher:
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.n_queries / self.n_batches if self.n_batches else 0.0
+
+    # ------------------------------------------------------------------
+    # Batching loop
+    # ------------------------------------------------------------------
+
+    async def _collect(self) -> List[Tuple[str, str | None, asyncio.Future]]:
+        """Wait for one query, then take more until the window or batch is full."""
+        loop = asyncio.get_running_loop()
+        batch = self._batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+
+            # One forward pass per distinct task in the batch.
+            by_task: Dict[str | None, List[Tuple[str, asyncio.Future]]] = {}
+            for text, task, future in batch:
+                if not future.cancelled():
+                    by_task.setdefault(task, []).append((text, future))
+
+            for task, items in by_task.items():
+                texts = [text for text, _ in items]
+                args = (texts, True) if task is None else (texts, True, task)
+                try:
+                    vecs = await loop.run_in_executor(
+                        self._executor, self.embedder.encode, *args,
+                    )
+                except Exception as e:
+                    for _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for row, (_, future) in zip(vecs, items):
+                    if not future.done():
+                        future.set_result(row)
+                self.n_batches += 1
+                self.n_queries += len(items)
+            self._batch = []
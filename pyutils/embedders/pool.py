@@ -0,0 +1,368 @@
+"""
+pool.py — multi-process encoding with one QwenEmbedder per worker.
+
+On a many-core CPU a single model process stops scaling long before the
+machine is busy: torch's intra-op threading plateaus at a handful of cores.
+EmbedderPool starts N worker processes instead, each holding its own model
+with a fixed thread count, and splits every call across them.
+
+    parent ── tasks ──▶ worker 0 (QwenEmbedder, k threads)
+           ── tasks ──▶ worker 1 (QwenEmbedder, k threads)
+           ◀─ results ─ ...        arrays via shared memory
+
+Inputs are sharded by length so workers finish together; results come back
+in input order. Returned float32 arrays travel through
+multiprocessing.shared_memory — only a block name and shape are pickled.
+A worker process that dies (OOM killer, crash) fails the call waiting on
+it, and the pool closes.
+
+The pool exposes the embedder API (dim, encode, encode_document,
+encode_documents), so it can be handed to RAGPipeline as its embedder.
+
+Requirements:
+    pip install transformers>=4.51.0 torch numpy
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .embedder import EMBEDDING_DIM
+
+logger = logging.getLogger(__name__)
+
+_POLL_S = 1.0                            # how often a waiting call checks for dead workers
+
+
+# ---------------------------------------------------------------------------
+# Shared-memory transport
+# ---------------------------------------------------------------------------
+
+def _to_shared(array: np.ndarray) -> Tuple[str | None, tuple]:
+    """Copy `array` into a new shared-memory block; return (name, shape)."""
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    if array.size == 0:
+        return None, array.shape
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=np.float32, buffer=shm.buf)[:] = array
+    # The parent unlinks the block once it has copied it out; stop this
+    # process's tracker from also "cleaning up" (and warning) at exit.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, array.shape
+
+
+def _from_shared(name: str | None, shape: tuple) -> np.ndarray:
+    """Copy a block written by `_to_shared` into a private array and free it."""
+    if name is None:
+        return np.zeros(shape, dtype=np.float32)
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.array(np.ndarray(shape, dtype=np.float32, buffer=shm.buf))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+
+def _worker_main(
+    worker_id: int,
+    embedder_kwargs: Dict,
+    n_threads: int,
+    tasks: mp.Queue,
+    results: mp.Queue,
+) -> None:
+    import torch
+
+    torch.set_num_threads(n_threads)
+    from .embedder import QwenEmbedder
+
+    embedder = QwenEmbedder(device="cpu", **embedder_kwargs)
+
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        job_id, method, args = job
+        try:
+            if method == "warmup":
+                embedder.warmup()
+                payload = None
+            elif method == "encode":
+                payload = _to_shared(embedder.encode(*args))
+            else:  # "encode_documents"
+                docs = embedder.encode_documents(*args)
+                lengths = [len(texts) for texts, _ in docs]
+                stacked = (
+                    np.vstack([vecs for _, vecs in docs])
+                    if docs else np.zeros((0, embedder.dim), dtype=np.float32)
+                )
+                payload = ([texts for texts, _ in docs], lengths, _to_shared(stacked))
+            results.put((job_id, worker_id, True, payload))
+        except Exception:
+            results.put((job_id, worker_id, False, traceback.format_exc()))
+
+
+# ---------------------------------------------------------------------------
+# Sharding
+# ---------------------------------------------------------------------------
+
+def _shard(lengths: List[int], n_shards: int) -> List[List[int]]:
+    """
+    Split indices into up to `n_shards` groups of similar total length.
+
+    Longest-first greedy assignment to the currently lightest shard. Each
+    group keeps its indices in ascending order; empty groups are dropped.
+    """
+    shards: List[List[int]] = [[] for _ in range(n_shards)]
+    loads = [0] * n_shards
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(i)
+        loads[lightest] += lengths[i] + 1
+    return [sorted(s) for s in shards if s]
+
+
+# ---------------------------------------------------------------------------
+# Pool
+# ---------------------------------------------------------------------------
+
+class EmbedderPool:
+    """
+    N worker processes, each with its own QwenEmbedder, behind one API.
+
+    Usage:
+        with EmbedderPool(n_workers=8, threads_per_worker=8) as pool:
+            vecs = pool.encode(texts)
+            rag = RAGPipeline(embedder=pool)
+            rag.index(documents)
+
+    Args:
+        n_workers:          worker processes
+        threads_per_worker: torch intra-op threads per worker; None →
+                            cpu_count // n_workers
+        **embedder_kwargs:  forwarded to QwenEmbedder in every worker
+                            (batch_size, model_id, output_dim, backend, ...).
+                            Workers always run on CPU.
+    """
+
+    def __init__(
+        self,
+        n_workers: int = 4,
+        threads_per_worker: int | None = None,
+        **embedder_kwargs,
+    ) -> None:
+        if "cache" in embedder_kwargs:
+            raise ValueError(
+                "EmbedderPool does not take a cache: an EmbeddingCache directory "
+                "supports one writing process"
+            )
+        embedder_kwargs.pop("device", None)
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker or max(
+            1, (os.cpu_count() or 1) // n_workers,
+        )
+        self.output_dim = embedder_kwargs.get("output_dim", EMBEDDING_DIM)
+
+        ctx = mp.get_context("spawn")      # fork + torch threads is unsafe
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for _ in range(n_workers)]
+        self._workers = [
+            ctx.Process(
+                target=_worker_main,
+                args=(i, embedder_kwargs, self.threads_per_worker, q, self._results),
+                daemon=True,
+            )
+            for i, q in enumerate(self._tasks)
+        ]
+        for w in self._workers:
+            w.start()
+
+        self._job_ids = itertools.count()
+        self._next_worker = itertools.cycle(range(n_workers))
+        self._lock = threading.Lock()        # one call in flight at a time
+        logger.info(
+            "EmbedderPool started — %d workers × %d threads",
+            n_workers, self.threads_per_worker,
+        )
+
+    @property
+    def dim(self) -> int:
+        return self.output_dim
+
+    # ------------------------------------------------------------------
+    # Dispatch
+    # ------------------------------------------------------------------
+
+    def _run(self, jobs: List[Tuple[int, str, tuple]]) -> List:
+        """Send (worker, method, args) jobs; return payloads in job order."""
+        if self._workers is None:
+            raise RuntimeError("EmbedderPool is closed")
+        with self._lock:
+            ids = []
+            for worker, method, args in jobs:
+                job_id = next(self._job_ids)
+                ids.append(job_id)
+                self._tasks[worker].put((job_id, method, args))
+
+            waiting: Dict[int, int] = {}
+            for worker, _, _ in jobs:
+                waiting[worker] = waiting.get(worker, 0) + 1
+            done: Dict[int, object] = {}
+            errors: List[str] = []
+            while len(done) + len(errors) < len(ids):
+                try:
+                    job_id, worker, ok, payload = self._next_result(waiting)
+                except RuntimeError:
+                    for payload in done.values():
+                        _free_payload(payload)
+                    raise
+                waiting[worker] -= 1
+                if ok:
+                    done[job_id] = payload
+                else:
+                    errors.append(f"worker {worker}:\n{payload}")
+
+            if errors:
+                for payload in done.values():          # free what did arrive
+                    _free_payload(payload)
+                raise RuntimeError("EmbedderPool job failed in " + errors[0])
+            return [done[i] for i in ids]
+
+    def _next_result(self, waiting: Dict[int, int]) -> Tuple:
+        """
+        Next message on the results queue. While none arrives, check that
+        the workers still owing results (`waiting`: worker → count) are
+        alive; if one died, close the pool, free any results that come in
+        late and raise.
+        """
+        while True:
+            try:
+                return self._results.get(timeout=_POLL_S)
+            except queue.Empty:
+                for worker, n in waiting.items():
+                    if n and not self._workers[worker].is_alive():
+                        code = self._workers[worker].exitcode
+                        self.close()
+                        while True:
+                            try:
+                                _, _, ok, payload = self._results.get_nowait()
+                            except queue.Empty:
+                                break
+                            if ok:
+                                _free_payload(payload)
+                        raise RuntimeError(
+                            f"EmbedderPool worker {worker} died (exit code {code}); "
+                            "the pool is closed"
+                        )
+
+    # ------------------------------------------------------------------
+    # Embedder API
+    # ------------------------------------------------------------------
+
+    def warmup(self) -> None:
+        """Load the model in every worker now."""
+        self._run([(w, "warmup", ()) for w in range(self.n_workers)])
+
+    def encode(
+        self,
+        texts: str | List[str],
+        is_query: bool = False,
+        task: str = "Given a web search query, retrieve relevant passages that answer the query",
+    ) -> np.ndarray:
+        """QwenEmbedder.encode, sharded across workers. (N, dim) in input order."""
+        if isinstance(texts, str):
+            texts = [texts]
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        shards = _shard([len(t) for t in texts], self.n_workers)
+        payloads = self._run([
+            (w, "encode", ([texts[i] for i in shard], is_query, task))
+            for w, shard in enumerate(shards)
+        ])
+        for shard, payload in zip(shards, payloads):
+            out[shard] = _from_shared(*payload)
+        return out
+
+    def encode_documents(
+        self,
+        texts: List[str],
+        chunk_tokens: int = 512,
+    ) -> List[tuple[List[str], np.ndarray]]:
+        """QwenEmbedder.encode_documents, documents sharded across workers."""
+        results: List[tuple[List[str], np.ndarray] | None] = [None] * len(texts)
+        shards = _shard([len(t) for t in texts], self.n_workers)
+        payloads = self._run([
+            (w, "encode_documents", ([texts[i] for i in shard], chunk_tokens))
+            for w, shard in enumerate(shards)
+        ])
+        for shard, (chunk_texts, lengths, block) in zip(shards, payloads):
+            stacked = _from_shared(*block)
+            offsets = np.cumsum([0] + lengths)
+            for j, i in enumerate(shard):
+                results[i] = chunk_texts[j], stacked[offsets[j] : offsets[j + 1]]
+        return results
+
+    def encode_document(
+        self,
+        text: str,
+        chunk_tokens: int = 512,
+    ) -> tuple[List[str], np.ndarray]:
+        """
+        Late chunking for one document on the next worker in turn.
+
+        Unlike QwenEmbedder.encode_document, documents past 32k tokens are
+        windowed rather than truncated (see QwenEmbedder.encode_documents).
+        """
+        (chunk_texts, _, block), = self._run(
+            [(next(self._next_worker), "encode_documents", ([text], chunk_tokens))]
+        )
+        return chunk_texts[0], _from_shared(*block)
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def close(self) -> None:
+        """Stop the workers. Idempotent."""
+        if self._workers is None:
+            return
+        for q in self._tasks:
+            q.put(None)
+        for w in self._workers:
+            w.join(timeout=30)
+            if w.is_alive():
+                w.terminate()
+        self._workers = None
+
+    def __enter__(self) -> EmbedderPool:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _free_payload(payload) -> None:
+    """Unlink any shared-memory block referenced by a job payload."""
+    if isinstance(payload, tuple) and len(payload) == 3:      # encode_documents
+        payload = payload[2]
+    if isinstance(payload, tuple) and len(payload) == 2 and payload[0]:
+        _from_shared(*payload)
@@ -3,6 +3,7 @@ rag.py — RAG pipeline with FAISS retrieval and late chunking.
 
 Components:
     Chunk        — a piece of text with its source metadata
+    ChunkTable   — array-backed storage for many Chunks
     FAISSStore   — cosine search over L2-normed vectors; exact ("flat") by
                    default, with opt-in approximate indexes (ivf, hnsw, ivfpq)
     RAGPipeline  — index documents (late chunking) → query → return top-k
@@ -11,7 +12,7 @@ Requirements:
     pip install transformers>=4.51.0 torch numpy faiss-cpu
 
 Quick-start:
-    from rag import RAGPipeline
+    from pyutils.embedders import RAGPipeline
 
     rag = RAGPipeline()
     rag.index(["Your long document...", "Another document..."])
@@ -22,14 +23,29 @@ Quick-start:
 
 from __future__ import annotations
 
+import asyncio
+import heapq
+import json
 import logging
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
 
 import faiss
 import numpy as np
 
-from embedder import QwenEmbedder
+from .embedder import QwenEmbedder
+from .microbatch import QueryMicrobatcher
+from .dedup import ChunkDeduplicator, text_hash
+from .sparse import BM25Index
 
 logger = logging.getLogger(__name__)
 
@@ -46,10 +62,417 @@ class Chunk:
     metadata: Dict = field(default_factory=dict)
 
 
+class ChunkTable:
+    """
+    Columnar storage for Chunk records.
+
+    A list of Chunk objects costs a few hundred bytes of object overhead per
+    chunk on top of the text itself — gigabytes at tens of millions of
+    chunks. The table keeps the same information in a handful of arrays:
+
+        texts      one UTF-8 byte blob, plus int64 end offsets
+        doc_ids    distinct doc_ids, stored once; int32 position per chunk
+        metadata   distinct metadata dicts, stored once; int32 position per
+                   chunk. Chunks of a document normally share one dict, so
+                   each document's metadata is held once.
+        chunk_idx  int32 per chunk
+        ids        int64 per chunk, strictly increasing — the ids FAISSStore
+                   files vectors under
+        live       one byte per chunk; 0 once the chunk is deleted
+
+    Rows are addressed by position. `table[i]` rebuilds a Chunk on demand;
+    the field accessors avoid even that. Metadata dicts are shared between
+    the rows that use them — treat them as read-only.
+
+    `select(where)` answers metadata filters from an inverted index of
+    (field, value) → metadata-table positions, so only the distinct dicts
+    are inspected, never the rows.
+
+    Deleting only clears `live`; `compact()` drops dead rows for good. Ids
+    never change, so after compaction row and id differ and `rows()`
+    translates between them. Each doc_id keeps the [start, end) id runs of
+    its live chunks, so a document's chunks are found without a scan.
+    """
+
+    def __init__(self) -> None:
+        self._blob = bytearray()
+        self._ends = array("q")              # text i = blob[ends[i-1]:ends[i]]
+        self._doc = array("i")
+        self._meta = array("i")
+        self._chunk_idx = array("i")
+        self._ids = array("q")
+        self._live = bytearray()
+        self.n_live = 0
+        self._runs: Dict[int, List[List[int]]] = {}   # doc position → id runs
+        self._doc_ids: List[str] = []
+        self._doc_pos: Dict[str, int] = {}
+        self._metas: List[Dict] = []
+        self._meta_pos: Dict[str, int] = {}
+        self._postings: Dict[Tuple[str, str], List[int]] = {}  # (field, value) → meta positions
+        self._last_meta: Tuple[Dict | None, int] = (None, -1)
+
+    def __len__(self) -> int:
+        return len(self._chunk_idx)
+
+    def append(self, chunks: List[Chunk], ids: Sequence[int] | None = None) -> None:
+        """
+        Add rows for `chunks`.
+
+        Args:
+            ids: one id per chunk, increasing and above every stored id;
+                 None → continue from the last stored id
+        """
+        first = self._ids[-1] + 1 if self._ids else 0
+        ids = range(first, first + len(chunks)) if ids is None else [int(i) for i in ids]
+        if len(ids) != len(chunks):
+            raise ValueError(f"{len(ids)} ids for {len(chunks)} chunks")
+        if ids and (ids[0] < first or any(b <= a for a, b in zip(ids, ids[1:]))):
+            raise ValueError("ids must increase and exceed every stored id")
+
+        for c, id_ in zip(chunks, ids):
+            self._blob += c.text.encode("utf-8")
+            self._ends.append(len(self._blob))
+            pos = self._doc_pos.get(c.doc_id)
+            if pos is None:
+                pos = self._doc_pos[c.doc_id] = len(self._doc_ids)
+                self._doc_ids.append(c.doc_id)
+            self._doc.append(pos)
+            self._meta.append(self._meta_position(c.metadata))
+            self._chunk_idx.append(c.chunk_idx)
+            runs = self._runs.setdefault(pos, [])
+            if runs and runs[-1][1] == id_:
+                runs[-1][1] = id_ + 1
+            else:
+                runs.append([id_, id_ + 1])
+        self._ids.extend(ids)
+        self._live.extend(b"\x01" * len(chunks))
+        self.n_live += len(chunks)
+
+    def _meta_position(self, meta: Dict) -> int:
+        """Table position for `meta`, adding it if no equal dict is stored."""
+        last, pos = self._last_meta
+        if meta is last:                     # next chunk of the same document
+            return pos
+        try:
+            key = json.dumps(meta, sort_keys=True, ensure_ascii=False)
+        except TypeError:                    # not JSON: keep it, undeduplicated
+            key = None
+        pos = self._meta_pos.get(key) if key is not None else None
+        if pos is None:
+            pos = len(self._metas)
+            self._metas.append(meta)
+            self._post(meta, pos)
+            if key is not None:
+                self._meta_pos[key] = pos
+        self._last_meta = (meta, pos)
+        return pos
+
+    @staticmethod
+    def _value_key(value) -> str | None:
+        try:
+            return json.dumps(value, sort_keys=True, ensure_ascii=False)
+        except TypeError:
+            return None
+
+    def _post(self, meta: Dict, pos: int) -> None:
+        """Add metadata dict `pos` to the postings; list values post each element."""
+        for field_name, value in meta.items():
+            for v in value if isinstance(value, list) else [value]:
+                key = self._value_key(v)
+                if key is not None:
+                    self._postings.setdefault((field_name, key), []).append(pos)
+
+    def select(self, where: Dict) -> np.ndarray:
+        """
+        Ids of the live chunks matching every field of `where`.
+
+        Each value in `where` is a single value or a list/tuple/set of
+        alternatives. A metadata field holding a list matches when any of its
+        elements does. The key "doc_id" filters on the chunk's doc_id rather
+        than its metadata.
+        """
+        mask = np.frombuffer(self._live, dtype=np.uint8).astype(bool)
+        for field_name, wanted in where.items():
+            options = wanted if isinstance(wanted, (list, tuple, set, frozenset)) else [wanted]
+            if field_name == "doc_id":
+                ids = [self.doc_ids_of(d) for d in options]
+                hit = np.zeros(len(self), dtype=bool)
+                hit[self.rows(np.concatenate([np.zeros(0, np.int64), *ids]))] = True
+            else:
+                metas = {
+                    pos
+                    for v in options
+                    for pos in self._postings.get((field_name, self._value_key(v)), ())
+                }
+                hit = np.isin(np.frombuffer(self._meta, dtype=np.int32), list(metas))
+            mask &= hit
+        return np.frombuffer(self._ids, dtype=np.int64)[mask]
+
+    # ------------------------------------------------------------------
+    # Ids, deletion and compaction
+    # ------------------------------------------------------------------
+
+    def rows(self, ids: np.ndarray) -> np.ndarray:
+        """Row positions of stored `ids` (any shape). Unknown ids map anywhere."""
+        return np.searchsorted(np.frombuffer(self._ids, dtype=np.int64), ids)
+
+    def ids(self) -> np.ndarray:
+        """Copy of the id column."""
+        return np.frombuffer(self._ids, dtype=np.int64).copy()
+
+    def is_live(self, rows: np.ndarray) -> np.ndarray:
+        return np.frombuffer(self._live, dtype=np.uint8)[rows].astype(bool)
+
+    def doc_ids_of(self, doc_id: str) -> np.ndarray:
+        """Ids of the live chunks of `doc_id` (empty if none)."""
+        runs = self._runs.get(self._doc_pos.get(doc_id, -1), [])
+        if not runs:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(a, b, dtype=np.int64) for a, b in runs])
+
+    def delete_doc(self, doc_id: str) -> np.ndarray:
+        """Mark every live chunk of `doc_id` deleted; return their ids."""
+        ids = self.doc_ids_of(doc_id)
+        if len(ids):
+            del self._runs[self._doc_pos[doc_id]]
+            np.frombuffer(self._live, dtype=np.uint8)[self.rows(ids)] = 0
+            self.n_live -= len(ids)
+        return ids
+
+    def compact(self) -> None:
+        """Drop deleted rows, reclaiming their text. Ids are unchanged."""
+        if self.n_live == len(self):
+            return
+        keep = np.frombuffer(self._live, dtype=np.uint8).astype(bool)
+        lengths = np.diff(np.frombuffer(self._ends, dtype=np.int64), prepend=0)
+        blob = np.frombuffer(self._blob, dtype=np.uint8)[np.repeat(keep, lengths)]
+
+        self._blob = bytearray(blob.tobytes())
+        self._ends = array("q", np.cumsum(lengths[keep], dtype=np.int64).tobytes())
+        self._ids = array("q", np.frombuffer(self._ids, dtype=np.int64)[keep].tobytes())
+        for name in ("_doc", "_meta", "_chunk_idx"):
+            column = np.frombuffer(getattr(self, name), dtype=np.int32)[keep]
+            setattr(self, name, array("i", column.tobytes()))
+        self._live = bytearray(b"\x01" * self.n_live)
+
+    # ------------------------------------------------------------------
+    # Row access
+    # ------------------------------------------------------------------
+
+    def text(self, i: int) -> str:
+        start = self._ends[i - 1] if i else 0
+        return self._blob[start : self._ends[i]].decode("utf-8")
+
+    def doc_id(self, i: int) -> str:
+        return self._doc_ids[self._doc[i]]
+
+    def id(self, i: int) -> int:
+        return self._ids[i]
+
+    def chunk_idx(self, i: int) -> int:
+        return self._chunk_idx[i]
+
+    def metadata(self, i: int) -> Dict:
+        return self._metas[self._meta[i]]
+
+    def __getitem__(self, i: int) -> Chunk:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return Chunk(self.text(i), self.doc_id(i), self.chunk_idx(i), self.metadata(i))
+
+    def nbytes(self) -> int:
+        """Approximate memory held, excluding the doc_id and metadata tables."""
+        columns = (self._ends, self._doc, self._meta, self._chunk_idx, self._ids)
+        return len(self._blob) + len(self._live) + sum(a.itemsize * len(a) for a in columns)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """
+        Write the table into directory `path`: texts.bin, one .npy per
+        column and tables.json (doc_ids and metadata dicts). Dead rows are
+        written too; `compact()` first to leave them out.
+        """
+        tmp = os.path.join(path, "texts.bin.tmp")
+        with open(tmp, "wb") as f:
+            f.write(self._blob)
+        os.replace(tmp, os.path.join(path, "texts.bin"))
+
+        ends = np.frombuffer(self._ends, dtype=np.int64)
+        _write_npy(path, "text_offsets.npy", np.concatenate([[0], ends]))
+        for name, column in (("doc_index", self._doc), ("meta_index", self._meta),
+                             ("chunk_idx", self._chunk_idx)):
+            _write_npy(path, f"{name}.npy", np.frombuffer(column, dtype=np.int32))
+        _write_npy(path, "ids.npy", np.frombuffer(self._ids, dtype=np.int64))
+        _write_npy(path, "live.npy", np.frombuffer(self._live, dtype=np.uint8))
+        _write_json(path, "tables.json", {
+            "doc_ids": self._doc_ids,
+            "metadata": self._metas,
+        })
+
+    @classmethod
+    def load(cls, path: str) -> ChunkTable:
+        """Read a table written by `save()`."""
+        table = cls()
+        with open(os.path.join(path, "tables.json"), encoding="utf-8") as f:
+            tables = json.load(f)
+        with open(os.path.join(path, "texts.bin"), "rb") as f:
+            table._blob = bytearray(f.read())
+
+        def column(name: str, code: str) -> array:
+            values = np.load(os.path.join(path, f"{name}.npy"))
+            return array(code, values.astype(np.int64 if code == "q" else np.int32).tobytes())
+
+        table._ends = column("text_offsets", "q")[1:]
+        table._doc = column("doc_index", "i")
+        table._meta = column("meta_index", "i")
+        table._chunk_idx = column("chunk_idx", "i")
+        table._ids = column("ids", "q")
+        table._live = bytearray(np.load(os.path.join(path, "live.npy")).tobytes())
+        table.n_live = table._live.count(1)
+        table._doc_ids = tables["doc_ids"]
+        table._doc_pos = {d: i for i, d in enumerate(table._doc_ids)}
+        table._metas = tables["metadata"]
+        table._meta_pos = {
+            json.dumps(m, sort_keys=True, ensure_ascii=False): i
+            for i, m in enumerate(table._metas)
+        }
+        for i, m in enumerate(table._metas):
+            table._post(m, i)
+
+        # Id runs per document: break wherever the doc changes or ids jump.
+        live = np.frombuffer(table._live, dtype=np.uint8).astype(bool)
+        docs = np.frombuffer(table._doc, dtype=np.int32)[live]
+        ids = np.frombuffer(table._ids, dtype=np.int64)[live]
+        if len(ids):
+            breaks = np.flatnonzero((np.diff(docs) != 0) | (np.diff(ids) != 1)) + 1
+            starts = np.concatenate([[0], breaks]).tolist()
+            ends = np.concatenate([breaks, [len(ids)]]).tolist()
+            for a, b in zip(starts, ends):
+                table._runs.setdefault(int(docs[a]), []).append(
+                    [int(ids[a]), int(ids[b - 1]) + 1]
+                )
+        return table
+
+
 # ---------------------------------------------------------------------------
 # FAISS Store
 # ---------------------------------------------------------------------------
 
+class _RWLock:
+    """
+    Many readers or one writer. A waiting writer holds back new readers, so
+    a steady stream of searches cannot starve adds. Not reentrant.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+_RESCORE_QTYPES = {
+    "sq8": faiss.ScalarQuantizer.QT_8bit,
+    "sq4": faiss.ScalarQuantizer.QT_4bit,
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+}
+
+
+class _BinaryIndex:
+    """
+    Sign-bit codes searched by Hamming distance, re-scored by cosine.
+
+    Pairs an IndexBinaryIDMap2 (candidate generation) with an IndexIDMap2
+    over scalar-quantised vectors (re-scoring, reconstruction), and exposes
+    the slice of the faiss.Index API FAISSStore uses.
+    """
+
+    def __init__(self, codes, vectors, oversample: int = 10) -> None:
+        self.codes = codes
+        self.vectors = vectors
+        self.oversample = oversample
+
+    @property
+    def ntotal(self) -> int:
+        return self.codes.ntotal
+
+    @property
+    def is_trained(self) -> bool:
+        return self.vectors.is_trained
+
+    @property
+    def hnsw(self):
+        return faiss.downcast_IndexBinary(self.codes.index).hnsw
+
+    def train(self, x: np.ndarray) -> None:
+        self.vectors.train(x)
+
+    def add_with_ids(self, x: np.ndarray, ids: np.ndarray) -> None:
+        self.codes.add_with_ids(np.packbits(x > 0, axis=1), ids)
+        self.vectors.add_with_ids(x, ids)
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        self.vectors.remove_ids(ids)
+        return self.codes.remove_ids(ids)
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        return self.vectors.reconstruct_batch(ids)
+
+    def search(self, x: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k by cosine among the oversample × k nearest codes; ids -1 past the end."""
+        n_candidates = min(self.ntotal, k * self.oversample)
+        _, candidates = self.codes.search(np.packbits(x > 0, axis=1), n_candidates, params=params)
+        scores = np.full((len(x), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(x), k), -1, dtype=np.int64)
+        for i, (query, row) in enumerate(zip(x, candidates)):
+            row = row[row >= 0]
+            if not len(row):
+                continue
+            cosine = self.vectors.reconstruct_batch(row) @ query
+            top = np.argsort(-cosine, kind="stable")[:k]
+            scores[i, : len(top)] = cosine[top]
+            ids[i, : len(top)] = row[top]
+        return scores, ids
+
+    def nbytes(self) -> int:
+        """Serialised size of both halves."""
+        return (len(faiss.serialize_index_binary(self.codes))
+                + len(faiss.serialize_index(self.vectors)))
+
+
 class FAISSStore:
     """
     Vector store backed by FAISS, with a choice of index.
@@ -79,19 +502,110 @@ class FAISSStore:
                  storing it in full. Drastically less memory for very large
                  corpora; compression is lossy, so it is the least accurate.
 
+        "sq8"    Exact scan over 8-bit scalar-quantised vectors: one byte per
+                 dimension instead of four, so 4x less memory than "flat",
+                 at a small loss in score precision. Needs training (the
+                 per-dimension value ranges).
+
+        "binary" Sign bits: each vector kept as `dim` bits and searched by
+                 Hamming distance (32x smaller than "flat", and fast). The top
+                 `binary_oversample` × k candidates are then re-scored by
+                 cosine against a `binary_rescore` copy ("sq8", "sq4" or
+                 "fp16"), so scores stay cosine. dim must be a multiple of 8.
+
+        "binary_hnsw"
+                 "binary" with an HNSW graph over the bit codes instead of a
+                 full Hamming scan (tombstones deletions, like "hnsw").
+
+        "auto"   Picks one of the above from the number of vectors and
+                 `memory_budget`: "flat" up to 50k vectors, "hnsw" up to 2M,
+                 "ivf" beyond — each only if its estimated size fits the
+                 budget, otherwise the next smaller type, down to "ivfpq".
+                 `index_type` then reports the type in use. As the store
+                 grows past a threshold, or (for "ivf") past 4× the vectors
+                 its nlist was sized for, it rebuilds in the background.
+
     Build model:
         Vectors are buffered as they are added, and the index is built once,
         lazily, on the first search (or via an explicit `build()`). This is
-        what lets "ivf"/"ivfpq" train on the whole corpus at once. After
-        building, the buffer is freed and further `add()`s go into the live
-        index.
-
-    Index/metadata alignment:
-        Vectors and their Chunk records are appended in lockstep, and FAISS
-        assigns sequential ids, so index position i always maps to chunk i.
+        what lets "ivf"/"ivfpq" train on a sample drawn from the whole
+        corpus (`train_per_list` vectors per cluster, fixed seed, so builds
+        are reproducible). Vectors then go in `_BLOCK` at a time, straight
+        from the buffer. After building, the buffer is freed and further
+        `add()`s go into the live index. For corpora too large to buffer,
+        `train(sample, n_total)` creates the index up front from a sample,
+        and every `add()` after it goes straight in (see
+        RAGPipeline.index_stream).
+
+    Ids and deletion:
+        Every chunk gets a 64-bit id, handed out in increasing order and
+        never reused; its vector is filed under that id in FAISS ("flat" and
+        "hnsw" through IndexIDMap2, the IVF types natively), and its record
+        in a ChunkTable. `delete(doc_id)` removes a document's vectors at
+        once where the index supports removal. An HNSW graph cannot drop
+        nodes, so there deleted vectors stay as tombstones: searches fetch
+        extra candidates and skip them until `compact()` rebuilds the graph.
+        `upsert()` is delete + add.
+
+    Background rebuild:
+        `rebuild()` (called automatically in "auto" mode) builds a new index
+        in a worker thread, reading vectors back out of the live index in
+        blocks. Searches keep using the old index meanwhile; adds and
+        deletes go to it as usual and are replayed onto the new one, which
+        is then swapped in atomically. Rebuilding from "ivfpq" re-encodes
+        decoded (approximate) vectors, so "auto" never leaves it.
+
+    Thread safety:
+        Searches may run concurrently with each other; add/delete/upsert
+        take an exclusive lock for the (short) time they touch the index.
+
+    Filtered search:
+        `search(..., filter={"lang": "en", "year": [2023, 2024]})` only
+        returns chunks whose metadata matches (see ChunkTable.select). The
+        eligible ids are resolved first, from an inverted index, and passed
+        to FAISS as an id selector, so ineligible vectors are never scored.
+        When few enough chunks qualify (≤ `filter_scan_max`), their vectors
+        are scored directly instead — exact, and faster than walking the
+        index for a handful of hits.
+
+    Keyword search:
+        With `sparse=True` the store also keeps a BM25Index over chunk
+        texts, updated by the same add/delete/compact calls, and
+        `search_text()` ranks chunks by the query's terms rather than its
+        meaning. RAGPipeline uses it for `mode="sparse"` and `"hybrid"`.
+
+    Deduplication:
+        With `dedup=True`, add() indexes a chunk only if no stored chunk has
+        the same normalised text and none is at least `dedup_threshold`
+        cosine-similar to it (one top-1 search per `_DEDUP_BATCH` chunks,
+        plus a check within the batch). Each duplicate is recorded as a
+        reference to the chunk it copies, and add() returns that chunk's id
+        for it. Results list the references under "duplicates"; filters
+        see only the indexed chunk's own doc_id and metadata. The cosine
+        test needs a searchable index: before an "ivf"/"ivfpq"/"auto" store
+        is trained, only exact copies and copies within one batch are
+        caught. See dedup.py; `dedup_stats()` reports the savings.
+
+    Persistence:
+        `save(path)` writes a directory holding the FAISS index and a
+        columnar copy of the chunk records; `FAISSStore.load(path)` reads it
+        back. With `mmap=True` the index is memory-mapped rather than read
+        into RAM, so worker processes loading the same directory share one
+        copy through the page cache. Chunk metadata must be JSON-serialisable.
     """
 
-    _VALID_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+    _VALID_TYPES = ("flat", "ivf", "hnsw", "ivfpq", "sq8", "binary", "binary_hnsw")
+    _TOMBSTONE_TYPES = ("hnsw", "binary_hnsw")      # no efficient remove_ids
+    _TRAINED_TYPES = ("ivf", "ivfpq", "sq8", "binary", "binary_hnsw")
+    _BINARY_TYPES = ("binary", "binary_hnsw")
+    _SQ_TRAIN_MAX = 65_536                 # scalar-quantiser ranges settle fast
+    _DEDUP_BATCH = 1024                    # chunks per dedup search
+
+    # "auto" thresholds (vectors) and the order types are upgraded in.
+    AUTO_FLAT_MAX = 50_000
+    AUTO_HNSW_MAX = 2_000_000
+    _AUTO_ORDER = ("flat", "hnsw", "ivf", "ivfpq")
+    _BLOCK = 65_536                        # vectors per add_with_ids / lock hold
 
     def __init__(
         self,
@@ -105,11 +619,22 @@ class FAISSStore:
         hnsw_ef_search: int = 64,
         pq_m: int = 64,
         pq_nbits: int = 8,
+        filter_scan_max: int = 20_000,
+        memory_budget: int | None = None,
+        train_per_list: int = 256,
+        n_threads: int | None = None,
+        sparse: bool = False,
+        binary_oversample: int = 10,
+        binary_rescore: str = "sq8",
+        dedup: bool = False,
+        dedup_threshold: float | None = 0.97,
     ) -> None:
         """
         Args:
-            dim:        embedding dimension (1024 for Qwen3-Embedding-0.6B)
-            index_type: "flat" | "ivf" | "hnsw" | "ivfpq"
+            dim:        embedding dimension (1024 for Qwen3-Embedding-0.6B, or
+                        the embedder's MRL `output_dim`)
+            index_type: "flat" | "ivf" | "hnsw" | "ivfpq" | "sq8" | "binary" |
+                        "binary_hnsw" | "auto"
 
           IVF / IVFPQ:
             nlist:      number of clusters; None → auto ≈ sqrt(N) at build time
@@ -119,20 +644,61 @@ class FAISSStore:
             pq_m:       sub-vectors per vector; must divide `dim`
             pq_nbits:   bits per sub-vector code (8 is standard)
 
+          SQ8:
+            (no parameters; trains its value ranges on a capped sample)
+
+          Binary / binary HNSW:
+            binary_oversample: re-score depth: Hamming candidates fetched and
+                               re-scored by cosine per requested result
+            binary_rescore:    precision of the re-scoring copy: "sq8"
+                               (1 byte/dim), "sq4" (½ byte/dim) or "fp16"
+            ("binary_hnsw" also takes the HNSW parameters below)
+
           HNSW:
             hnsw_m:               graph neighbours per node (recall ↔ memory)
             hnsw_ef_construction: build-time search depth (index quality)
             hnsw_ef_search:       query-time search depth (recall ↔ speed)
+
+          Filtered search:
+            filter_scan_max: score a filter's matches by direct scan when
+                             there are at most this many
+
+          Auto:
+            memory_budget:   bytes the index may use; None → unlimited
+
+          Build:
+            train_per_list:  IVF k-means trains on at most this many vectors
+                             per cluster (a fixed-seed sample of the corpus)
+            n_threads:       OpenMP threads FAISS uses to train and add;
+                             None → FAISS's default (all cores)
+
+          Keyword search:
+            sparse:          also keep a BM25 index over chunk texts
+
+          Deduplication:
+            dedup:           fold duplicate chunks into references at add()
+            dedup_threshold: cosine at or above which a chunk is a near-
+                             duplicate; None → exact (normalised) text only
         """
-        if index_type not in self._VALID_TYPES:
+        if index_type not in self._VALID_TYPES + ("auto",):
             raise ValueError(
-                f"index_type must be one of {list(self._VALID_TYPES)}, got {index_type!r}"
+                f"index_type must be one of {list(self._VALID_TYPES) + ['auto']}, "
+                f"got {index_type!r}"
             )
-        if index_type == "ivfpq" and dim % pq_m != 0:
+        if index_type in ("ivfpq", "auto") and dim % pq_m != 0:
             raise ValueError(f"pq_m={pq_m} must divide dim={dim}")
+        if index_type in self._BINARY_TYPES and dim % 8 != 0:
+            raise ValueError(f"{index_type} needs dim divisible by 8, got {dim}")
+        if binary_rescore not in _RESCORE_QTYPES:
+            raise ValueError(
+                f"binary_rescore must be one of {list(_RESCORE_QTYPES)}, got {binary_rescore!r}"
+            )
+        if dedup_threshold is not None and not -1.0 <= dedup_threshold <= 1.0:
+            raise ValueError(f"dedup_threshold must be a cosine in [-1, 1], got {dedup_threshold}")
 
         self.dim = dim
-        self.index_type = index_type
+        self.auto = index_type == "auto"
+        self.index_type = "flat" if self.auto else index_type
         self.nlist = nlist
         self.nprobe = nprobe
         self.hnsw_m = hnsw_m
@@ -140,28 +706,86 @@ class FAISSStore:
         self.hnsw_ef_search = hnsw_ef_search
         self.pq_m = pq_m
         self.pq_nbits = pq_nbits
-
-        self._chunks: List[Chunk] = []
-        self._pending: List[np.ndarray] = []   # vectors awaiting the first build
+        self.filter_scan_max = filter_scan_max
+        self.memory_budget = memory_budget
+        self.binary_oversample = binary_oversample
+        self.binary_rescore = binary_rescore
+        self.dedup_threshold = dedup_threshold
+        self.train_per_list = train_per_list
+        self.n_threads = n_threads
+
+        self._chunks = ChunkTable()
+        self.sparse = BM25Index() if sparse else None
+        self.dedup = ChunkDeduplicator() if dedup else None
+        self._pending: List[Tuple[np.ndarray, np.ndarray]] = []  # (ids, vectors) awaiting build
         self._index = None                     # faiss.Index, created at build
         self._built = False
+        self._mmapped = False                  # index pages backed by a file
+        self._next_id = 0
+        self._n_tombstones = 0                 # deleted vectors still in the index
+        self._lock = _RWLock()
+        self._rebuild_thread: threading.Thread | None = None
+        self._replay: List[Tuple[str, np.ndarray, np.ndarray | None]] | None = None
 
     # ------------------------------------------------------------------
     # Index construction
     # ------------------------------------------------------------------
 
-    def _make_index(self, n_vectors: int):
-        """Build an empty index of the requested type (inner-product metric)."""
+    @contextmanager
+    def _threads(self):
+        """Run FAISS with `n_threads` OpenMP threads (a per-thread setting)."""
+        if self.n_threads is None:
+            yield
+            return
+        previous = faiss.omp_get_max_threads()
+        faiss.omp_set_num_threads(self.n_threads)
+        try:
+            yield
+        finally:
+            faiss.omp_set_num_threads(previous)
+
+    def _n_train(self, index, n_vectors: int) -> int:
+        """Training-set size for `index`: k-means gains little past ~256/centroid."""
+        if not hasattr(index, "nlist"):        # scalar quantiser: ranges only
+            return min(n_vectors, self._SQ_TRAIN_MAX)
+        return min(n_vectors, self.train_per_list * index.nlist)
+
+    def _make_index(self, n_vectors: int, index_type: str | None = None):
+        """
+        Build an empty index of `index_type` (default: the current type),
+        inner-product metric. Every type returned accepts `add_with_ids`.
+        """
         metric = faiss.METRIC_INNER_PRODUCT
+        index_type = index_type or self.index_type
 
-        if self.index_type == "flat":
-            return faiss.IndexFlatIP(self.dim)
+        if index_type == "flat":
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
 
-        if self.index_type == "hnsw":
+        if index_type == "hnsw":
             index = faiss.IndexHNSWFlat(self.dim, self.hnsw_m, metric)
             index.hnsw.efConstruction = self.hnsw_ef_construction
             index.hnsw.efSearch = self.hnsw_ef_search
-            return index
+            return faiss.IndexIDMap2(index)
+
+        if index_type == "sq8":
+            return faiss.IndexIDMap2(
+                faiss.IndexScalarQuantizer(self.dim, faiss.ScalarQuantizer.QT_8bit, metric)
+            )
+
+        if index_type in self._BINARY_TYPES:
+            if index_type == "binary_hnsw":
+                codes = faiss.IndexBinaryHNSW(self.dim, self.hnsw_m)
+                codes.hnsw.efConstruction = self.hnsw_ef_construction
+                codes.hnsw.efSearch = self.hnsw_ef_search
+            else:
+                codes = faiss.IndexBinaryFlat(self.dim)
+            vectors = faiss.IndexScalarQuantizer(
+                self.dim, _RESCORE_QTYPES[self.binary_rescore], metric,
+            )
+            return _BinaryIndex(
+                faiss.IndexBinaryIDMap2(codes), faiss.IndexIDMap2(vectors),
+                self.binary_oversample,
+            )
 
         # "ivf" and "ivfpq" share a coarse quantiser and an auto-sized nlist.
         nlist = self.nlist or max(1, round(n_vectors ** 0.5))
@@ -170,34 +794,149 @@ class FAISSStore:
             logger.warning(
                 "%s: %d vectors is small for nlist=%d; recall may suffer. "
                 "Consider index_type='flat' for small corpora.",
-                self.index_type, n_vectors, nlist,
+                index_type, n_vectors, nlist,
             )
         quantizer = faiss.IndexFlatIP(self.dim)
 
-        if self.index_type == "ivf":
+        if index_type == "ivf":
             index = faiss.IndexIVFFlat(quantizer, self.dim, nlist, metric)
         else:  # "ivfpq"
             index = faiss.IndexIVFPQ(
                 quantizer, self.dim, nlist, self.pq_m, self.pq_nbits, metric,
             )
         index.nprobe = min(self.nprobe, nlist)
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)   # reconstruct by id
         return index
 
+    def _index_bytes(self, index_type: str, n_vectors: int) -> int:
+        """Rough memory of an `index_type` index over n_vectors, ids included."""
+        per_vector = {
+            "flat": 4 * self.dim + 16,
+            "ivf": 4 * self.dim + 24,
+            "hnsw": 4 * self.dim + 8 * self.hnsw_m + 24,   # level-0 links dominate
+            "ivfpq": self.pq_m * self.pq_nbits // 8 + 24,
+            "sq8": self.dim + 16,
+        }.get(index_type)
+        if per_vector is None:                 # binary: bit codes + rescoring copy
+            rescore = {"sq8": 1.0, "sq4": 0.5, "fp16": 2.0}[self.binary_rescore]
+            per_vector = int(self.dim / 8 + self.dim * rescore) + 32
+            if index_type == "binary_hnsw":
+                per_vector += 8 * self.hnsw_m
+        return per_vector * n_vectors
+
+    def _choose_type(self, n_vectors: int) -> str:
+        """The "auto" choice for n_vectors: see the class docstring."""
+        if n_vectors <= self.AUTO_FLAT_MAX:
+            first = "flat"
+        elif n_vectors <= self.AUTO_HNSW_MAX:
+            first = "hnsw"
+        else:
+            first = "ivf"
+        for index_type in self._AUTO_ORDER[self._AUTO_ORDER.index(first):]:
+            if (self.memory_budget is None
+                    or self._index_bytes(index_type, n_vectors) <= self.memory_budget):
+                return index_type
+        return "ivfpq"
+
+    def _rebuild_target(self) -> str | None:
+        """Type an "auto" store should rebuild into now, or None."""
+        n = self._chunks.n_live
+        target = self._choose_type(n)
+        order = self._AUTO_ORDER
+        if order.index(target) > order.index(self.index_type):
+            return target                      # only ever upgrade: no flapping
+        if self.index_type == "ivf" and self.nlist is None:
+            if n > 4 * self._index.nlist ** 2:  # sized for sqrt(n/4)
+                return "ivf"
+        return None
+
     def build(self) -> None:
         """
         Build the index from all buffered vectors. Idempotent.
 
-        Trains first for "ivf"/"ivfpq" (the others need no training), then adds
-        every buffered vector and releases the buffer. Called lazily by
-        `search()`, or explicitly to control when the one-off training happens.
+        Trains first for the types that need it ("ivf", "ivfpq", "sq8" and
+        the binary ones), then adds every buffered vector and releases the
+        buffer. Called lazily by `search()`, or explicitly to control when
+        the one-off training happens.
         """
+        with self._lock.write():
+            self._build()
+
+    @property
+    def built(self) -> bool:
+        """True once the index exists (adds then go straight into it)."""
+        return self._built
+
+    @property
+    def needs_training(self) -> bool:
+        """True while `train()` needs a sample: unbuilt "auto" or a trained type."""
+        return not self._built and (self.auto or self.index_type in self._TRAINED_TYPES)
+
+    def train(self, sample: np.ndarray | None = None, n_total: int | None = None) -> None:
+        """
+        Create the index now, without buffering the corpus first.
+
+        Args:
+            sample:  (S, dim) L2-normalised vectors representative of the
+                     corpus; required when `needs_training`
+            n_total: expected final number of vectors. Sizes the "auto" type
+                     choice and the automatic nlist; default: the sample
+                     size plus anything already buffered.
+
+        Vectors already buffered by `add()` go into the new index.
+        """
+        with self._lock.write():
+            if self._built:
+                raise RuntimeError("index is already built")
+            n_buffered = sum(len(i) for i, _ in self._pending)
+            n = n_total or n_buffered + (len(sample) if sample is not None else 0)
+            if self.auto:
+                self.index_type = self._choose_type(n)
+            with self._threads():
+                index = self._make_index(max(n, 1))
+                if not index.is_trained:
+                    if sample is None or not len(sample):
+                        raise ValueError(f"{self.index_type} index needs a training sample")
+                    if hasattr(index, "nlist") and len(sample) < 39 * index.nlist:
+                        logger.warning("Training nlist=%d on only %d vectors; "
+                                       "recall may suffer.", index.nlist, len(sample))
+                    rows = _sample_rows(len(sample), self._n_train(index, len(sample)))
+                    index.train(np.ascontiguousarray(sample[rows], dtype=np.float32))
+                for ids, vectors in self._pending:
+                    live = self._chunks.is_live(self._chunks.rows(ids))
+                    index.add_with_ids(vectors[live], ids[live])
+            self._index = index
+            self._pending = []
+            self._built = True
+        logger.info("Trained %s index for %d vectors.", self.index_type, n)
+
+    def _build(self) -> None:
         if self._built or not self._pending:
             return
-        vectors = np.vstack(self._pending)
-        index = self._make_index(len(vectors))
-        if not index.is_trained:
-            index.train(vectors)
-        index.add(vectors)
+        # The buffer is used in place, piece by piece: stacking it would
+        # briefly double the corpus in memory.
+        pieces = []
+        for ids, vectors in self._pending:
+            live = self._chunks.is_live(self._chunks.rows(ids))
+            if not live.all():                 # deleted before the build
+                ids, vectors = ids[live], vectors[live]
+            if len(ids):
+                pieces.append((ids, vectors))
+        n = sum(len(ids) for ids, _ in pieces)
+        if not n:
+            self._pending = []
+            return
+        if self.auto:
+            self.index_type = self._choose_type(n)
+        with self._threads():
+            index = self._make_index(n)
+            if not index.is_trained:
+                rows = _sample_rows(n, self._n_train(index, n))
+                index.train(_gather_rows(pieces, rows))
+            for ids, vectors in pieces:
+                for start in range(0, len(ids), self._BLOCK):
+                    stop = start + self._BLOCK
+                    index.add_with_ids(vectors[start:stop], ids[start:stop])
         self._index = index
         self._pending = []          # free buffer; "ivfpq" now keeps only codes
         self._built = True
@@ -207,30 +946,222 @@ class FAISSStore:
     # Public API
     # ------------------------------------------------------------------
 
-    def add(self, chunks: List[Chunk], embeddings: np.ndarray) -> None:
+    def add(self, chunks: List[Chunk], embeddings: np.ndarray) -> np.ndarray:
         """
         Add chunks and their L2-normalised embeddings.
 
         Before the first build the vectors are buffered; afterwards they go
         straight into the live index. Either way chunk metadata is recorded so
-        results can be mapped back.
+        results can be mapped back. With `dedup=True`, duplicates are folded
+        into references instead (see the class docstring).
 
         Args:
             chunks:     list of Chunk (length N)
             embeddings: (N, dim) float32, L2-normalised
+
+        Returns:
+            (N,) int64 ids assigned to the chunks; for a folded duplicate,
+            the id of the chunk it copies.
         """
         if embeddings.shape != (len(chunks), self.dim):
             raise ValueError(
                 f"Shape mismatch: {embeddings.shape} vs expected ({len(chunks)}, {self.dim})"
             )
         embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
-        self._chunks.extend(chunks)
-        if self._built:
-            self._index.add(embeddings)
-        else:
-            self._pending.append(embeddings)
+        if self.dedup is None:
+            with self._lock.write():
+                return self._add(chunks, embeddings)
+        ids = np.zeros(len(chunks), dtype=np.int64)
+        for start in range(0, len(chunks), self._DEDUP_BATCH):
+            end = start + self._DEDUP_BATCH
+            with self._lock.write():           # released between batches for searches
+                ids[start:end] = self._add_unique(chunks[start:end], embeddings[start:end])
+        return ids
+
+    def _add(self, chunks: List[Chunk], embeddings: np.ndarray) -> np.ndarray:
+        ids = np.arange(self._next_id, self._next_id + len(chunks), dtype=np.int64)
+        self._next_id += len(chunks)
+        self._chunks.append(chunks, ids)
+        if self.sparse is not None:
+            self.sparse.add(ids, [c.text for c in chunks])
+        if not self._built:
+            self._pending.append((ids, embeddings))
+            return ids
+
+        if self._mmapped:
+            self._detach()
+        self._index.add_with_ids(embeddings, ids)
+        if self._replay is not None:
+            self._replay.append(("add", ids, embeddings))
+        elif self.auto and not self.rebuilding:
+            target = self._rebuild_target()
+            if target is not None:
+                self._start_rebuild(target)
+        return ids
+
+    def _add_unique(self, chunks: List[Chunk], embeddings: np.ndarray) -> np.ndarray:
+        """`_add` for a dedup store: index only the chunks unlike any stored one."""
+        n = len(chunks)
+        hashes = [text_hash(c.text) for c in chunks]
+        match = np.full(n, -1, dtype=np.int64)     # stored chunk a row duplicates
+        source = np.full(n, -1, dtype=np.int64)    # earlier row of this batch it copies
+        first: Dict[int, int] = {}
+        for i, h in enumerate(hashes):
+            survivor = self.dedup.survivor(h)
+            if survivor is not None:
+                match[i] = survivor
+            elif h in first:
+                source[i] = first[h]
+            else:
+                first[h] = i
+        exact = (match >= 0) | (source >= 0)
+
+        if self.dedup_threshold is not None:
+            rest = np.flatnonzero(~exact)
+            scores, nearest = self._nearest(embeddings[rest])
+            near = scores >= self.dedup_threshold
+            match[rest[near]] = nearest[near]
+            rest = rest[~near]
+            sims = embeddings[rest] @ embeddings[rest].T
+            kept = np.ones(len(rest), dtype=bool)
+            for j in range(1, len(rest)):
+                close = np.flatnonzero(kept[:j] & (sims[j, :j] >= self.dedup_threshold))
+                if len(close):
+                    kept[j] = False
+                    source[rest[j]] = rest[close[0]]
+
+        ids = np.zeros(n, dtype=np.int64)
+        keep = np.flatnonzero((match < 0) & (source < 0))
+        if len(keep):
+            ids[keep] = self._add([chunks[i] for i in keep], embeddings[keep])
+            self.dedup.register(ids[keep], [hashes[i] for i in keep])
+        dups = np.flatnonzero((match >= 0) | (source >= 0))
+        for i in dups:                         # sources precede their copies
+            ids[i] = match[i] if match[i] >= 0 else ids[source[i]]
+        if len(dups):
+            self.dedup.refer(
+                [(chunks[i].doc_id, chunks[i].chunk_idx) for i in dups],
+                ids[dups].tolist(), n_exact=int(exact[dups].sum()),
+            )
+        return ids
+
+    def _nearest(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score and id of each query's nearest live chunk; -inf and -1 when
+        there is none or nothing is searchable yet. Caller holds the lock.
+        """
+        scores = np.full(len(queries), -np.inf, dtype=np.float32)
+        ids = np.full(len(queries), -1, dtype=np.int64)
+        if not self._built:
+            if self.needs_training or not self._pending:
+                return scores, ids
+            self._build()
+        if not len(queries) or not self._index.ntotal:
+            return scores, ids
+        k = min(1 + self._n_tombstones, self._index.ntotal)
+        found_scores, found = self._index.search(queries, k)
+        live = found >= 0
+        if self._n_tombstones:
+            live &= self._chunks.is_live(self._chunks.rows(found))
+        rows = np.flatnonzero(live.any(axis=1))
+        cols = live[rows].argmax(axis=1)
+        scores[rows] = found_scores[rows, cols]
+        ids[rows] = found[rows, cols]
+        return scores, ids
+
+    def delete(self, doc_id: str) -> int:
+        """
+        Remove every chunk of `doc_id`. Returns how many were removed
+        (with `dedup=True`, counting the document's references too).
+
+        "flat" and the IVF types drop the vectors from the index right away;
+        "hnsw" tombstones them (see the class docstring).
+        """
+        with self._lock.write():
+            return self._delete(doc_id)
+
+    def _delete(self, doc_id: str) -> int:
+        ids = self._chunks.delete_doc(doc_id)
+        n_refs = 0
+        if self.dedup is not None:             # texts stay readable until compact()
+            hashes = [text_hash(self._chunks.text(r)) for r in self._chunks.rows(ids).tolist()]
+            n_refs = self.dedup.delete(doc_id, ids, hashes)
+        if self.sparse is not None:
+            self.sparse.delete(ids)
+        if len(ids) and self._built:
+            if self.index_type in self._TOMBSTONE_TYPES:
+                self._n_tombstones += len(ids)
+            else:
+                if self._mmapped:
+                    self._detach()
+                self._index.remove_ids(ids)
+            if self._replay is not None:
+                self._replay.append(("delete", ids, None))
+        return len(ids) + n_refs
+
+    def upsert(
+        self,
+        doc_id: str,
+        chunks: List[Chunk],
+        embeddings: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Replace the chunks of `doc_id` with `chunks` (all of which must carry
+        that doc_id). Returns the new ids.
+        """
+        if any(c.doc_id != doc_id for c in chunks):
+            raise ValueError(f"upsert({doc_id!r}) given chunks of another document")
+        if embeddings.shape != (len(chunks), self.dim):    # check before deleting
+            raise ValueError(
+                f"Shape mismatch: {embeddings.shape} vs expected ({len(chunks)}, {self.dim})"
+            )
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock.write():
+            self._delete(doc_id)
+            if self.dedup is not None:
+                return self._add_unique(chunks, embeddings)
+            return self._add(chunks, embeddings)
 
-    def search(self, query_vec: np.ndarray, top_k: int = 5) -> List[Dict]:
+    def compact(self) -> None:
+        """
+        Reclaim the space of deleted chunks: rebuild an "hnsw" graph without
+        its tombstones and drop dead rows from the chunk table. Waits for a
+        background rebuild to finish first.
+        """
+        self.wait_for_rebuild()
+        with self._lock.write():
+            self._compact()
+
+    def _compact(self) -> None:
+        if self._pending:
+            kept = []
+            for ids, vectors in self._pending:
+                live = self._chunks.is_live(self._chunks.rows(ids))
+                if live.any():
+                    kept.append((ids[live], vectors[live]))
+            self._pending = kept
+        if self._n_tombstones:
+            ids = self._chunks.select({})
+            vectors = self._index.reconstruct_batch(ids)
+            index = self._make_index(len(ids))
+            if not index.is_trained:
+                index.train(vectors[_sample_rows(len(ids), self._n_train(index, len(ids)))])
+            index.add_with_ids(vectors, ids)
+            self._index = index
+            self._mmapped = False
+            logger.info("Rebuilt %s index without %d tombstones.",
+                        self.index_type, self._n_tombstones)
+            self._n_tombstones = 0
+        self._chunks.compact()
+        if self.sparse is not None:
+            self.sparse.compact()
+
+    def search(
+        self,
+        query_vec: np.ndarray,
+        top_k: int = 5,
+        filter: Dict | None = None,
+    ) -> List[Dict]:
         """
         Return the top_k chunks most similar to query_vec.
 
@@ -239,47 +1170,628 @@ class FAISSStore:
         Args:
             query_vec: (dim,) float32, L2-normalised
             top_k:     number of results
+            filter:    only consider chunks matching this, e.g.
+                       {"source": "wiki", "doc_id": ["d1", "d2"]}
+                       (see ChunkTable.select)
 
         Returns:
             List of dicts, descending by cosine score:
                 score, text, doc_id, chunk_idx, metadata
         """
-        if not self._chunks:                 # nothing indexed yet
-            return []
-        if not self._built:
+        return self.search_batch(query_vec.reshape(1, -1), top_k=top_k, filter=filter)[0]
+
+    def search_batch(
+        self,
+        query_matrix: np.ndarray,
+        top_k: int = 5,
+        filter: Dict | None = None,
+    ) -> List[List[Dict]]:
+        """
+        `search()` for many queries with a single FAISS call.
+
+        FAISS parallelises a multi-row search internally, so one call over Q
+        queries is far cheaper than Q single-row calls.
+
+        Args:
+            query_matrix: (Q, dim) float32, L2-normalised rows
+            top_k:        results per query
+            filter:       as in `search()`; applies to every query
+
+        Returns:
+            Q result lists, each as returned by `search()`.
+        """
+        if query_matrix.ndim != 2 or query_matrix.shape[1] != self.dim:
+            raise ValueError(
+                f"query_matrix must be (Q, {self.dim}), got {query_matrix.shape}"
+            )
+        if not self._built and self._pending:
             self.build()
 
-        top_k = min(top_k, self._index.ntotal)
-        query = np.ascontiguousarray(query_vec.reshape(1, -1), dtype=np.float32)
-        scores, indices = self._index.search(query, top_k)
+        queries = np.ascontiguousarray(query_matrix, dtype=np.float32)
+        with self._lock.read():
+            if not self._chunks.n_live:      # nothing indexed yet
+                return [[] for _ in range(len(queries))]
+            if filter is not None:
+                scores, ids = self._search_filtered(queries, top_k, filter)
+            else:
+                # Tombstones can take up to _n_tombstones of the top slots.
+                k = min(top_k + self._n_tombstones, self._index.ntotal)
+                scores, ids = self._index.search(queries, k)
+            rows = self._chunks.rows(ids)
+            keep = ids >= 0                  # sentinel: fewer than k found
+            if self._n_tombstones:
+                keep &= self._chunks.is_live(rows)
+            return [
+                self._results(s[m][:top_k].tolist(), r[m][:top_k].tolist())
+                for s, r, m in zip(scores, rows, keep)
+            ]
 
-        results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < 0:                      # sentinel: fewer than top_k found
-                continue
-            c = self._chunks[idx]
-            results.append({
-                "score": float(score),
-                "text": c.text,
-                "doc_id": c.doc_id,
-                "chunk_idx": c.chunk_idx,
-                "metadata": c.metadata,
-            })
+    def _search_filtered(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        where: Dict,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """(scores, ids) over the chunks matching `where`; ids -1 past the end."""
+        ids = self._chunks.select(where)
+        if not len(ids):
+            return (np.zeros((len(queries), 0), dtype=np.float32),
+                    np.zeros((len(queries), 0), dtype=np.int64))
+        if len(ids) <= self.filter_scan_max:
+            return self._scan(queries, ids, top_k)
+
+        eligible = np.zeros(self._next_id, dtype=bool)
+        eligible[ids] = True
+        bitmap = np.packbits(eligible, bitorder="little")
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        if self.index_type == "hnsw":
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = faiss.downcast_index(self._index.index).hnsw.efSearch
+        elif self.index_type == "binary_hnsw":
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = self._index.hnsw.efSearch
+        elif self.index_type in ("ivf", "ivfpq"):
+            params = faiss.SearchParametersIVF()
+            params.nprobe = self._index.nprobe
+        else:
+            params = faiss.SearchParameters()
+        params.sel = selector               # `bitmap` must outlive the search
+        return self._index.search(queries, min(top_k, len(ids)), params=params)
+
+    def _scan(
+        self,
+        queries: np.ndarray,
+        ids: np.ndarray,
+        top_k: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k of `queries` against the stored vectors of `ids` only."""
+        scores = queries @ self._index.reconstruct_batch(ids).T
+        k = min(top_k, len(ids))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return (np.take_along_axis(top_scores, order, axis=1),
+                ids[np.take_along_axis(top, order, axis=1)])
+
+    def search_text(
+        self,
+        query: str,
+        top_k: int = 5,
+        filter: Dict | None = None,
+    ) -> List[Dict]:
+        """
+        Keyword (BM25) search over chunk texts; needs `sparse=True`.
+
+        Returns:
+            Result dicts as from `search()`, descending by BM25 score. Only
+            chunks sharing a term with the query are returned, so there
+            may be fewer than top_k.
+        """
+        if self.sparse is None:
+            raise RuntimeError("keyword search needs FAISSStore(sparse=True)")
+        with self._lock.read():
+            ids = self._chunks.select(filter) if filter is not None else None
+            if ids is not None and not len(ids):
+                return []
+            scores, ids = self.sparse.search(query, top_k, ids)
+            return self._results(scores.tolist(), self._chunks.rows(ids).tolist())
+
+    def _results(self, scores: List[float], rows: List[int]) -> List[Dict]:
+        """Result dicts for one query's scores and chunk-table rows."""
+        t = self._chunks
+        results = [
+            {
+                "score": score,
+                "text": t.text(row),
+                "doc_id": t.doc_id(row),
+                "chunk_idx": t.chunk_idx(row),
+                "metadata": t.metadata(row),
+            }
+            for score, row in zip(scores, rows)
+        ]
+        if self.dedup is not None:
+            for r, row in zip(results, rows):
+                r["duplicates"] = [
+                    {"doc_id": doc_id, "chunk_idx": idx}
+                    for doc_id, idx in self.dedup.references(t.id(row))
+                ]
         return results
 
+    def dedup_stats(self) -> Dict[str, float] | None:
+        """ChunkDeduplicator.stats() plus the chunks indexed; None without dedup."""
+        if self.dedup is None:
+            return None
+        with self._lock.read():
+            return dict(self.dedup.stats(), indexed=len(self))
+
     def __len__(self) -> int:
-        return len(self._chunks)
+        """Live (not deleted) chunks."""
+        return self._chunks.n_live
+
+    # ------------------------------------------------------------------
+    # Background rebuild
+    # ------------------------------------------------------------------
+
+    @property
+    def rebuilding(self) -> bool:
+        return self._rebuild_thread is not None and self._rebuild_thread.is_alive()
+
+    def rebuild(self, index_type: str | None = None, wait: bool = False) -> None:
+        """
+        Rebuild the index in a background thread and swap it in when done.
+        Does nothing if a rebuild is already running.
+
+        Args:
+            index_type: type to rebuild into; None → the "auto" choice for
+                        the current size, or else the current type
+            wait:       block until the new index is live
+        """
+        with self._lock.write():
+            if index_type is None:
+                index_type = (self._choose_type(self._chunks.n_live)
+                              if self.auto else self.index_type)
+            if index_type not in self._VALID_TYPES:
+                raise ValueError(f"cannot rebuild into {index_type!r}")
+            if not self._built:                # nothing to copy: build lazily
+                self.index_type = index_type
+                return
+            if not self.rebuilding:
+                self._start_rebuild(index_type)
+        if wait:
+            self.wait_for_rebuild()
+
+    def wait_for_rebuild(self, timeout: float | None = None) -> bool:
+        """Block until any background rebuild finishes; False on timeout."""
+        thread = self._rebuild_thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    def _start_rebuild(self, index_type: str) -> None:
+        """Start the rebuild thread. Caller holds the write lock."""
+        if self.index_type == "ivfpq":
+            logger.warning("Rebuilding from ivfpq re-encodes approximate vectors.")
+        logger.info("Rebuilding %d-vector %s index as %s in the background.",
+                    self._chunks.n_live, self.index_type, index_type)
+        self._replay = []                      # writes from now on are replayed
+        ids = self._chunks.select({})
+        self._rebuild_thread = threading.Thread(
+            target=self._rebuild, args=(index_type, ids),
+            name="faiss-rebuild", daemon=True,
+        )
+        self._rebuild_thread.start()
+
+    def _rebuild(self, index_type: str, ids: np.ndarray) -> None:
+        """Rebuild thread: copy live vectors into a new index, replay, swap."""
+        try:
+            with self._threads():
+                index = self._make_index(len(ids), index_type)
+                if not index.is_trained:
+                    sample = ids[_sample_rows(len(ids), self._n_train(index, len(ids)))]
+                    index.train(self._copy_vectors(sample)[1])
+                for start in range(0, len(ids), self._BLOCK):
+                    block_ids, vectors = self._copy_vectors(ids[start : start + self._BLOCK])
+                    index.add_with_ids(vectors, block_ids)
+
+            with self._lock.write():
+                for op, op_ids, vectors in self._replay:
+                    if op == "add":
+                        index.add_with_ids(vectors, op_ids)
+                    elif index_type not in self._TOMBSTONE_TYPES:
+                        index.remove_ids(op_ids)
+                self._index = index
+                self.index_type = index_type
+                self._n_tombstones = index.ntotal - self._chunks.n_live
+                self._mmapped = False
+                self._replay = None
+            logger.info("Swapped in the rebuilt %s index (%d vectors).",
+                        index_type, index.ntotal)
+        except Exception:
+            logger.exception("Background rebuild failed; keeping the %s index.",
+                             self.index_type)
+            with self._lock.write():
+                self._replay = None
+
+    def _copy_vectors(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids still live, their vectors) read from the live index."""
+        with self._lock.read():
+            ids = ids[self._chunks.is_live(self._chunks.rows(ids))]
+            return ids, self._index.reconstruct_batch(ids)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """
+        Write the store to directory `path` (created if missing).
+
+        Builds the index first if needed; deleted chunks are kept (as
+        tombstones, for "hnsw") unless `compact()` runs first. Layout:
+            store.json       format version and constructor settings
+            index.faiss      the FAISS index (faiss.write_index); for the
+                             binary types, the re-scoring copy
+            codes.faiss      binary types only: the bit-code index
+            texts.bin        chunk texts, UTF-8, back to back
+            *.npy            per-chunk columns: text offsets, doc / metadata
+                             table positions, chunk_idx
+            tables.json      distinct doc_ids and distinct metadata dicts
+            bm25*, dedup*    with sparse=True / dedup=True: see
+                             BM25Index.save and ChunkDeduplicator.save
+
+        Each file is written to a temporary name and renamed into place, and
+        store.json goes last, so an interrupted save never leaves a
+        directory that loads as complete.
+        """
+        self.build()
+        with self._lock.read():
+            self._save(path)
+
+    def _save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, "index.faiss")
+        codes_path = os.path.join(path, "codes.faiss")
+        if self._index is not None:
+            vectors = self._index
+            if isinstance(self._index, _BinaryIndex):
+                vectors = self._index.vectors
+                faiss.write_index_binary(self._index.codes, codes_path + ".tmp")
+                os.replace(codes_path + ".tmp", codes_path)
+            faiss.write_index(vectors, index_path + ".tmp")
+            os.replace(index_path + ".tmp", index_path)
+        elif os.path.exists(index_path):          # left by an earlier save
+            os.remove(index_path)
+        self._chunks.save(path)
+        if self.sparse is not None:
+            self.sparse.save(path)
+        if self.dedup is not None:
+            self.dedup.save(path)
+        _write_json(path, "store.json", {
+            "format": _STORE_FORMAT,
+            "dim": self.dim,
+            "index_type": self.index_type,
+            "auto": self.auto,
+            "n_chunks": len(self._chunks),
+            "next_id": self._next_id,
+            "n_tombstones": self._n_tombstones,
+            "settings": {
+                name: getattr(self, name)
+                for name in ("nlist", "nprobe", "hnsw_m", "hnsw_ef_construction",
+                             "hnsw_ef_search", "pq_m", "pq_nbits", "filter_scan_max",
+                             "memory_budget", "train_per_list", "n_threads",
+                             "binary_oversample", "binary_rescore", "dedup_threshold")
+            },
+            "sparse": self.sparse is not None,
+            "dedup": self.dedup is not None,
+        })
+        logger.info("Saved %d chunks to %s.", len(self._chunks), path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> FAISSStore:
+        """
+        Read a store written by `save()`.
+
+        Args:
+            path: directory passed to `save()`
+            mmap: memory-map the index instead of reading it into RAM. The
+                  store stays fully usable; the first `add()` copies the
+                  index into memory before changing it.
+        """
+        with open(os.path.join(path, "store.json")) as f:
+            manifest = json.load(f)
+        if manifest["format"] != _STORE_FORMAT:
+            raise ValueError(
+                f"{path}: store format {manifest['format']}, expected {_STORE_FORMAT}"
+            )
+        store = cls(
+            manifest["dim"],
+            "auto" if manifest.get("auto") else manifest["index_type"],
+            **manifest["settings"],
+        )
+        store.index_type = manifest["index_type"]
+        store._chunks = ChunkTable.load(path)
+        if manifest.get("sparse"):
+            store.sparse = BM25Index.load(path)
+        if manifest.get("dedup"):
+            store.dedup = ChunkDeduplicator.load(path)
+        store._next_id = manifest["next_id"]
+        store._n_tombstones = manifest["n_tombstones"]
+        if len(store._chunks) != manifest["n_chunks"]:
+            raise ValueError(
+                f"{path}: {len(store._chunks)} chunk records, "
+                f"manifest says {manifest['n_chunks']}"
+            )
+
+        index_path = os.path.join(path, "index.faiss")
+        if os.path.exists(index_path):
+            flags = 0
+            if mmap:
+                # IVF inverted lists and flat code arrays are mapped by
+                # different flags, and FAISS rejects the two combined.
+                ivf = store.index_type in ("ivf", "ivfpq")
+                flags = faiss.IO_FLAG_MMAP if ivf else faiss.IO_FLAG_MMAP_IFC
+            store._index = faiss.read_index(index_path, flags)
+            if store.index_type in cls._BINARY_TYPES:
+                codes = faiss.read_index_binary(
+                    os.path.join(path, "codes.faiss"), faiss.IO_FLAG_MMAP if mmap else 0,
+                )
+                store._index = _BinaryIndex(codes, store._index, store.binary_oversample)
+            if store.index_type in ("ivf", "ivfpq") and (
+                store._index.direct_map.type == faiss.DirectMap.NoMap
+            ):                                 # saved before filtered search
+                store._index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            store._built = True
+            store._mmapped = mmap
+            if store._index.ntotal != store._chunks.n_live + store._n_tombstones:
+                raise ValueError(
+                    f"{path}: index holds {store._index.ntotal} vectors "
+                    f"for {store._chunks.n_live} chunks"
+                )
+        return store
+
+    def _detach(self) -> None:
+        """Copy a memory-mapped index into RAM so it can be modified."""
+        if isinstance(self._index, _BinaryIndex):
+            self._index = _BinaryIndex(
+                faiss.deserialize_index_binary(faiss.serialize_index_binary(self._index.codes)),
+                faiss.deserialize_index(faiss.serialize_index(self._index.vectors)),
+                self._index.oversample,
+            )
+        else:
+            self._index = faiss.deserialize_index(faiss.serialize_index(self._index))
+        self._mmapped = False
+
+
+# ---------------------------------------------------------------------------
+# Build helpers
+# ---------------------------------------------------------------------------
+
+def _sample_rows(n: int, k: int) -> np.ndarray:
+    """k of range(n), sorted, drawn without replacement with a fixed seed."""
+    if k >= n:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(0).choice(n, k, replace=False))
+
+
+def _gather_rows(pieces: Sequence[Tuple[np.ndarray, np.ndarray]], rows: np.ndarray) -> np.ndarray:
+    """Rows `rows` (sorted) of the vectors in `pieces`, as if vstacked."""
+    out, start = [], 0
+    for _, vectors in pieces:
+        lo, hi = np.searchsorted(rows, [start, start + len(vectors)])
+        out.append(vectors[rows[lo:hi] - start])
+        start += len(vectors)
+    return np.ascontiguousarray(np.vstack(out), dtype=np.float32)
+
+
+# ---------------------------------------------------------------------------
+# On-disk helpers
+# ---------------------------------------------------------------------------
+
+_STORE_FORMAT = 2
+
+
+def _write_json(path: str, name: str, obj) -> None:
+    tmp = os.path.join(path, name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(path, name))
+
+
+def _write_npy(path: str, name: str, values: np.ndarray) -> None:
+    tmp = os.path.join(path, name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, values)
+    os.replace(tmp, os.path.join(path, name))
+
+
+# ---------------------------------------------------------------------------
+# Streaming helpers
+# ---------------------------------------------------------------------------
+
+def _stream_items(documents: Iterable[str | Tuple]) -> Iterator[Tuple[str, str, Dict]]:
+    """Normalise index_stream inputs to (doc_id, text, metadata)."""
+    for i, item in enumerate(documents):
+        if isinstance(item, str):
+            yield f"doc_{i}", item, {}
+        elif len(item) == 2:
+            yield item[0], item[1], {}
+        else:
+            yield item[0], item[1], item[2] if item[2] is not None else {}
+
+
+def _blocks(
+    encoded: Iterable[Tuple[List[Chunk], np.ndarray]],
+    block_size: int,
+) -> Iterator[Tuple[List[Chunk], np.ndarray]]:
+    """Regroup per-document (chunks, vectors) into blocks of ~block_size rows."""
+    chunks: List[Chunk] = []
+    vectors: List[np.ndarray] = []
+    for doc_chunks, doc_vecs in encoded:
+        chunks.extend(doc_chunks)
+        vectors.append(doc_vecs)
+        if len(chunks) >= block_size:
+            yield chunks, np.vstack(vectors)
+            chunks, vectors = [], []
+    if chunks:
+        yield chunks, np.vstack(vectors)
+
+
+def _spill(
+    encoded: Iterable[Tuple[List[Chunk], np.ndarray]],
+    path: str,
+    dim: int,
+    sample_size: int,
+) -> Tuple[int, np.ndarray]:
+    """
+    Write every document's chunks (docs.pkl) and vectors (vectors.f32)
+    under `path`, keeping a uniform reservoir sample of the vectors.
+
+    Documents are pickled one record at a time, so metadata comes back as
+    given — tuples, non-string keys and non-JSON values included — just as
+    index() would store it. It must be picklable.
+
+    Returns (number of vectors written, (≤ sample_size, dim) sample).
+    """
+    rng = np.random.default_rng(0)
+    sample = np.empty((sample_size, dim), dtype=np.float32)
+    seen = 0
+    with open(os.path.join(path, "docs.pkl"), "wb") as docs, \
+            open(os.path.join(path, "vectors.f32"), "wb") as vecs:
+        for chunks, embeddings in encoded:
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            pickle.dump(
+                (chunks[0].doc_id, chunks[0].metadata, [c.text for c in chunks]),
+                docs, protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            vecs.write(embeddings.tobytes())
+
+            # Reservoir sampling (Algorithm R), one document at a time.
+            fill = max(0, min(sample_size - seen, len(embeddings)))
+            sample[seen : seen + fill] = embeddings[:fill]
+            rest = embeddings[fill:]
+            if len(rest):
+                slots = rng.integers(0, seen + fill + np.arange(1, len(rest) + 1))
+                hit = slots < sample_size
+                sample[slots[hit]] = rest[hit]
+            seen += len(embeddings)
+    return seen, sample[: min(seen, sample_size)]
+
+
+def _read_spill(
+    path: str,
+    dim: int,
+    block_size: int,
+) -> Iterator[Tuple[List[Chunk], np.ndarray]]:
+    """Read back a `_spill` directory as blocks of ~block_size chunks."""
+    n_rows = os.path.getsize(os.path.join(path, "vectors.f32")) // (4 * dim)
+    vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32,
+                        mode="r", shape=(n_rows, dim))
+    start, chunks = 0, []
+    with open(os.path.join(path, "docs.pkl"), "rb") as docs:
+        while docs.peek(1):
+            doc_id, meta, texts = pickle.load(docs)
+            chunks.extend(
+                Chunk(text=t, doc_id=doc_id, chunk_idx=j, metadata=meta)
+                for j, t in enumerate(texts)
+            )
+            if len(chunks) >= block_size:
+                yield chunks, np.array(vectors[start : start + len(chunks)])
+                start, chunks = start + len(chunks), []
+    if chunks:
+        yield chunks, np.array(vectors[start : start + len(chunks)])
+    del vectors
 
 
 # ---------------------------------------------------------------------------
 # RAG Pipeline
 # ---------------------------------------------------------------------------
 
+RRF_K = 60          # reciprocal-rank-fusion constant (Cormack et al., 2009)
+
 DEFAULT_TASK = (
     "Given a web search query, retrieve relevant passages that answer the query"
 )
 
 
+class QueryResult(list):
+    """
+    A query's result dicts, plus where the time went.
+
+    `timings` maps stage → milliseconds: "encode_ms" (0-ish on a query-cache
+    hit; absent in "sparse" mode), "search_ms", "rerank_ms" (only with a
+    reranker) and "total_ms".
+    """
+
+    def __init__(self, results: Iterable[Dict] = (), timings: Dict[str, float] | None = None):
+        super().__init__(results)
+        self.timings = timings if timings is not None else {}
+
+
+def _ms_since(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+class QueryCache:
+    """
+    In-memory LRU of query vectors, keyed by (query text, task).
+
+    Production query streams repeat a lot; a hit skips the model entirely.
+    Entries expire after `ttl` seconds if set. Safe to share between threads.
+
+    Args:
+        max_size: entries kept; the least recently used is dropped past it
+        ttl:      seconds an entry stays valid; None → until evicted
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str, task: str) -> np.ndarray | None:
+        key = (text, task)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if time.monotonic() - entry[0] > self.ttl:
+                    del self._entries[key]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, task: str, vec: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+        vec = np.array(vec, dtype=np.float32)
+        vec.flags.writeable = False            # shared by every later hit
+        with self._lock:
+            self._entries[(text, task)] = (time.monotonic(), vec)
+            self._entries.move_to_end((text, task))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
 class RAGPipeline:
     """
     End-to-end retrieval pipeline.
@@ -301,17 +1813,46 @@ class RAGPipeline:
         results = rag.query("your question", top_k=5)
 
         # large corpus, approximate index:
-        from rag import FAISSStore
+        from pyutils.embedders.rag import FAISSStore
         store = FAISSStore(dim=1024, index_type="hnsw")   # dim must match the model
         rag = RAGPipeline(store=store)
+
+        # Matryoshka-truncated vectors: 4x less index memory, ~4x faster search
+        rag = RAGPipeline(output_dim=256)
+
+        # dense + keyword (BM25) results, fused by reciprocal rank
+        rag = RAGPipeline(mode="hybrid")
+
+        # index repeated boilerplate once; copies become references
+        rag = RAGPipeline(dedup=True)
+
+        # rerank the top 50 with a cross-encoder, within 300 ms per query
+        from pyutils.embedders import QwenReranker
+        rag = RAGPipeline(reranker=QwenReranker(), deadline_ms=300)
+        results = rag.query("your question")
+        results.timings          # {"encode_ms": ..., "search_ms": ..., "rerank_ms": ...}
     """
 
+    _MODES = ("dense", "sparse", "hybrid")
+    _FUSIONS = ("rrf", "weighted")
+
     def __init__(
         self,
         embedder: QwenEmbedder | None = None,
         store: FAISSStore | None = None,
         chunk_tokens: int = 512,
         task: str = DEFAULT_TASK,
+        output_dim: int | None = None,
+        query_cache_size: int = 1024,
+        query_cache_ttl: float | None = None,
+        mode: str = "dense",
+        fusion: str = "rrf",
+        dense_weight: float = 0.5,
+        fusion_depth: int = 50,
+        reranker=None,
+        rerank_depth: int = 50,
+        deadline_ms: float | None = None,
+        dedup: bool = False,
     ) -> None:
         """
         Args:
@@ -319,70 +1860,526 @@ class RAGPipeline:
             store:        FAISSStore instance (created as exact "flat" if None)
             chunk_tokens: tokens per late-chunking window
             task:         instruction prepended to queries
+            output_dim:   MRL vector size for the default embedder (None → full
+                          1024). With an injected embedder it must match its dim.
+            query_cache_size: query vectors kept in the in-memory LRU (0 → off)
+            query_cache_ttl:  seconds a cached query vector stays valid
+            mode:         default retrieval for queries: "dense" (vectors),
+                          "sparse" (BM25 keywords) or "hybrid" (both, fused).
+                          "sparse"/"hybrid" need a store with sparse=True;
+                          the default store gets one automatically.
+            fusion:       how "hybrid" merges the two lists: "rrf"
+                          (reciprocal rank, k=60) or "weighted" (min-max
+                          normalised scores mixed by `dense_weight`)
+            dense_weight: weight of the dense score for fusion="weighted"
+            fusion_depth: candidates taken from each list before fusing
+            reranker:     optional second stage, e.g. reranker.QwenReranker:
+                          anything with rerank(query, results, top_k,
+                          deadline, task) → results
+            rerank_depth: candidates retrieved for the reranker to rescore
+            deadline_ms:  wall-clock budget per query, counted from the
+                          call. Reranking stops before a batch that would
+                          overrun it and returns the best ordering so far;
+                          None → always rerank every candidate
+            dedup:        index each repeated or near-identical chunk once
+                          (see FAISSStore "Deduplication"). Needs a store
+                          built with dedup=True; the default store gets one.
         """
-        self.embedder = embedder if embedder is not None else QwenEmbedder()
+        if mode not in self._MODES:
+            raise ValueError(f"mode must be one of {list(self._MODES)}, got {mode!r}")
+        if fusion not in self._FUSIONS:
+            raise ValueError(f"fusion must be one of {list(self._FUSIONS)}, got {fusion!r}")
+        if embedder is None:
+            embedder = (
+                QwenEmbedder(output_dim=output_dim) if output_dim else QwenEmbedder()
+            )
+        elif output_dim is not None and output_dim != embedder.dim:
+            raise ValueError(
+                f"output_dim={output_dim} does not match embedder dim={embedder.dim}"
+            )
+        self.embedder = embedder
         self.chunk_tokens = chunk_tokens
         self.task = task
-        self.store = store if store is not None else FAISSStore(dim=self.embedder.dim)
+        self.store = (
+            store if store is not None
+            else FAISSStore(dim=self.embedder.dim, sparse=mode != "dense", dedup=dedup)
+        )
+        self.mode = mode
+        self.fusion = fusion
+        self.dense_weight = dense_weight
+        self.fusion_depth = fusion_depth
+        self.reranker = reranker
+        self.rerank_depth = rerank_depth
+        self.deadline_ms = deadline_ms
+        if mode != "dense" and self.store.sparse is None:
+            raise ValueError(f'mode="{mode}" needs a store built with sparse=True')
+        if dedup and self.store.dedup is None:
+            raise ValueError("dedup=True needs a store built with dedup=True")
+        self._batcher: QueryMicrobatcher | None = None
+        self.query_cache = QueryCache(query_cache_size, query_cache_ttl)
+        if self.store.dim != self.embedder.dim:
+            raise ValueError(
+                f"store dim={self.store.dim} does not match embedder dim={self.embedder.dim}"
+            )
 
     def index(
         self,
         documents: List[str],
         doc_ids: List[str] | None = None,
         metadatas: List[Dict] | None = None,
+        batch_docs: int = 64,
+        block_size: int = 16_384,
+        workers: int = 2,
     ) -> None:
         """
         Index documents using late chunking.
 
         Each document → one forward pass → multiple contextual chunk embeddings.
+        Short documents share padded forward passes (see
+        QwenEmbedder.encode_documents); documents longer than the model's
+        context are embedded in overlapping windows, so nothing past 32k
+        tokens is dropped.
+
+        Ingestion is a three-stage pipeline joined by bounded queues:
+
+            tokenize ──▶ forward ──▶ decode ──▶ store.add
+            (threads)    (caller)    (threads)  (indexer thread, in blocks)
+
+        so the model runs batch after batch while the tokenizer and FAISS
+        work beside it (see QwenEmbedder.encode_document_batches). The
+        result is the same as running the stages one after another.
 
         Args:
-            documents: raw text strings (any length)
-            doc_ids:   stable IDs; defaults to "doc_0", "doc_1", ...
-            metadatas: per-document metadata dicts
+            documents:  raw text strings (any length)
+            doc_ids:    stable IDs; defaults to "doc_0", "doc_1", ...
+            metadatas:  per-document metadata dicts
+            batch_docs: documents handed to the embedder at a time
+            block_size: chunk vectors per store.add()
+            workers:    tokenizer/decoder threads; 0 → run every stage on
+                        the calling thread, one after another
         """
         if doc_ids is None:
             doc_ids = [f"doc_{i}" for i in range(len(documents))]
         if metadatas is None:
             metadatas = [{} for _ in documents]
 
-        total_chunks = 0
+        before = self.store.dedup_stats()
+        items = zip(doc_ids, documents, metadatas)
+        encoded = self._encode_stream(items, batch_docs, workers)
+        total_chunks = self._add_blocks(encoded, block_size, workers)
 
-        for text, doc_id, meta in zip(documents, doc_ids, metadatas):
-            if not text.strip():
-                continue
+        logger.info(
+            "Indexed %d chunks from %d documents.", total_chunks, len(documents),
+        )
+        self._log_dedup(before)
 
-            chunk_texts, embeddings = self.embedder.encode_document(
-                text, chunk_tokens=self.chunk_tokens,
-            )
+    def index_stream(
+        self,
+        documents: Iterable[str | Tuple],
+        batch_docs: int = 64,
+        block_size: int = 16_384,
+        train_sample: int = 100_000,
+        spill_dir: str | None = None,
+        workers: int = 2,
+    ) -> int:
+        """
+        Index an iterable of documents without holding the corpus in memory.
+
+        Documents are consumed lazily and embedded `batch_docs` at a time.
+        Memory stays bounded by a few blocks of `block_size` chunk vectors:
+        one with workers=0; about four with workers (one being filled, two
+        queued for the indexer thread, one inside store.add()). Indexes that
+        need training also hold the training sample:
+
+          - If the store is built already, or its index needs no training
+            ("flat", "hnsw"), blocks go straight into the index.
+          - Otherwise ("ivf", "ivfpq", "sq8", the binary types, and "auto"
+            before the first build) the vectors are spilled to a temporary
+            directory (chunk texts and metadata pickled, so metadata must be
+            picklable) while a reservoir sample of `train_sample` vectors is
+            kept. Once the stream ends, the index is trained on the sample,
+            sized for the final count, and the spill is read back and added
+            block by block.
 
-            chunks = [
-                Chunk(text=ct, doc_id=doc_id, chunk_idx=j, metadata=meta)
-                for j, ct in enumerate(chunk_texts)
-            ]
+        Args:
+            documents:    items of `text`, `(doc_id, text)` or
+                          `(doc_id, text, metadata)`; bare texts get ids
+                          "doc_0", "doc_1", ... by position
+            batch_docs:   documents handed to the embedder at a time
+            block_size:   chunk vectors per store.add()
+            train_sample: reservoir size for IVF training
+            spill_dir:    where to put the temporary spill (default: system
+                          temp dir); needs room for every vector
+            workers:      tokenizer/decoder threads, as for index()
 
-            self.store.add(chunks, embeddings)
-            total_chunks += len(chunks)
+        Returns:
+            Number of chunks indexed.
+        """
+        before = self.store.dedup_stats()
+        encoded = self._encode_stream(_stream_items(documents), batch_docs, workers)
+        if not self.store.needs_training:
+            if not self.store.built:
+                self.store.train()
+            total = self._add_blocks(encoded, block_size, workers)
+        else:
+            with tempfile.TemporaryDirectory(prefix="rag-spill-", dir=spill_dir) as tmp:
+                total, sample = _spill(encoded, tmp, self.store.dim, train_sample)
+                if not total:
+                    return 0
+                self.store.train(sample, n_total=total)
+                del sample
+                for chunks, embeddings in _read_spill(tmp, self.store.dim, block_size):
+                    self.store.add(chunks, embeddings)
+        logger.info("Indexed %d chunks from a stream.", total)
+        self._log_dedup(before)
+        return total
+
+    def _log_dedup(self, before: Dict | None) -> None:
+        """Log what deduplication saved since `before` (a dedup_stats())."""
+        if before is None:
+            return
+        after = self.store.dedup_stats()
+        seen = after["chunks_seen"] - before["chunks_seen"]
+        exact = after["exact_duplicates"] - before["exact_duplicates"]
+        near = after["near_duplicates"] - before["near_duplicates"]
+        if seen:
+            logger.info(
+                "Dedup: %d exact + %d near duplicates folded into references; "
+                "%d of %d chunks indexed (%.1f%% fewer).",
+                exact, near, seen - exact - near, seen, 100 * (exact + near) / seen,
+            )
 
-        logger.info(
-            "Indexed %d chunks from %d documents.", total_chunks, len(documents),
+    def _encode_stream(
+        self,
+        items: Iterable[Tuple[str, str, Dict]],
+        batch_docs: int,
+        workers: int = 0,
+    ) -> Iterator[Tuple[List[Chunk], np.ndarray]]:
+        """
+        Late-chunk (doc_id, text, metadata) items; one (chunks, vectors) per
+        doc. With `workers` and an embedder that has encode_document_batches()
+        (QwenEmbedder), tokenizing and decoding overlap the forward passes.
+        """
+        groups: deque = deque()               # groups handed out, not yet encoded
+
+        def grouped() -> Iterator[List[str]]:
+            group: List[Tuple[str, str, Dict]] = []
+            for doc_id, text, meta in items:
+                if not text.strip():
+                    continue
+                group.append((doc_id, text, meta))
+                if len(group) == batch_docs:
+                    groups.append(group)
+                    yield [text for _, text, _ in group]
+                    group = []
+            if group:
+                groups.append(group)
+                yield [text for _, text, _ in group]
+
+        if workers and hasattr(self.embedder, "encode_document_batches"):
+            encoded = self.embedder.encode_document_batches(
+                grouped(), chunk_tokens=self.chunk_tokens, workers=workers,
+            )
+        else:
+            encoded = (
+                self.embedder.encode_documents(texts, chunk_tokens=self.chunk_tokens)
+                for texts in grouped()
+            )
+        for results in encoded:
+            for (doc_id, _, meta), (chunk_texts, embeddings) in zip(groups.popleft(), results):
+                yield [
+                    Chunk(text=ct, doc_id=doc_id, chunk_idx=j, metadata=meta)
+                    for j, ct in enumerate(chunk_texts)
+                ], embeddings
+
+    def _add_blocks(
+        self,
+        encoded: Iterable[Tuple[List[Chunk], np.ndarray]],
+        block_size: int,
+        workers: int,
+    ) -> int:
+        """
+        store.add() `encoded` in blocks of `block_size` chunks; returns the
+        chunk count. With `workers`, the adds run on an indexer thread fed
+        through a two-block queue, so the model never waits for FAISS; an
+        error there stops the stream and is raised here. Up to four blocks
+        are then alive at once: one filling, two queued, one being added.
+        """
+        if not workers:
+            total = 0
+            for chunks, embeddings in _blocks(encoded, block_size):
+                self.store.add(chunks, embeddings)
+                total += len(chunks)
+            return total
+
+        blocks: queue.Queue = queue.Queue(maxsize=2)
+        errors: List[BaseException] = []
+
+        def add_blocks() -> None:
+            while (block := blocks.get()) is not None:
+                if not errors:                 # keep draining so put() never blocks
+                    try:
+                        self.store.add(*block)
+                    except BaseException as e:
+                        errors.append(e)
+
+        indexer = threading.Thread(target=add_blocks, name="rag-indexer", daemon=True)
+        indexer.start()
+        total = 0
+        try:
+            for chunks, embeddings in _blocks(encoded, block_size):
+                if errors:
+                    break
+                blocks.put((chunks, embeddings))
+                total += len(chunks)
+        finally:
+            blocks.put(None)
+            indexer.join()
+        if errors:
+            raise errors[0]
+        return total
+
+    def upsert(self, doc_id: str, text: str, metadata: Dict | None = None) -> None:
+        """Re-embed one document and replace its chunks in the store."""
+        (chunk_texts, embeddings), = self.embedder.encode_documents(
+            [text], chunk_tokens=self.chunk_tokens,
         )
-
-    def query(self, text: str, top_k: int = 5) -> List[Dict]:
+        meta = metadata if metadata is not None else {}
+        chunks = [
+            Chunk(text=ct, doc_id=doc_id, chunk_idx=j, metadata=meta)
+            for j, ct in enumerate(chunk_texts)
+        ]
+        self.store.upsert(doc_id, chunks, embeddings)
+
+    def delete(self, doc_id: str) -> int:
+        """Remove a document's chunks from the store; returns how many."""
+        return self.store.delete(doc_id)
+
+    def query(
+        self,
+        text: str,
+        top_k: int = 5,
+        filter: Dict | None = None,
+        mode: str | None = None,
+    ) -> QueryResult:
         """
         Embed query and return top-k most relevant chunks.
 
         The query is encoded with an instruction prefix using last-token
-        pooling (standard mode), matching how the model was trained.
+        pooling (standard mode), matching how the model was trained. Repeated
+        queries are served from `self.query_cache` without touching the model.
+        `filter` restricts results by metadata / doc_id (see FAISSStore.search).
+        `mode` overrides the pipeline's default retrieval mode for this call;
+        "sparse" skips the model entirely. With a reranker, the top
+        `rerank_depth` candidates are rescored and the best top_k returned.
 
         Returns:
-            List of result dicts, each with:
+            QueryResult: a list of result dicts, each with
                 score, text, doc_id, chunk_idx, metadata
+            (+ rerank_score when reranked; in "hybrid" mode, score is the
+            fused score), and per-stage `.timings` in milliseconds.
+        """
+        start = time.perf_counter()
+        mode = self._mode(mode)
+        timings: Dict[str, float] = {}
+        query_vec = None
+        if mode != "sparse":
+            query_vec = self.query_cache.get(text, self.task)
+            if query_vec is None:
+                query_vec = self.embedder.encode(
+                    text, is_query=True, task=self.task,
+                )[0]
+                self.query_cache.put(text, self.task, query_vec)
+            timings["encode_ms"] = _ms_since(start)
+
+        t = time.perf_counter()
+        results = self._retrieve(text, query_vec, self._depth(top_k), filter, mode)
+        timings["search_ms"] = _ms_since(t)
+        return self._finish(text, results, top_k, timings, start)
+
+    def query_batch(
+        self,
+        texts: List[str],
+        top_k: int = 5,
+        filter: Dict | None = None,
+        mode: str | None = None,
+    ) -> List[QueryResult]:
+        """
+        `query()` for many questions: one batched encode, one FAISS search.
+
+        Cached query vectors are reused; only the rest go through the model,
+        together. Encode and search timings are for the whole batch; each
+        query's rerank gets its own share of `deadline_ms`, as if the
+        batch's encode and search had been its own.
+
+        Returns:
+            One QueryResult per text, in input order.
         """
-        query_vec = self.embedder.encode(
-            text, is_query=True, task=self.task,
-        )[0]
-        return self.store.search(query_vec, top_k=top_k)
+        start = time.perf_counter()
+        mode = self._mode(mode)
+        if not texts:
+            return []
+        k = self._depth(top_k)
+        timings: Dict[str, float] = {}
+        if mode == "sparse":
+            t = time.perf_counter()
+            batch = [self.store.search_text(q, top_k=k, filter=filter) for q in texts]
+        else:
+            vecs: List[np.ndarray | None] = [self.query_cache.get(q, self.task) for q in texts]
+            misses = [i for i, v in enumerate(vecs) if v is None]
+            if misses:
+                fresh = self.embedder.encode(
+                    [texts[i] for i in misses], is_query=True, task=self.task,
+                )
+                for i, vec in zip(misses, fresh):
+                    vecs[i] = vec
+                    self.query_cache.put(texts[i], self.task, vec)
+            timings["encode_ms"] = _ms_since(start)
+
+            t = time.perf_counter()
+            if mode == "dense":
+                batch = self.store.search_batch(np.vstack(vecs), top_k=k, filter=filter)
+            else:
+                depth = max(k, self.fusion_depth)
+                dense = self.store.search_batch(np.vstack(vecs), top_k=depth, filter=filter)
+                batch = [
+                    self._fuse(d, self.store.search_text(q, top_k=depth, filter=filter), k)
+                    for d, q in zip(dense, texts)
+                ]
+        timings["search_ms"] = _ms_since(t)
+
+        shared_s = time.perf_counter() - start
+        return [
+            self._finish(q, results, top_k, dict(timings), time.perf_counter() - shared_s)
+            for q, results in zip(texts, batch)
+        ]
+
+    async def aquery(
+        self,
+        text: str,
+        top_k: int = 5,
+        filter: Dict | None = None,
+        mode: str | None = None,
+    ) -> QueryResult:
+        """
+        `query()` for asyncio servers: concurrent calls share forward passes.
+
+        The query joins a QueryMicrobatcher (created on first use; replace
+        `self._batcher` to tune it), which encodes whatever queries arrive
+        within a couple of milliseconds as one batch. Search and rerank run
+        in a worker thread so the event loop is never blocked. The batcher
+        owns a thread; `await pipeline.aclose()` when done serving.
+        """
+        start = time.perf_counter()
+        mode = self._mode(mode)
+        timings: Dict[str, float] = {}
+        query_vec = None
+        if mode != "sparse":
+            query_vec = self.query_cache.get(text, self.task)
+            if query_vec is None:
+                if self._batcher is None:
+                    self._batcher = QueryMicrobatcher(self.embedder, task=self.task)
+                query_vec = await self._batcher.encode(text)
+                self.query_cache.put(text, self.task, query_vec)
+            timings["encode_ms"] = _ms_since(start)
+
+        def search_and_rerank() -> QueryResult:
+            t = time.perf_counter()
+            results = self._retrieve(text, query_vec, self._depth(top_k), filter, mode)
+            timings["search_ms"] = _ms_since(t)
+            return self._finish(text, results, top_k, timings, start)
+
+        return await asyncio.to_thread(search_and_rerank)
+
+    async def aclose(self) -> None:
+        """Close the batcher `aquery()` created; a later aquery() starts a new one."""
+        if self._batcher is not None:
+            await self._batcher.close()
+            self._batcher = None
+
+    def _depth(self, top_k: int) -> int:
+        """Candidates to retrieve: rerank_depth when reranking, else top_k."""
+        return max(top_k, self.rerank_depth) if self.reranker is not None else top_k
+
+    def _retrieve(
+        self,
+        text: str,
+        query_vec: np.ndarray | None,
+        k: int,
+        filter: Dict | None,
+        mode: str,
+    ) -> List[Dict]:
+        """First-stage candidates for one query in `mode`."""
+        if mode == "sparse":
+            return self.store.search_text(text, top_k=k, filter=filter)
+        if mode == "dense":
+            return self.store.search(query_vec, top_k=k, filter=filter)
+        depth = max(k, self.fusion_depth)
+        return self._fuse(
+            self.store.search(query_vec, top_k=depth, filter=filter),
+            self.store.search_text(text, top_k=depth, filter=filter),
+            k,
+        )
+
+    def _finish(
+        self,
+        text: str,
+        results: List[Dict],
+        top_k: int,
+        timings: Dict[str, float],
+        start: float,
+    ) -> QueryResult:
+        """Rerank (within the deadline, counted from `start`) and cut to top_k."""
+        if self.reranker is not None and results:
+            t = time.perf_counter()
+            deadline = start + self.deadline_ms / 1000 if self.deadline_ms is not None else None
+            results = self.reranker.rerank(
+                text, results, top_k=top_k, deadline=deadline, task=self.task,
+            )
+            timings["rerank_ms"] = _ms_since(t)
+        else:
+            results = results[:top_k]
+        timings["total_ms"] = _ms_since(start)
+        return QueryResult(results, timings)
+
+    def _mode(self, mode: str | None) -> str:
+        """Resolve a per-call mode override against the pipeline default."""
+        mode = self.mode if mode is None else mode
+        if mode not in self._MODES:
+            raise ValueError(f"mode must be one of {list(self._MODES)}, got {mode!r}")
+        if mode != "dense" and self.store.sparse is None:
+            raise ValueError(f'mode="{mode}" needs a store built with sparse=True')
+        return mode
+
+    def _fuse(self, dense: List[Dict], sparse: List[Dict], top_k: int) -> List[Dict]:
+        """
+        Merge a dense and a keyword result list into one top-k list.
+
+        "rrf": score = Σ 1 / (60 + rank) over the lists a chunk appears in —
+        rank-only, so the two score scales never need reconciling.
+        "weighted": each list's scores are min-max normalised to [0, 1] and
+        mixed as dense_weight · dense + (1 - dense_weight) · sparse.
+        """
+        fused: Dict[Tuple[str, int], float] = {}
+        best: Dict[Tuple[str, int], Dict] = {}
+        weights = (self.dense_weight, 1 - self.dense_weight)
+        for results, weight in zip((dense, sparse), weights):
+            if not results:
+                continue
+            if self.fusion == "rrf":
+                parts = [1 / (RRF_K + rank) for rank in range(1, len(results) + 1)]
+            else:
+                hi, lo = results[0]["score"], results[-1]["score"]
+                parts = [
+                    weight * ((r["score"] - lo) / (hi - lo) if hi > lo else 1.0)
+                    for r in results
+                ]
+            for r, part in zip(results, parts):
+                key = r["doc_id"], r["chunk_idx"]
+                fused[key] = fused.get(key, 0.0) + part
+                best.setdefault(key, r)
+        top = heapq.nlargest(top_k, fused.items(), key=lambda kv: kv[1])
+        return [dict(best[key], score=score) for key, score in top]
 
     def __len__(self) -> int:
         return len(self.store)
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""
+reranker.py — Qwen3-Reranker-0.6B cross-encoder for a second-stage rerank.
+
+Vector search compares a query vector with chunk vectors computed apart
+from it; a cross-encoder reads the query and the chunk together and judges
+relevance far more precisely, at the price of one forward pass per pair.
+The usual split: retrieve a wide candidate set cheaply, then rerank it.
+
+Model facts (HuggingFace model card, June 2025):
+    Model    : Qwen/Qwen3-Reranker-0.6B (causal LM, 28 layers)
+    Scoring  : the prompt asks for "yes" or "no"; the score is
+               P(yes) = softmax(logit_yes, logit_no) at the last position
+    Context  : 32 768 tokens (pairs are truncated to `max_length`)
+    Prompt   : chat template with an <Instruct>/<Query>/<Document> body
+
+Bounded latency:
+    `rerank(..., deadline=...)` scores candidates in retrieval order, one
+    batch at a time, and stops before a batch that would not finish in
+    time. Scored candidates are ordered by reranker score; the rest keep
+    their retrieval order behind them — the best ordering available when
+    the budget ran out.
+
+Loading is lazy, as for QwenEmbedder: torch and transformers are imported,
+and the weights read, on first use or on `warmup()`.
+
+Requirements:
+    pip install transformers>=4.51.0 torch numpy
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from .embedder import _auto_device
+
+logger = logging.getLogger(__name__)
+
+RERANKER_MODEL_ID = "Qwen/Qwen3-Reranker-0.6B"
+
+_PREFIX = (
+    "<|im_start|>system\nJudge whether the Document meets the requirements based "
+    "on the Query and the Instruct provided. Note that the answer can only be "
+    '"yes" or "no".<|im_end|>\n<|im_start|>user\n'
+)
+_SUFFIX = "<|im_end|>\n<|im_start|>assistant\n<think>\n\n</think>\n\n"
+
+
+class QwenReranker:
+    """
+    Scores (query, passage) pairs → relevance in [0, 1].
+
+    Usage:
+        reranker = QwenReranker()
+        scores = reranker.score("what is gamma?", ["passage 1", "passage 2"])
+        top = reranker.rerank("what is gamma?", results, top_k=5, deadline=0.2)
+
+    Args:
+        device:     "cuda" | "mps" | "cpu" | None (auto, resolved at load)
+        batch_size: pairs per forward pass
+        max_length: tokens per pair, prompt included; longer passages are
+                    truncated
+        model_id:   HuggingFace model id or local path
+    """
+
+    def __init__(
+        self,
+        device: str | None = None,
+        batch_size: int = 8,
+        max_length: int = 8192,
+        model_id: str = RERANKER_MODEL_ID,
+    ) -> None:
+        self._device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.model_id = model_id
+
+        self._tokenizer = None
+        self._model = None
+        self._yes_no = None                    # token ids of "yes", "no"
+        self._affixes = None                   # token ids of _PREFIX, _SUFFIX
+        self._load_lock = threading.Lock()
+
+    @property
+    def device(self) -> str:
+        if self._device is None:
+            self._device = _auto_device()
+        return self._device
+
+    def _ensure_loaded(self) -> None:
+        if self._model is not None:
+            return
+        with self._load_lock:
+            if self._model is not None:
+                return
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(self.model_id, padding_side="left")
+            model = AutoModelForCausalLM.from_pretrained(self.model_id)
+            model.to(self.device).eval()
+            self._yes_no = [tokenizer.convert_tokens_to_ids(t) for t in ("yes", "no")]
+            self._affixes = (
+                tokenizer.encode(_PREFIX, add_special_tokens=False),
+                tokenizer.encode(_SUFFIX, add_special_tokens=False),
+            )
+            self._tokenizer = tokenizer
+            self._model = model
+            logger.info("QwenReranker ready — device=%s", self.device)
+
+    def warmup(self) -> None:
+        """Load the weights and run one small forward pass."""
+        self.score("warmup", ["warmup"])
+
+    # ------------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------------
+
+    def score(
+        self,
+        query: str,
+        passages: List[str],
+        task: str = "Given a web search query, retrieve relevant passages that answer the query",
+    ) -> np.ndarray:
+        """P("yes") for each passage against `query`; (N,) float32."""
+        out = np.zeros(len(passages), dtype=np.float32)
+        for start in range(0, len(passages), self.batch_size):
+            batch = passages[start : start + self.batch_size]
+            out[start : start + len(batch)] = self._score_batch(query, batch, task)
+        return out
+
+    def _score_batch(self, query: str, passages: List[str], task: str) -> np.ndarray:
+        import torch
+
+        self._ensure_loaded()
+        prefix, suffix = self._affixes
+        bodies = [
+            f"<Instruct>: {task}\n<Query>: {query}\n<Document>: {p}" for p in passages
+        ]
+        encoded = self._tokenizer(
+            bodies, padding=False, truncation=True, return_attention_mask=False,
+            add_special_tokens=False,
+            max_length=max(1, self.max_length - len(prefix) - len(suffix)),
+        )
+        inputs = self._tokenizer.pad(
+            {"input_ids": [prefix + ids + suffix for ids in encoded["input_ids"]]},
+            padding=True, return_tensors="pt",
+        ).to(self.device)
+        with torch.inference_mode():
+            logits = self._model(**inputs, logits_to_keep=1).logits[:, -1, :]
+        yes_no = logits[:, self._yes_no].float()
+        return torch.softmax(yes_no, dim=-1)[:, 0].cpu().numpy()
+
+    # ------------------------------------------------------------------
+    # Reranking
+    # ------------------------------------------------------------------
+
+    def rerank(
+        self,
+        query: str,
+        candidates: List[Dict],
+        top_k: int | None = None,
+        deadline: float | None = None,
+        task: str = "Given a web search query, retrieve relevant passages that answer the query",
+    ) -> List[Dict]:
+        """
+        Reorder search results by cross-encoder score.
+
+        Args:
+            query:      the question
+            candidates: result dicts (with "text"), best retrieval match first
+            top_k:      results returned (None → all)
+            deadline:   time.perf_counter() value by which to stop scoring;
+                        None → score everything
+            task:       instruction inserted into the prompt
+
+        Returns:
+            New result dicts. Scored ones carry "rerank_score" and come
+            first, by that score; any the deadline cut off follow in their
+            original order.
+        """
+        top_k = len(candidates) if top_k is None else top_k
+        scores: List[float] = []
+        batch_s = 0.0                          # duration of the last batch
+        for start in range(0, len(candidates), self.batch_size):
+            now = time.perf_counter()
+            if deadline is not None and now + batch_s > deadline:
+                logger.debug("Rerank deadline: scored %d of %d candidates.",
+                             len(scores), len(candidates))
+                break
+            batch = candidates[start : start + self.batch_size]
+            scores.extend(self._score_batch(query, [c["text"] for c in batch], task).tolist())
+            batch_s = time.perf_counter() - now
+
+        scored = sorted(
+            (dict(c, rerank_score=s) for c, s in zip(candidates, scores)),
+            key=lambda r: r["rerank_score"], reverse=True,
+        )
+        return (scored + [dict(c) for c in candidates[len(scores):]])[:top_k]
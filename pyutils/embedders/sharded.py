@@ -0,0 +1,452 @@
+"""
+sharded.py — FAISSStore split across worker processes, scatter-gather search.
+
+One FAISSStore lives in one process: its index must fit that process's
+memory, and a search walks one index on one set of threads. ShardedStore
+partitions the chunks over N worker processes, each owning a FAISSStore,
+and fans every call out to them:
+
+    add(chunks)   ── by crc32(doc_id) % N ──▶ shard k only
+    search(q)     ──────── to every shard ──▶ per-shard top-k
+                  ◀── heap merge of N sorted lists ── global top-k
+
+A document's chunks always land on the same shard, so delete/upsert touch
+one process. Embeddings for add() and training samples travel through
+shared memory (as in pool.py); queries and results are small and are
+pickled. A shard process that dies fails the call waiting on it, and the
+store closes.
+
+ShardedStore has FAISSStore's API (add, delete, upsert, search,
+search_batch, search_text, build, train, compact, save/load, len), so it can
+be handed to RAGPipeline as its store.
+
+Requirements:
+    pip install numpy faiss-cpu
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import traceback
+import zlib
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .pool import _from_shared, _to_shared
+from .rag import Chunk
+
+logger = logging.getLogger(__name__)
+
+_SHARDED_FORMAT = 1
+_POLL_S = 1.0                            # how often a waiting call checks for dead shards
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+
+def _shard_main(
+    shard_id: int,
+    spec: Tuple,
+    n_threads: int,
+    tasks: mp.Queue,
+    results: mp.Queue,
+) -> None:
+    import faiss
+
+    faiss.omp_set_num_threads(n_threads)
+    from .rag import FAISSStore
+
+    kind, arg = spec
+    try:
+        store = FAISSStore(**arg) if kind == "new" else FAISSStore.load(*arg)
+    except Exception:
+        results.put((None, shard_id, False, traceback.format_exc()))
+        return
+    results.put((None, shard_id, True, None))            # ready
+
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        job_id, method, args = job
+        try:
+            if method in ("add", "upsert"):
+                *head, block = args
+                payload = getattr(store, method)(*head, _from_shared(*block))
+            elif method == "train":
+                block, n_total = args
+                payload = store.train(None if block is None else _from_shared(*block), n_total)
+            elif method == "len":
+                payload = len(store)
+            elif method == "built":
+                payload = store.built
+            elif method == "needs_training":
+                payload = store.needs_training
+            else:
+                payload = getattr(store, method)(*args)
+            results.put((job_id, shard_id, True, payload))
+        except Exception:
+            results.put((job_id, shard_id, False, traceback.format_exc()))
+
+
+# ---------------------------------------------------------------------------
+# Store
+# ---------------------------------------------------------------------------
+
+class ShardedStore:
+    """
+    N FAISSStores in N processes behind the FAISSStore API.
+
+    Usage:
+        with ShardedStore(n_shards=4, dim=1024, index_type="hnsw") as store:
+            rag = RAGPipeline(store=store)
+            rag.index(documents)
+            rag.query("...")
+
+    Ids returned by add() are global: shard-local id × n_shards + shard.
+
+    Args:
+        n_shards:          worker processes, one FAISSStore each
+        dim:               embedding dimension
+        index_type:        as FAISSStore; every shard gets the same type
+        threads_per_shard: FAISS OpenMP threads per worker; None →
+                           cpu_count // n_shards
+        **store_kwargs:    forwarded to every shard's FAISSStore (nlist,
+                           hnsw_m, sparse, dedup, ...). Sizes such as nlist
+                           apply per shard; dedup compares a chunk only with
+                           its own shard's, so copies in documents routed to
+                           different shards are each kept.
+    """
+
+    def __init__(
+        self,
+        n_shards: int = 4,
+        dim: int = 1024,
+        index_type: str = "flat",
+        threads_per_shard: int | None = None,
+        **store_kwargs,
+    ) -> None:
+        self._start(
+            n_shards, dim, index_type, threads_per_shard,
+            [("new", dict(store_kwargs, dim=dim, index_type=index_type))] * n_shards,
+        )
+        self.sparse = True if store_kwargs.get("sparse") else None
+        self.dedup = True if store_kwargs.get("dedup") else None
+
+    def _start(
+        self,
+        n_shards: int,
+        dim: int,
+        index_type: str,
+        threads_per_shard: int | None,
+        specs: List[Tuple],
+    ) -> None:
+        self.n_shards = n_shards
+        self.dim = dim
+        self.index_type = index_type
+        self.threads_per_shard = threads_per_shard or max(
+            1, (os.cpu_count() or 1) // n_shards,
+        )
+        ctx = mp.get_context("spawn")      # faiss/OpenMP state does not survive fork
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for _ in range(n_shards)]
+        self._workers = [
+            ctx.Process(
+                target=_shard_main,
+                args=(i, spec, self.threads_per_shard, q, self._results),
+                daemon=True,
+            )
+            for i, (spec, q) in enumerate(zip(specs, self._tasks))
+        ]
+        for w in self._workers:
+            w.start()
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()        # one call in flight at a time
+
+        errors = []
+        waiting = dict.fromkeys(range(n_shards), 1)
+        for _ in range(n_shards):
+            _, shard, ok, payload = self._next_result(waiting)
+            waiting[shard] -= 1
+            if not ok:
+                errors.append(f"shard {shard}:\n{payload}")
+        if errors:
+            self.close()
+            raise RuntimeError("ShardedStore failed to start " + errors[0])
+        logger.info("ShardedStore started — %d shards × %d threads",
+                    n_shards, self.threads_per_shard)
+
+    # ------------------------------------------------------------------
+    # Dispatch
+    # ------------------------------------------------------------------
+
+    def _run(self, jobs: List[Tuple[int, str, tuple]]) -> List:
+        """Send (shard, method, args) jobs; return payloads in job order."""
+        if self._workers is None:
+            raise RuntimeError("ShardedStore is closed")
+        with self._lock:
+            ids = []
+            for shard, method, args in jobs:
+                job_id = next(self._job_ids)
+                ids.append(job_id)
+                self._tasks[shard].put((job_id, method, args))
+
+            waiting: Dict[int, int] = {}
+            for shard, _, _ in jobs:
+                waiting[shard] = waiting.get(shard, 0) + 1
+            done: Dict[int, object] = {}
+            errors: List[str] = []
+            while len(done) + len(errors) < len(ids):
+                job_id, shard, ok, payload = self._next_result(waiting)
+                waiting[shard] -= 1
+                if ok:
+                    done[job_id] = payload
+                else:
+                    errors.append(f"shard {shard}:\n{payload}")
+            if errors:
+                raise RuntimeError("ShardedStore job failed in " + errors[0])
+            return [done[i] for i in ids]
+
+    def _next_result(self, waiting: Dict[int, int]) -> Tuple:
+        """
+        Next message on the results queue. While none arrives, check that
+        the shards still owing results (`waiting`: shard → count) are alive;
+        if one died, close the store and raise.
+        """
+        while True:
+            try:
+                return self._results.get(timeout=_POLL_S)
+            except queue.Empty:
+                for shard, n in waiting.items():
+                    if n and not self._workers[shard].is_alive():
+                        code = self._workers[shard].exitcode
+                        self.close()
+                        raise RuntimeError(
+                            f"ShardedStore shard {shard} died (exit code {code}); "
+                            "the store is closed"
+                        )
+
+    def _all(self, method: str, *args) -> List:
+        """Run one method on every shard; payloads in shard order."""
+        return self._run([(s, method, args) for s in range(self.n_shards)])
+
+    def shard_of(self, doc_id: str) -> int:
+        """The shard that holds (or will hold) `doc_id`'s chunks."""
+        return zlib.crc32(doc_id.encode("utf-8")) % self.n_shards
+
+    # ------------------------------------------------------------------
+    # FAISSStore API
+    # ------------------------------------------------------------------
+
+    def add(self, chunks: List[Chunk], embeddings: np.ndarray) -> np.ndarray:
+        """FAISSStore.add, each chunk routed to its document's shard."""
+        if embeddings.shape != (len(chunks), self.dim):
+            raise ValueError(
+                f"Shape mismatch: {embeddings.shape} vs expected ({len(chunks)}, {self.dim})"
+            )
+        by_shard: Dict[int, List[int]] = {}
+        for i, chunk in enumerate(chunks):
+            by_shard.setdefault(self.shard_of(chunk.doc_id), []).append(i)
+        shards = sorted(by_shard)
+        local = self._run([
+            (s, "add", ([chunks[i] for i in by_shard[s]], _to_shared(embeddings[by_shard[s]])))
+            for s in shards
+        ])
+        ids = np.zeros(len(chunks), dtype=np.int64)
+        for s, local_ids in zip(shards, local):
+            ids[by_shard[s]] = local_ids * self.n_shards + s
+        return ids
+
+    def delete(self, doc_id: str) -> int:
+        """FAISSStore.delete on the document's shard."""
+        return self._run([(self.shard_of(doc_id), "delete", (doc_id,))])[0]
+
+    def upsert(self, doc_id: str, chunks: List[Chunk], embeddings: np.ndarray) -> np.ndarray:
+        """FAISSStore.upsert on the document's shard; returns global ids."""
+        if any(c.doc_id != doc_id for c in chunks):
+            raise ValueError(f"upsert({doc_id!r}) given chunks of another document")
+        s = self.shard_of(doc_id)
+        local = self._run([(s, "upsert", (doc_id, chunks, _to_shared(embeddings)))])[0]
+        return local * self.n_shards + s
+
+    def search(
+        self,
+        query_vec: np.ndarray,
+        top_k: int = 5,
+        filter: Dict | None = None,
+    ) -> List[Dict]:
+        """FAISSStore.search over every shard."""
+        return self.search_batch(query_vec.reshape(1, -1), top_k=top_k, filter=filter)[0]
+
+    def search_batch(
+        self,
+        query_matrix: np.ndarray,
+        top_k: int = 5,
+        filter: Dict | None = None,
+    ) -> List[List[Dict]]:
+        """
+        FAISSStore.search_batch, scattered to every shard and gathered.
+
+        Each shard returns its own top_k per query; the N sorted lists are
+        merged with a heap, so the result equals one store's over all data.
+        """
+        if query_matrix.ndim != 2 or query_matrix.shape[1] != self.dim:
+            raise ValueError(
+                f"query_matrix must be (Q, {self.dim}), got {query_matrix.shape}"
+            )
+        queries = np.ascontiguousarray(query_matrix, dtype=np.float32)
+        per_shard = self._all("search_batch", queries, top_k, filter)
+        return [_merge(lists, top_k) for lists in zip(*per_shard)]
+
+    def search_text(
+        self,
+        query: str,
+        top_k: int = 5,
+        filter: Dict | None = None,
+    ) -> List[Dict]:
+        """
+        FAISSStore.search_text over every shard (needs sparse=True).
+
+        BM25 statistics (document frequencies, average length) are per
+        shard; with hash partitioning they agree closely across shards.
+        """
+        return _merge(self._all("search_text", query, top_k, filter), top_k)
+
+    @property
+    def built(self) -> bool:
+        return all(self._all("built"))
+
+    @property
+    def needs_training(self) -> bool:
+        return any(self._all("needs_training"))
+
+    def build(self) -> None:
+        self._all("build")
+
+    def train(self, sample: np.ndarray | None = None, n_total: int | None = None) -> None:
+        """
+        FAISSStore.train on every shard not built yet, each on its
+        1 / n_shards share of `sample` and sized for n_total / n_shards.
+        Shards can differ: build() leaves a shard that holds no chunks
+        unbuilt, and those are the ones trained here.
+        """
+        n_shard = -(-n_total // self.n_shards) if n_total else None
+        # Chunks are spread evenly by hash, so every n_shards-th row of the
+        # sample is a sample of one shard's data.
+        self._run([
+            (s, "train", (None if sample is None else _to_shared(sample[s :: self.n_shards]),
+                          n_shard))
+            for s, built in enumerate(self._all("built")) if not built
+        ])
+
+    def compact(self) -> None:
+        self._all("compact")
+
+    def wait_for_rebuild(self, timeout: float | None = None) -> bool:
+        return all(self._all("wait_for_rebuild", timeout))
+
+    def __len__(self) -> int:
+        return sum(self._all("len"))
+
+    def dedup_stats(self) -> Dict[str, float] | None:
+        """FAISSStore.dedup_stats summed over the shards; None without dedup."""
+        if self.dedup is None:
+            return None
+        per_shard = self._all("dedup_stats")
+        total = {name: sum(s[name] for s in per_shard) for name in per_shard[0]}
+        duplicates = total["exact_duplicates"] + total["near_duplicates"]
+        total["reduction"] = duplicates / total["chunks_seen"] if total["chunks_seen"] else 0.0
+        return total
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """
+        Write every shard to `path`/shard_<i> (FAISSStore.save layout), then
+        sharded.json with the shard count and dim.
+        """
+        os.makedirs(path, exist_ok=True)
+        self._run([
+            (s, "save", (os.path.join(path, f"shard_{s}"),)) for s in range(self.n_shards)
+        ])
+        tmp = os.path.join(path, "sharded.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({
+                "format": _SHARDED_FORMAT,
+                "n_shards": self.n_shards,
+                "dim": self.dim,
+                "index_type": self.index_type,
+                "sparse": bool(self.sparse),
+                "dedup": bool(self.dedup),
+            }, f)
+        os.replace(tmp, os.path.join(path, "sharded.json"))
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        mmap: bool = True,
+        threads_per_shard: int | None = None,
+    ) -> ShardedStore:
+        """Start one worker per saved shard, each loading its FAISSStore."""
+        with open(os.path.join(path, "sharded.json")) as f:
+            manifest = json.load(f)
+        if manifest["format"] != _SHARDED_FORMAT:
+            raise ValueError(
+                f"{path}: sharded format {manifest['format']}, expected {_SHARDED_FORMAT}"
+            )
+        n = manifest["n_shards"]
+        store = cls.__new__(cls)
+        store._workers = None
+        store._start(
+            n, manifest["dim"], manifest["index_type"], threads_per_shard,
+            [("load", (os.path.join(path, f"shard_{s}"), mmap)) for s in range(n)],
+        )
+        store.sparse = True if manifest["sparse"] else None
+        store.dedup = True if manifest.get("dedup") else None
+        return store
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def close(self) -> None:
+        """Stop the workers. Idempotent."""
+        if getattr(self, "_workers", None) is None:
+            return
+        for q in self._tasks:
+            q.put(None)
+        for w in self._workers:
+            w.join(timeout=30)
+            if w.is_alive():
+                w.terminate()
+        self._workers = None
+
+    def __enter__(self) -> ShardedStore:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _merge(lists: List[List[Dict]], top_k: int) -> List[Dict]:
+    """Top-k of several score-descending result lists, via a k-way heap merge."""
+    merged = heapq.merge(*lists, key=lambda r: -r["score"])
+    return list(itertools.islice(merged, top_k))
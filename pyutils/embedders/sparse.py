@@ -0,0 +1,325 @@
+"""
+sparse.py — BM25 keyword index over chunk texts.
+
+Dense vectors capture meaning but blur exact strings: a product code such as
+"XR-2210" or an error like "ECONNREFUSED" has no neighbourhood of similar
+text to land in. BM25Index scores chunks by the query terms they actually
+contain, so FAISSStore can answer keyword queries next to vector ones, and
+RAGPipeline can fuse the two (see RAGPipeline `mode="hybrid"`).
+
+Layout:
+    Postings are kept in CSR form — one int64 `indptr` over the vocabulary,
+    one int32 array of chunk rows and one uint16 array of term frequencies —
+    so scoring a term is a slice and a few vectorised ops, not a Python
+    loop. New chunks append to flat pending arrays, which are merged into
+    the CSR arrays (one stable sort) on the next search.
+
+    chunk row ──▶ chunk id (FAISSStore id), token count, live flag
+
+Deletes clear the live flag; `compact()` drops the dead postings. Until
+then a term's document frequency is counted over its live postings at
+search time, so idf agrees with `n_live` and avgdl, which count live rows
+only.
+
+Requirements:
+    pip install numpy
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import re
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Word characters, optionally joined by - . / : into one compound token.
+_TOKEN = re.compile(r"\w+(?:[-./:]\w+)*")
+_SPLIT = re.compile(r"[-./:]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower-cased terms of `text`.
+
+    Compounds like "xr-2210" or "v1.4.2" are kept whole, so an exact code
+    matches exactly, and their parts are emitted too, so "xr" still matches.
+    """
+    terms = []
+    for token in _TOKEN.findall(text.lower()):
+        terms.append(token)
+        if _SPLIT.search(token):
+            terms.extend(p for p in _SPLIT.split(token) if p)
+    return terms
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a growing, shrinking set of texts keyed by int64 id.
+
+    Usage:
+        index = BM25Index()
+        index.add(np.array([0, 1]), ["error ECONNREFUSED on boot", "all good"])
+        scores, ids = index.search("econnrefused", top_k=5)
+
+    Ids must be added in increasing order (FAISSStore hands them out that
+    way); a search may be restricted to a subset of them.
+
+    Args:
+        k1: term-frequency saturation
+        b:  document-length normalisation (0 = none, 1 = full)
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+
+        self._vocab: Dict[str, int] = {}
+        self._ids = array("q")             # row → chunk id (increasing)
+        self._lengths = array("I")         # row → token count
+        self._live = bytearray()           # row → 1 if not deleted
+        self.n_live = 0
+        self._live_tokens = 0              # sum of live lengths, for avgdl
+
+        # Merged postings (CSR over term index) ...
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._rows = np.zeros(0, dtype=np.int32)
+        self._tfs = np.zeros(0, dtype=np.uint16)
+        # ... and postings added since the last merge, one entry per (term, row).
+        self._new_terms = array("i")
+        self._new_rows = array("i")
+        self._new_tfs = array("H")
+        self._merge_lock = threading.Lock()   # concurrent searches may merge
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+
+    def add(self, ids: np.ndarray, texts: Sequence[str]) -> None:
+        """Index `texts` under `ids` (increasing, above every stored id)."""
+        if len(ids) != len(texts):
+            raise ValueError(f"{len(ids)} ids for {len(texts)} texts")
+        if len(ids) and self._ids and ids[0] <= self._ids[-1]:
+            raise ValueError("ids must increase across add() calls")
+        vocab = self._vocab
+        for chunk_id, text in zip(ids, texts):
+            row = len(self._ids)
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                term_idx = vocab.get(term)
+                if term_idx is None:
+                    term_idx = vocab[term] = len(vocab)
+                self._new_terms.append(term_idx)
+                self._new_rows.append(row)
+                self._new_tfs.append(min(tf, 0xFFFF))
+            length = sum(counts.values())
+            self._ids.append(int(chunk_id))
+            self._lengths.append(length)
+            self._live.append(1)
+            self.n_live += 1
+            self._live_tokens += length
+
+    def delete(self, ids: np.ndarray) -> int:
+        """Mark `ids` deleted; returns how many were live."""
+        rows = self._row_of(np.asarray(ids, dtype=np.int64))
+        n = 0
+        for row in rows[rows >= 0].tolist():
+            if self._live[row]:
+                self._live[row] = 0
+                self.n_live -= 1
+                self._live_tokens -= self._lengths[row]
+                n += 1
+        return n
+
+    def compact(self) -> None:
+        """Drop deleted rows and their postings; renumber the rest."""
+        self._merge()
+        live = np.frombuffer(self._live, dtype=np.uint8).astype(bool)
+        if live.all():
+            return
+        new_row = np.cumsum(live, dtype=np.int64) - 1
+        keep = live[self._rows]
+        terms = np.repeat(np.arange(len(self._vocab)), np.diff(self._indptr))[keep]
+        self._rows = new_row[self._rows[keep]].astype(np.int32)
+        self._tfs = self._tfs[keep]
+        self._indptr = _indptr(terms, len(self._vocab))
+        self._ids = array("q", np.frombuffer(self._ids, dtype=np.int64)[live].tobytes())
+        self._lengths = array("I", np.frombuffer(self._lengths, dtype=np.uint32)[live].tobytes())
+        self._live = bytearray(b"\x01") * self.n_live
+
+    def _merge(self) -> None:
+        """Fold pending postings into the CSR arrays."""
+        if not self._new_terms and len(self._indptr) == len(self._vocab) + 1:
+            return
+        with self._merge_lock:
+            if self._new_terms or len(self._indptr) != len(self._vocab) + 1:
+                self._merge_pending()
+
+    def _merge_pending(self) -> None:
+        n_terms = len(self._vocab)
+        old_terms = np.repeat(
+            np.arange(len(self._indptr) - 1, dtype=np.int32), np.diff(self._indptr),
+        )
+        terms = np.concatenate([old_terms, np.frombuffer(self._new_terms, dtype=np.int32)])
+        rows = np.concatenate([self._rows, np.frombuffer(self._new_rows, dtype=np.int32)])
+        tfs = np.concatenate([self._tfs, np.frombuffer(self._new_tfs, dtype=np.uint16)])
+        # Stable: within a term, old rows (smaller) stay ahead of new ones.
+        order = np.argsort(terms, kind="stable")
+        self._rows, self._tfs = rows[order], tfs[order]
+        self._indptr = _indptr(terms, n_terms)
+        self._new_terms, self._new_rows, self._new_tfs = array("i"), array("i"), array("H")
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 10,
+        ids: np.ndarray | None = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        BM25 top-k for `query`.
+
+        Args:
+            query: free text, tokenised like the indexed texts
+            top_k: results wanted
+            ids:   only score these chunk ids (e.g. a metadata filter's
+                   matches); None → all
+
+        Returns:
+            (scores, ids), descending by score; only chunks containing at
+            least one query term, so possibly fewer than top_k.
+        """
+        empty = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        terms = [self._vocab[t] for t in dict.fromkeys(tokenize(query)) if t in self._vocab]
+        if not terms or not self.n_live or top_k <= 0:
+            return empty
+        self._merge()
+
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+        live = np.frombuffer(self._live, dtype=np.uint8)
+        has_dead = self.n_live < len(lengths)
+        norm = self.k1 * (1 - self.b + self.b * lengths / (self._live_tokens / self.n_live))
+        all_rows, all_scores = [], []
+        for term in terms:
+            start, stop = self._indptr[term], self._indptr[term + 1]
+            rows = self._rows[start:stop]
+            tfs = self._tfs[start:stop].astype(np.float32)
+            df = int(live[rows].sum()) if has_dead else stop - start
+            idf = math.log(1 + (self.n_live - df + 0.5) / (df + 0.5))
+            all_rows.append(rows)
+            all_scores.append((idf * tfs * (self.k1 + 1) / (tfs + norm[rows])).astype(np.float32))
+
+        rows = np.concatenate(all_rows)
+        scores = np.concatenate(all_scores)
+        if len(terms) > 1:                 # a row may appear once per term
+            if len(rows) > len(lengths) // 8:
+                # Common terms: a dense accumulator beats sorting postings.
+                dense = np.bincount(rows, weights=scores, minlength=len(lengths))
+                rows = np.flatnonzero(dense)
+                scores = dense[rows].astype(np.float32)
+            else:
+                rows, inverse = np.unique(rows, return_inverse=True)
+                scores = np.bincount(inverse, weights=scores).astype(np.float32)
+
+        keep = live[rows].astype(bool)
+        if ids is not None:
+            allowed = self._row_of(np.asarray(ids, dtype=np.int64))
+            keep &= np.isin(rows, allowed[allowed >= 0])
+        rows, scores = rows[keep], scores[keep]
+        if not len(rows):
+            return empty
+
+        k = min(top_k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return scores[top], np.frombuffer(self._ids, dtype=np.int64)[rows[top]]
+
+    def _row_of(self, ids: np.ndarray) -> np.ndarray:
+        """Row of each id, or -1 where the id is unknown."""
+        stored = np.frombuffer(self._ids, dtype=np.int64)
+        if not len(stored):
+            return np.full(len(ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(stored, ids), len(stored) - 1)
+        return np.where(stored[rows] == ids, rows, -1)
+
+    def __len__(self) -> int:
+        return self.n_live
+
+    def nbytes(self) -> int:
+        """Approximate bytes held by postings and per-row columns."""
+        self._merge()
+        return (self._indptr.nbytes + self._rows.nbytes + self._tfs.nbytes
+                + len(self._ids) * 8 + len(self._lengths) * 4 + len(self._live))
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """
+        Write the index into directory `path` (files prefixed "bm25_"):
+            bm25.json           k1, b and the vocabulary in term order
+            bm25_*.npy          indptr, rows, tfs, ids, lengths, live
+        """
+        self._merge()
+        os.makedirs(path, exist_ok=True)
+        columns = {
+            "indptr": self._indptr,
+            "rows": self._rows,
+            "tfs": self._tfs,
+            "ids": np.frombuffer(self._ids, dtype=np.int64),
+            "lengths": np.frombuffer(self._lengths, dtype=np.uint32),
+            "live": np.frombuffer(self._live, dtype=np.uint8),
+        }
+        for name, values in columns.items():
+            tmp = os.path.join(path, f"bm25_{name}.npy.tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp, os.path.join(path, f"bm25_{name}.npy"))
+        tmp = os.path.join(path, "bm25.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocab": list(self._vocab)},
+                      f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, "bm25.json"))
+
+    @classmethod
+    def load(cls, path: str) -> BM25Index:
+        """Read an index written by `save()`."""
+        with open(os.path.join(path, "bm25.json"), encoding="utf-8") as f:
+            header = json.load(f)
+
+        def column(name):
+            return np.load(os.path.join(path, f"bm25_{name}.npy"))
+
+        index = cls(header["k1"], header["b"])
+        index._vocab = {term: i for i, term in enumerate(header["vocab"])}
+        index._indptr = column("indptr")
+        index._rows = column("rows")
+        index._tfs = column("tfs")
+        index._ids = array("q", column("ids").tobytes())
+        index._lengths = array("I", column("lengths").tobytes())
+        live = column("live")
+        index._live = bytearray(live.tobytes())
+        index.n_live = int(live.sum())
+        index._live_tokens = int(np.frombuffer(index._lengths, dtype=np.uint32)[live.astype(bool)]
+                                 .sum(dtype=np.int64))
+        return index
+
+
+def _indptr(terms: np.ndarray, n_terms: int) -> np.ndarray:
+    """CSR row pointer for postings sorted by term index."""
+    indptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=n_terms), out=indptr[1:])
+    return indptr
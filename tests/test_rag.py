@@ -13,6 +13,7 @@ Run:
 
 import os
 import sys
+import time
 
 import numpy as np
 import torch
@@ -21,8 +22,65 @@ import torch.nn.functional as F
 # Make the project root importable when run directly.
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from embedder import _last_token_pool, EMBEDDING_DIM, MAX_SEQ_TOKENS, MODEL_ID
-from rag import Chunk, FAISSStore
+from pyutils.embedders.embedder import (
+    _last_token_pool, _token_budget_batches,
+    EMBEDDING_DIM, MAX_SEQ_TOKENS, MODEL_ID, QwenEmbedder,
+)
+from pyutils.embedders.rag import Chunk, FAISSStore
+
+
+# ---------------------------------------------------------------------------
+# Tiny offline model
+# ---------------------------------------------------------------------------
+
+_TINY_DIR = None
+
+
+def _tiny_model_dir():
+    """
+    Save a 2-layer, randomly initialised Qwen3 model (hidden size 1024, so
+    EMBEDDING_DIM holds) and a word-level tokenizer to a temp dir, once.
+
+    Lets QwenEmbedder run its real code paths without downloading weights.
+    Words are "w0" .. "w499"; anything else maps to <unk>.
+    """
+    global _TINY_DIR
+    if _TINY_DIR is not None:
+        return _TINY_DIR
+
+    import tempfile
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3Model
+
+    vocab = {"<pad>": 0, "<unk>": 1}
+    vocab.update({f"w{i}": i + 2 for i in range(500)})
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tok.decoder = decoders.WordPiece(prefix="##")
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tok, pad_token="<pad>", unk_token="<unk>",
+    )
+
+    config = Qwen3Config(
+        vocab_size=len(vocab), hidden_size=EMBEDDING_DIM, intermediate_size=64,
+        num_hidden_layers=2, num_attention_heads=2, num_key_value_heads=1,
+        head_dim=16, max_position_embeddings=4096,
+    )
+    torch.manual_seed(0)
+    model = Qwen3Model(config)
+
+    _TINY_DIR = tempfile.mkdtemp(prefix="tiny-qwen3-")
+    tokenizer.save_pretrained(_TINY_DIR)
+    model.save_pretrained(_TINY_DIR)
+    return _TINY_DIR
+
+
+def _tiny_embedder(**kwargs):
+    return QwenEmbedder(device="cpu", model_id=_tiny_model_dir(), **kwargs)
+
+
+def _words(n, offset=0):
+    return " ".join(f"w{(offset + i) % 500}" for i in range(n))
 
 
 # ---------------------------------------------------------------------------
@@ -52,6 +110,519 @@ def test_last_token_pool_right_padding():
     assert torch.equal(out[2], hidden[2, 9])
 
 
+# ---------------------------------------------------------------------------
+# Token-budget batching
+# ---------------------------------------------------------------------------
+
+def test_token_budget_batches_respect_budget():
+    """Batches are length-sorted and never exceed the padded-token budget."""
+    lengths = [30, 20_000, 30, 25, 40, 30, 35, 28]
+    batches = _token_budget_batches(lengths, max_tokens=1024, max_count=8)
+
+    assert batches[0] == [1]                        # the long text stands alone
+    assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+    for b in batches[1:]:
+        assert max(lengths[i] for i in b) * len(b) <= 1024
+
+
+def test_token_budget_batches_respect_count():
+    batches = _token_budget_batches([5] * 10, max_tokens=10_000, max_count=4)
+    assert [len(b) for b in batches] == [4, 4, 2]
+
+
+def test_encode_bucketed_matches_one_by_one():
+    """Packing mixed lengths into batches must not change any row or its order."""
+    embedder = _tiny_embedder(batch_size=8, max_batch_tokens=64)
+    texts = [_words(3), _words(120, 7), _words(5, 3), _words(40, 11), _words(1)]
+
+    batched = embedder.encode(texts)
+    single = np.vstack([embedder.encode(t) for t in texts])
+
+    assert batched.shape == (len(texts), EMBEDDING_DIM)
+    assert batched.dtype == np.float32
+    assert np.allclose(batched, single, atol=1e-4)
+    assert np.allclose(np.linalg.norm(batched, axis=1), 1.0, atol=1e-5)
+
+
+# ---------------------------------------------------------------------------
+# Embedding cache
+# ---------------------------------------------------------------------------
+
+def _cache(max_rows=1000, dim=8):
+    import tempfile
+    from pyutils.embedders.cache import EmbeddingCache
+    return EmbeddingCache(tempfile.mkdtemp(prefix="emb-cache-"), dim=dim, max_rows=max_rows)
+
+
+def test_cache_roundtrip_and_persistence():
+    from pyutils.embedders.cache import EmbeddingCache
+    cache = _cache()
+    vecs = _normed(3, 8, seed=3)
+    key = cache.key(MODEL_ID, "doc", chunk_tokens=512)
+    assert cache.get(key) is None
+
+    cache.put(key, vecs, ["a", "b", "c"])
+    texts, got = cache.get(key)
+    assert texts == ["a", "b", "c"]
+    assert np.array_equal(got, vecs)
+
+    reopened = EmbeddingCache(cache.path, dim=8)
+    assert np.array_equal(reopened.get(key)[1], vecs)
+
+
+def test_cache_key_covers_every_input():
+    base = dict(model_id=MODEL_ID, text="t", is_query=True, task="x", chunk_tokens=None)
+    key = _cache().key(**base)
+    for field, value in [("model_id", "other"), ("text", "t2"), ("is_query", False),
+                         ("task", "y"), ("chunk_tokens", 256)]:
+        assert _cache().key(**{**base, field: value}) != key, field
+
+
+def test_cache_lru_eviction_and_compaction():
+    """Least recently used entries go first; dead rows are reclaimed on disk."""
+    cache = _cache(max_rows=4)
+    for i in range(4):
+        cache.put(f"k{i}", _normed(1, 8, seed=i))
+    cache.get("k0")                                  # k0 is now most recent
+    cache.put("k4", _normed(1, 8, seed=4))
+
+    assert cache.get("k1") is None                   # oldest, evicted
+    assert cache.get("k0") is not None
+    assert cache.n_rows == 4
+
+    for i in range(5, 2000):
+        cache.put(f"k{i}", _normed(1, 8, seed=i))
+    assert len(cache) == 4
+    file_rows = os.path.getsize(os.path.join(cache.path, "vectors.f32")) // (4 * 8)
+    assert file_rows < 2000                          # compacted, not append-only
+    assert np.array_equal(cache.get("k1999")[1], _normed(1, 8, seed=1999))
+
+
+def test_cache_compaction_survives_interrupted_rename():
+    from pyutils.embedders.cache import EmbeddingCache
+    cache = _cache(max_rows=4)
+    replace = os.replace
+
+    def crash(src, dst):
+        raise OSError("crashed before the rename")
+
+    os.replace = crash
+    try:
+        for i in range(2000):
+            cache.put(f"k{i}", _normed(1, 8, seed=i))
+        assert False, "expected the compaction to fail"
+    except OSError:
+        last = i
+    finally:
+        os.replace = replace
+
+    reopened = EmbeddingCache(cache.path, dim=8)     # finishes the rename
+    for i in range(last - 3, last + 1):
+        assert np.array_equal(reopened.get(f"k{i}")[1], _normed(1, 8, seed=i))
+        assert np.array_equal(cache.get(f"k{i}")[1], _normed(1, 8, seed=i))
+
+    stale = os.path.join(cache.path, "vectors.f32.tmp")
+    open(stale, "wb").close()                        # offsets never committed
+    EmbeddingCache(cache.path, dim=8)
+    assert not os.path.exists(stale)
+
+
+def test_embedder_cache_skips_model_on_hits():
+    embedder = _tiny_embedder(cache=_cache(dim=EMBEDDING_DIM))
+    embedder.warmup()
+    calls = []
+    model = embedder._model
+    embedder._model = lambda **kw: calls.append(kw["input_ids"].shape) or model(**kw)
+
+    docs = [_words(40), _words(20, 3)]
+    first = embedder.encode_documents(docs, chunk_tokens=16)
+    q1 = embedder.encode(["w1 w2", "w3"], is_query=True)
+    n_calls = len(calls)
+
+    again = embedder.encode_documents(docs + [_words(5, 9)], chunk_tokens=16)
+    q2 = embedder.encode(["w3", "w1 w2"], is_query=True)
+    single = embedder.encode_document(docs[1], chunk_tokens=16)
+
+    assert len(calls) == n_calls + 1                 # only the new document ran
+    for (t1, v1), (t2, v2) in zip(first, again):
+        assert t1 == t2 and np.array_equal(v1, v2)
+    assert np.array_equal(q2, q1[::-1])
+    assert single[0] == first[1][0]
+
+
+# ---------------------------------------------------------------------------
+# Matryoshka output dimension
+# ---------------------------------------------------------------------------
+
+def test_output_dim_truncates_and_renormalises():
+    full = _tiny_embedder()
+    small = _tiny_embedder(output_dim=256)
+    texts = [_words(12), _words(30, 4)]
+
+    want = full.encode(texts)[:, :256]
+    want /= np.linalg.norm(want, axis=1, keepdims=True)
+    got = small.encode(texts)
+    assert small.dim == 256 and got.shape == (2, 256)
+    assert np.allclose(got, want, atol=1e-5)
+
+    _, vecs = small.encode_documents([_words(50)], chunk_tokens=16)[0]
+    assert vecs.shape == (4, 256)
+    assert np.allclose(np.linalg.norm(vecs, axis=1), 1.0, atol=1e-5)
+    assert small.encode_document("", chunk_tokens=16)[1].shape == (0, 256)
+
+
+def test_output_dim_bounds():
+    for bad in (16, 2048):
+        try:
+            _tiny_embedder(output_dim=bad)
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+
+
+def test_pipeline_threads_output_dim_to_store():
+    from pyutils.embedders.rag import RAGPipeline
+    rag = RAGPipeline(embedder=_tiny_embedder(output_dim=256), chunk_tokens=16)
+    assert rag.store.dim == 256
+    rag.index([_words(40)])
+    assert rag.query(_words(5), top_k=1)[0]["doc_id"] == "doc_0"
+
+    try:
+        RAGPipeline(embedder=_StubEmbedder(), store=FAISSStore(dim=128))
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_mrl_recall_reports_each_dim():
+    """
+    On vectors whose variance decays along the dimensions (the shape MRL
+    training produces), a 256-d prefix keeps most of the top-10, and the
+    full-dim row is exact by construction.
+    """
+    from pyutils.embedders.bench import mrl_recall
+    rng = np.random.RandomState(0)
+    scale = np.exp(-np.arange(EMBEDDING_DIM) / 64.0).astype(np.float32)
+    docs = rng.randn(2000, EMBEDDING_DIM).astype(np.float32) * scale
+    docs /= np.linalg.norm(docs, axis=1, keepdims=True)
+    queries = docs[:50] + 0.05 * rng.randn(50, EMBEDDING_DIM).astype(np.float32) * scale
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    rows = {r["dim"]: r for r in mrl_recall(docs, queries, dims=(64, 256), k=10)}
+    assert rows[EMBEDDING_DIM]["recall"] == 1.0
+    assert rows[256]["recall"] >= 0.9
+    assert rows[64]["recall"] <= rows[256]["recall"]
+    assert rows[256]["bytes_per_vector"] * 4 == rows[EMBEDDING_DIM]["bytes_per_vector"]
+
+
+# ---------------------------------------------------------------------------
+# CPU backends
+# ---------------------------------------------------------------------------
+
+def _backend_parity(backend, **kwargs):
+    texts = [_words(8), _words(60, 3), _words(25, 9)]
+    docs = [_words(70, 1)]
+    ref = _tiny_embedder()
+    other = _tiny_embedder(backend=backend, **kwargs)
+
+    cos = (ref.encode(texts) * other.encode(texts)).sum(axis=1)
+    ref_doc = ref.encode_documents(docs, chunk_tokens=16)[0]
+    got_doc = other.encode_documents(docs, chunk_tokens=16)[0]
+    assert got_doc[0] == ref_doc[0]
+    doc_cos = (ref_doc[1] * got_doc[1]).sum(axis=1)
+    return np.concatenate([cos, doc_cos])
+
+
+def test_int8_backend_agrees_with_fp32():
+    cos = _backend_parity("int8")
+    assert cos.min() > 0.99, cos
+
+
+def test_onnx_backend_agrees_with_fp32():
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        return                                  # optional dependency
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(prefix="onnx-"), "tiny.onnx")
+    cos = _backend_parity("onnx", onnx_path=path)
+    assert cos.min() > 0.9999, cos
+    assert os.path.exists(path)
+
+
+def test_backend_guards():
+    for kwargs in ({"backend": "tensorrt"}, {"backend": "int8", "device": "cuda"}):
+        try:
+            QwenEmbedder(model_id=_tiny_model_dir(), **kwargs)
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+
+
+def test_backend_throughput_rows():
+    from pyutils.embedders.bench import backend_throughput
+    rows = backend_throughput(
+        [_words(30, i) for i in range(8)], backends=("torch", "int8"),
+        repeats=1, model_id=_tiny_model_dir(),
+    )
+    assert [r["backend"] for r in rows] == ["torch", "int8"]
+    assert rows[0]["speedup"] == 1.0 and rows[0]["cos_min"] > 0.9999
+    assert all(r["texts_per_sec"] > 0 for r in rows)
+
+
+# ---------------------------------------------------------------------------
+# Lazy loading
+# ---------------------------------------------------------------------------
+
+def test_import_does_not_load_torch():
+    """Importing the embedder (or the package) must not pull in torch or transformers."""
+    import subprocess
+    from pyutils.embedders import embedder
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(embedder.__file__))))
+    code = (
+        "import sys, pyutils.embedders, pyutils.embedders.embedder, pyutils.embedders.cache; "
+        "heavy = {'torch', 'transformers', 'faiss'} & set(sys.modules); "
+        "assert not heavy, heavy"
+    )
+    env = dict(os.environ, PYTHONPATH=root)
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+
+def test_package_exports_resolve():
+    import pyutils.embedders as package
+    for name, module in package._EXPORTS.items():
+        value = getattr(package, name)
+        assert value.__name__ == name
+        assert value.__module__ == "pyutils.embedders" + module
+
+
+def test_weights_load_on_first_use():
+    embedder = _tiny_embedder()
+    assert not embedder.loaded
+    assert embedder.dim == EMBEDDING_DIM          # no load needed
+    embedder.encode("w1 w2")
+    assert embedder.loaded
+
+
+def test_warmup_loads_weights():
+    embedder = _tiny_embedder()
+    embedder.warmup()
+    assert embedder.loaded
+
+
+# ---------------------------------------------------------------------------
+# Multi-process pool
+# ---------------------------------------------------------------------------
+
+def test_pool_shards_and_restores_order():
+    from pyutils.embedders.pool import _shard
+    lengths = [5, 100, 7, 60, 3, 40]
+    shards = _shard(lengths, 3)
+    assert sorted(i for s in shards for i in s) == list(range(6))
+    assert all(s == sorted(s) for s in shards)
+    assert len(_shard([1, 2], 8)) == 2                # no empty shards
+
+
+def test_pool_matches_single_process():
+    from pyutils.embedders.pool import EmbedderPool
+    single = _tiny_embedder()
+    texts = [_words(n, n) for n in (3, 50, 8, 120, 1, 33, 17)]
+    docs = [_words(70), "", _words(20, 5), _words(45, 9)]
+
+    with EmbedderPool(n_workers=2, threads_per_worker=1, model_id=_tiny_model_dir()) as pool:
+        vecs = pool.encode(texts, is_query=True)
+        chunked = pool.encode_documents(docs, chunk_tokens=16)
+        one = pool.encode_document(docs[3], chunk_tokens=16)
+        assert pool.dim == EMBEDDING_DIM
+
+    assert np.allclose(vecs, single.encode(texts, is_query=True), atol=1e-4)
+    for (t, v), (want_t, want_v) in zip(chunked, single.encode_documents(docs, chunk_tokens=16)):
+        assert t == want_t and v.shape == want_v.shape
+        assert np.allclose(v, want_v, atol=1e-4)
+    assert one[0] == chunked[3][0] and np.allclose(one[1], chunked[3][1], atol=1e-5)
+
+
+def test_pool_raises_when_a_worker_dies_mid_call():
+    import threading
+    from pyutils.embedders.pool import EmbedderPool
+    pool = EmbedderPool(n_workers=2, threads_per_worker=1, model_id=_tiny_model_dir())
+    docs = [_words(200, i) for i in range(40)]
+    threading.Timer(1.0, pool._workers[0].kill).start()   # while loading / encoding
+    start = time.perf_counter()
+    try:
+        for _ in range(20):
+            pool.encode_documents(docs, chunk_tokens=16)
+        assert False, "expected RuntimeError"
+    except RuntimeError as e:
+        assert "worker 0 died" in str(e)
+    assert time.perf_counter() - start < 60
+    assert pool._workers is None                          # closed
+
+
+# ---------------------------------------------------------------------------
+# Async micro-batching
+# ---------------------------------------------------------------------------
+
+class _RecordingEmbedder:
+    """Per-text deterministic vectors; records every encode() batch."""
+    dim = 64
+
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, texts, is_query=False, task="default"):
+        if isinstance(texts, str):
+            texts = [texts]
+        self.batches.append((list(texts), task))
+        rows = [_normed(1, self.dim, seed=sum(map(ord, t + task)))[0] for t in texts]
+        return np.vstack(rows)
+
+
+def test_microbatcher_merges_concurrent_queries():
+    import asyncio
+    from pyutils.embedders.microbatch import QueryMicrobatcher
+    embedder = _RecordingEmbedder()
+    texts = [f"q{i}" for i in range(20)]
+
+    async def main():
+        async with QueryMicrobatcher(embedder, max_batch=8, max_wait_ms=50) as batcher:
+            return await asyncio.gather(*(batcher.encode(t) for t in texts)), batcher
+
+    vecs, batcher = asyncio.run(main())
+    assert [len(b) for b, _ in embedder.batches] == [8, 8, 4]
+    assert batcher.mean_batch_size == 20 / 3
+    for t, v in zip(texts, vecs):
+        assert np.array_equal(v, embedder.encode([t])[0])
+
+
+def test_microbatcher_splits_by_task_and_propagates_errors():
+    import asyncio
+    from pyutils.embedders.microbatch import QueryMicrobatcher
+    embedder = _RecordingEmbedder()
+
+    async def main():
+        async with QueryMicrobatcher(embedder, max_wait_ms=20) as batcher:
+            await asyncio.gather(
+                batcher.encode("x", task="t1"), batcher.encode("y", task="t2"),
+                batcher.encode("z", task="t1"),
+            )
+            embedder.encode = lambda *a: 1 / 0
+            try:
+                await batcher.encode("boom")
+                assert False, "expected ZeroDivisionError"
+            except ZeroDivisionError:
+                pass
+
+    asyncio.run(main())
+    assert sorted((tuple(t), task) for t, task in embedder.batches) == [
+        (("x", "z"), "t1"), (("y",), "t2"),
+    ]
+
+
+def test_microbatcher_close_cancels_running_batch():
+    import asyncio
+    import threading
+    from pyutils.embedders.microbatch import QueryMicrobatcher
+    embedder = _RecordingEmbedder()
+    started, release = threading.Event(), threading.Event()
+    encode = embedder.encode
+    embedder.encode = lambda *a: (started.set(), release.wait(5), encode(*a))[2]
+
+    async def main():
+        batcher = QueryMicrobatcher(embedder, max_wait_ms=1)
+        running = asyncio.ensure_future(batcher.encode("slow"))
+        while not started.is_set():
+            await asyncio.sleep(0.001)
+        await batcher.close()
+        release.set()
+        try:
+            await asyncio.wait_for(running, 1)
+            assert False, "expected CancelledError"
+        except asyncio.CancelledError:
+            pass
+        try:
+            await batcher.encode("late")
+            assert False, "expected RuntimeError"
+        except RuntimeError:
+            pass
+
+    asyncio.run(main())
+
+
+def test_microbatcher_moves_to_a_new_event_loop():
+    import asyncio
+    from pyutils.embedders.microbatch import QueryMicrobatcher
+    embedder = _RecordingEmbedder()
+    batcher = QueryMicrobatcher(embedder, max_wait_ms=1)
+
+    first = asyncio.new_event_loop()                 # left open, runner pending
+    try:
+        a = first.run_until_complete(batcher.encode("a"))
+        stale = batcher._runner
+        b = asyncio.run(asyncio.wait_for(batcher.encode("b"), 5))
+    finally:
+        stale.cancel()
+        first.run_until_complete(asyncio.gather(stale, return_exceptions=True))
+        first.close()
+    assert np.array_equal(a, embedder.encode(["a"])[0])
+    assert np.array_equal(b, embedder.encode(["b"])[0])
+
+
+def test_pipeline_aquery_matches_query():
+    import asyncio
+    from pyutils.embedders.rag import RAGPipeline
+    rag = RAGPipeline(embedder=_RecordingEmbedder())
+    rag.store.add([Chunk(f"c{i}", "d", i) for i in range(30)], _normed(30, 64, seed=4))
+
+    async def main():
+        results = await asyncio.gather(*(rag.aquery(f"q{i}", top_k=3) for i in range(5)))
+        batcher = rag._batcher
+        await rag.aclose()
+        return results, batcher
+
+    results, batcher = asyncio.run(main())
+    for i, got in enumerate(results):
+        assert got == rag.query(f"q{i}", top_k=3)
+    assert batcher._closed and rag._batcher is None
+
+
+# ---------------------------------------------------------------------------
+# Query cache
+# ---------------------------------------------------------------------------
+
+def test_query_cache_hits_skip_the_model():
+    from pyutils.embedders.rag import RAGPipeline
+    embedder = _RecordingEmbedder()
+    rag = RAGPipeline(embedder=embedder, query_cache_size=2)
+    rag.store.add([Chunk(f"c{i}", "d", i) for i in range(10)], _normed(10, 64, seed=4))
+
+    first = rag.query("a")
+    assert rag.query("a") == first
+    assert len(embedder.batches) == 1
+    assert (rag.query_cache.hits, rag.query_cache.misses) == (1, 1)
+
+    rag.query("b")
+    rag.query("c")                                   # evicts "a" (size 2)
+    rag.query("a")
+    assert len(embedder.batches) == 4
+
+    rag.task = "other task"                          # key includes the task
+    rag.query("a")
+    assert len(embedder.batches) == 5
+
+
+def test_query_cache_ttl_and_disable():
+    from pyutils.embedders.rag import QueryCache
+    cache = QueryCache(max_size=4, ttl=0.0)
+    cache.put("q", "t", np.ones(3, np.float32))
+    time.sleep(0.01)
+    assert cache.get("q", "t") is None
+
+    off = QueryCache(max_size=0)
+    off.put("q", "t", np.ones(3, np.float32))
+    assert off.get("q", "t") is None and len(off) == 0
+
+
 # ---------------------------------------------------------------------------
 # L2 normalisation identity
 # ---------------------------------------------------------------------------
@@ -96,6 +667,84 @@ def test_late_chunk_windowing_and_last_token():
     assert torch.allclose(norms, torch.ones(expected_chunks), atol=1e-5)
 
 
+def test_stream_single_window_matches_encode_document():
+    """A document that fits one window streams exactly like encode_document."""
+    embedder = _tiny_embedder()
+    doc = _words(100)
+    texts, vecs = embedder.encode_document(doc, chunk_tokens=16)
+
+    windows = list(embedder.encode_document_stream(doc, chunk_tokens=16))
+    assert len(windows) == 1
+    assert windows[0][0] == texts
+    assert np.allclose(windows[0][1], vecs, atol=1e-5)
+
+
+def test_stream_covers_whole_document():
+    """
+    Past the window limit, every token lands in exactly one chunk, and the
+    carry-over prefix gives each later window the text just before it.
+    """
+    embedder = _tiny_embedder()
+    doc = _words(300)
+    windows = list(embedder.encode_document_stream(
+        doc, chunk_tokens=16, context_tokens=32, window_tokens=128,
+    ))
+
+    # First window: 128 tokens; later windows: (128 - 32) // 16 * 16 = 96.
+    assert [len(t) for t, _ in windows] == [8, 6, 5]
+    texts = [t for w, _ in windows for t in w]
+    assert " ".join(texts) == doc
+    for _, vecs in windows:
+        assert vecs.shape[1] == EMBEDDING_DIM
+        assert np.allclose(np.linalg.norm(vecs, axis=1), 1.0, atol=1e-5)
+
+    # A chunk in window 2 equals a single pass over [prefix + itself].
+    prefix_and_chunk = embedder.encode_document(
+        _words(32 + 16, offset=128 - 32), chunk_tokens=48,
+    )[1][0]
+    assert np.allclose(windows[1][1][0], prefix_and_chunk, atol=1e-4)
+
+
+def test_encode_documents_matches_encode_document():
+    """
+    Packing documents of different lengths into one padded pass must give
+    every document the same chunks it gets alone.
+    """
+    embedder = _tiny_embedder(max_batch_tokens=4096)
+    docs = [_words(70), _words(200, 5), "", _words(33, 9), _words(128, 2)]
+
+    batched = embedder.encode_documents(docs, chunk_tokens=32)
+
+    assert len(batched) == len(docs)
+    assert batched[2][0] == [] and batched[2][1].shape == (0, EMBEDDING_DIM)
+    for doc, (texts, vecs) in zip(docs, batched):
+        want_texts, want_vecs = embedder.encode_document(doc, chunk_tokens=32)
+        assert texts == want_texts
+        assert np.allclose(vecs, want_vecs, atol=1e-4)
+
+
+def test_pipeline_index_assigns_chunk_ids():
+    from pyutils.embedders.rag import RAGPipeline
+    rag = RAGPipeline(embedder=_tiny_embedder(), chunk_tokens=16)
+    rag.index([_words(40), "   ", _words(10, 3)], doc_ids=["a", "blank", "b"])
+
+    rows = [rag.store._chunks[i] for i in range(len(rag))]
+    assert [(c.doc_id, c.chunk_idx) for c in rows] == [
+        ("a", 0), ("a", 1), ("a", 2), ("b", 0),
+    ]
+
+
+def test_stream_rejects_prefix_filling_window():
+    embedder = _tiny_embedder()
+    try:
+        list(embedder.encode_document_stream(
+            _words(10), chunk_tokens=16, context_tokens=120, window_tokens=128,
+        ))
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
 def test_matched_pooling_gives_identical_vectors():
     """
     The bug we fixed: query (last-token) vs document (mean) put vectors in
@@ -139,6 +788,31 @@ def test_faiss_exact_search_matches_numpy():
     assert scores == sorted(scores, reverse=True)
 
 
+def test_faiss_search_batch_matches_single_searches():
+    vecs = _normed(200, 64, seed=8)
+    store = FAISSStore(dim=64)
+    store.add([Chunk(f"c_{i}", "d", i) for i in range(200)], vecs)
+    queries = _normed(7, 64, seed=9)
+
+    batched = store.search_batch(queries, top_k=4)
+    assert batched == [store.search(q, top_k=4) for q in queries]
+    assert all(isinstance(r["score"], float) for r in batched[0])
+    assert FAISSStore(dim=64).search_batch(queries) == [[]] * 7
+
+
+def test_pipeline_query_batch_encodes_once():
+    from pyutils.embedders.rag import RAGPipeline
+    embedder = _RecordingEmbedder()
+    rag = RAGPipeline(embedder=embedder)
+    rag.store.add([Chunk(f"c{i}", "d", i) for i in range(50)], _normed(50, 64, seed=4))
+    rag.query("q1")                                  # now cached
+    embedder.batches.clear()
+
+    got = rag.query_batch(["q0", "q1", "q2"], top_k=3)
+    assert [b for b, _ in embedder.batches] == [["q0", "q2"]]
+    assert got == [rag.query(q, top_k=3) for q in ("q0", "q1", "q2")]
+
+
 def test_faiss_incremental_add():
     """Adding in batches preserves correct indexing across batches."""
     dim = EMBEDDING_DIM
@@ -191,7 +865,7 @@ def test_all_index_types_find_self():
     A stored vector is its own nearest neighbour. Exact and graph indexes put
     it at rank 1; the lossy compressed index should keep it within the top 5.
     """
-    for index_type in ("flat", "ivf", "hnsw"):
+    for index_type in ("flat", "ivf", "hnsw", "sq8", "binary", "binary_hnsw"):
         store, vecs = _approx_store(index_type)
         top = store.search(vecs[123], top_k=5)
         assert top[0]["text"] == "c_123", f"{index_type}: expected rank-1 self"
@@ -227,6 +901,46 @@ def test_approximate_recall_matches_flat():
         assert recall >= 0.9, f"{store.index_type}: recall {recall:.2f} < 0.90"
 
 
+def test_quantised_indexes_return_cosine_scores():
+    """
+    sq8 and binary trade a little recall for memory; binary re-scores its
+    Hamming candidates, so scores are cosines and widen with oversampling.
+    """
+    import faiss
+    flat, vecs = _approx_store("flat")
+    queries = _normed(20, _APX_DIM, seed=99)
+    truth = [{r["text"] for r in flat.search(q, top_k=10)} for q in queries]
+
+    def recall(store):
+        return sum(len(truth[i] & {r["text"] for r in store.search(q, top_k=10)})
+                   for i, q in enumerate(queries)) / (len(queries) * 10)
+
+    sq8, _ = _approx_store("sq8")
+    assert recall(sq8) >= 0.9
+    hit = sq8.search(queries[0], top_k=1)[0]
+    assert abs(hit["score"] - float(vecs[int(hit["text"][2:])] @ queries[0])) < 0.02
+
+    recalls = []
+    for oversample in (1, 300):
+        store = FAISSStore(dim=_APX_DIM, index_type="binary", binary_oversample=oversample,
+                           binary_rescore="fp16")
+        store.add([Chunk(f"c_{i}", "d", i) for i in range(_APX_N)], vecs)
+        recalls.append(recall(store))
+        hits = store.search(queries[0], top_k=10)
+        cosines = [float(vecs[int(h["text"][2:])] @ queries[0]) for h in hits]
+        np.testing.assert_allclose([h["score"] for h in hits], cosines, atol=1e-3)
+        assert cosines == sorted(cosines, reverse=True)
+    assert recalls[0] < recalls[1] == 1.0
+    assert store._index.nbytes() < 0.6 * len(faiss.serialize_index(flat._index))
+
+    for bad in (dict(dim=60, index_type="binary"), dict(dim=64, binary_rescore="sq2")):
+        try:
+            FAISSStore(**bad)
+            assert False, f"expected ValueError for {bad}"
+        except ValueError:
+            pass
+
+
 def test_lazy_build_then_explicit_build_is_idempotent():
     """Index builds on first search; an explicit build() is safe to repeat."""
     store, vecs = _approx_store("ivf")
@@ -247,6 +961,969 @@ def test_post_build_add_goes_live():
     assert store.search(extra[10], top_k=1)[0]["text"] == "x_10"
 
 
+# ---------------------------------------------------------------------------
+# Chunk table
+# ---------------------------------------------------------------------------
+
+def test_chunk_table_roundtrips_rows():
+    from pyutils.embedders.rag import ChunkTable
+    shared = {"source": "wiki"}
+    chunks = [Chunk(f"tëxt {i}", f"d{i // 3}", i % 3, shared) for i in range(9)]
+    chunks.append(Chunk("", "d9", 0, {"source": "wiki"}))   # equal, not identical
+    table = ChunkTable()
+    table.append(chunks[:4])
+    table.append(chunks[4:])
+
+    assert len(table) == 10
+    assert [table[i] for i in range(10)] == chunks
+    assert table[-1] == chunks[-1]
+    assert table.text(4) == "tëxt 4" and table.doc_id(4) == "d1"
+    assert len(table._metas) == 1 and len(table._doc_ids) == 4
+    try:
+        table[10]
+        assert False, "expected IndexError"
+    except IndexError:
+        pass
+
+
+def test_chunk_table_keeps_non_json_metadata():
+    from pyutils.embedders.rag import ChunkTable
+    table = ChunkTable()
+    table.append([Chunk("a", "d", 0, {"when": object}), Chunk("b", "d", 1, {"when": int})])
+    assert table.metadata(0) == {"when": object}
+    assert table.metadata(1) == {"when": int}
+
+
+def test_chunk_memory_benchmark_rows():
+    from pyutils.embedders.bench import chunk_memory
+    rows = chunk_memory(n_chunks=2000, chunks_per_doc=10, text_chars=100)
+    by_name = {r["storage"]: r for r in rows}
+    assert by_name["ChunkTable"]["bytes_per_chunk"] < by_name["List[Chunk]"]["bytes_per_chunk"]
+
+
+# ---------------------------------------------------------------------------
+# Deletion and upsert
+# ---------------------------------------------------------------------------
+
+def _doc_store(index_type, n_docs=300, per_doc=10):
+    """Store of n_docs documents "d<i>", per_doc chunks each."""
+    kw = dict(dim=_APX_DIM, index_type=index_type)
+    if index_type == "ivfpq":
+        kw.update(pq_m=8, pq_nbits=4)
+    store = FAISSStore(**kw)
+    vecs = _normed(n_docs * per_doc, _APX_DIM, seed=21)
+    for d in range(n_docs):
+        rows = slice(d * per_doc, (d + 1) * per_doc)
+        store.add([Chunk(f"d{d}_{j}", f"d{d}", j) for j in range(per_doc)], vecs[rows])
+    return store, vecs
+
+
+def test_delete_removes_document_from_results():
+    for index_type in ("flat", "ivf", "hnsw", "ivfpq", "sq8", "binary", "binary_hnsw"):
+        store, vecs = _doc_store(index_type)
+        store.build()
+        assert store.delete("d5") == 10
+        assert store.delete("d5") == 0                       # already gone
+        assert len(store) == 2990
+        for q in vecs[50:60]:
+            hits = store.search(q, top_k=20)
+            assert len(hits) == 20, index_type
+            assert all(h["doc_id"] != "d5" for h in hits), index_type
+        tombstones = 10 if index_type in ("hnsw", "binary_hnsw") else 0
+        assert store._n_tombstones == tombstones
+        assert store._index.ntotal == 2990 + tombstones
+
+
+def test_delete_before_build_and_upsert():
+    store, vecs = _doc_store("flat", n_docs=5)
+    store.delete("d1")
+    new = _normed(2, _APX_DIM, seed=22)
+    ids = store.upsert("d3", [Chunk("new0", "d3", 0), Chunk("new1", "d3", 1)], new)
+    assert list(ids) == [50, 51]                            # ids never reused
+    assert len(store) == 32
+    assert store.search(new[1], top_k=1)[0]["text"] == "new1"
+    assert {h["doc_id"] for h in store.search(vecs[15], top_k=50)} == {"d0", "d2", "d3", "d4"}
+    hits = store.search(new[0], top_k=50)
+    assert sorted(h["text"] for h in hits if h["doc_id"] == "d3") == ["new0", "new1"]
+    try:
+        store.upsert("d3", [Chunk("x", "d4", 0)], new[:1])
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_compact_drops_tombstones_and_dead_rows():
+    store, vecs = _doc_store("hnsw")
+    store.build()
+    for d in range(0, 300, 3):
+        store.delete(f"d{d}")
+    before = [store.search(q, top_k=5) for q in vecs[::97]]
+    store.compact()
+    assert store._n_tombstones == 0 and store._index.ntotal == 2000
+    assert len(store._chunks) == 2000
+    assert [store.search(q, top_k=5) for q in vecs[::97]] == before
+    store.delete("d1")                                      # runs still valid
+    assert len(store) == 1990
+
+
+def test_deletions_survive_save_load():
+    store, vecs = _doc_store("hnsw", n_docs=20)
+    store.build()
+    store.delete("d4")
+    path = _tmp_dir("faiss-store-")
+    store.save(path)
+    loaded = FAISSStore.load(path)
+    assert len(loaded) == 190 and loaded._n_tombstones == 10
+    assert loaded.search(vecs[42], top_k=5) == store.search(vecs[42], top_k=5)
+    assert loaded.delete("d7") == 10
+    assert loaded.add([Chunk("z", "z", 0)], vecs[:1])[0] == 200
+
+
+def test_pipeline_upsert_and_delete():
+    from pyutils.embedders.rag import RAGPipeline
+    rag = RAGPipeline(embedder=_StubEmbedder())
+    rag.index(["alpha", "beta"], doc_ids=["a", "b"])
+    rag.upsert("a", "alpha v2", {"rev": 2})
+    texts = {h["text"]: h["metadata"] for h in rag.query("q", top_k=10)}
+    assert texts == {"alpha v2": {"rev": 2}, "beta": {}}
+    assert rag.delete("b") == 1 and len(rag) == 1
+
+
+# ---------------------------------------------------------------------------
+# Filtered search
+# ---------------------------------------------------------------------------
+
+def _tagged_store(index_type, filter_scan_max):
+    """3000 chunks over 300 docs; metadata lang ∈ {en, fr, de}, tags lists."""
+    kw = dict(dim=_APX_DIM, index_type=index_type, filter_scan_max=filter_scan_max)
+    if index_type == "ivfpq":
+        kw.update(pq_m=8, pq_nbits=4)
+    store = FAISSStore(**kw)
+    vecs = _normed(3000, _APX_DIM, seed=31)
+    for d in range(300):
+        meta = {"lang": ["en", "fr", "de"][d % 3], "tags": [f"t{d % 7}", "all"]}
+        store.add([Chunk(f"d{d}_{j}", f"d{d}", j, meta) for j in range(10)],
+                  vecs[d * 10 : (d + 1) * 10])
+    return store, vecs
+
+
+def test_chunk_table_select():
+    store, _ = _tagged_store("flat", 0)
+    table = store._chunks
+    assert len(table.select({"lang": "en"})) == 1000
+    assert len(table.select({"lang": ["en", "fr"], "tags": "t0"})) == 290
+    assert list(table.select({"doc_id": "d4"})) == list(range(40, 50))
+    assert len(table.select({"lang": "xx"})) == 0
+    store.delete("d0")
+    assert len(table.select({"lang": "en"})) == 990
+
+
+def test_filtered_search_matches_filtered_exact():
+    """Selector path and scan path both return only, and exactly, matches."""
+    queries = _normed(4, _APX_DIM, seed=32)
+    where = {"lang": "fr", "tags": ["t1", "t2"]}
+    flat_all, vecs = _tagged_store("flat", 0)
+    allowed = {f"d{d}" for d in range(300) if d % 3 == 1 and d % 7 in (1, 2)}
+    want = []
+    for q in queries:
+        ranked = [h for h in flat_all.search(q, top_k=3000) if h["doc_id"] in allowed]
+        want.append([h["text"] for h in ranked[:10]])
+
+    for index_type in ("flat", "ivf", "hnsw", "ivfpq", "sq8", "binary", "binary_hnsw"):
+        for scan_max in (0, 10_000):                 # selector, then scan
+            store, _ = _tagged_store(index_type, scan_max)
+            got = store.search_batch(queries, top_k=10, filter=where)
+            for hits, expected in zip(got, want):
+                assert all(h["doc_id"] in allowed for h in hits), index_type
+                # Flat search and scans of stored floats are exact; codes are not.
+                if index_type == "flat" or (scan_max and index_type in ("ivf", "hnsw")):
+                    assert [h["text"] for h in hits] == expected, (index_type, scan_max)
+
+
+def test_filtered_search_edge_cases():
+    store, vecs = _tagged_store("hnsw", 100)
+    assert store.search(vecs[0], top_k=5, filter={"lang": "xx"}) == []
+    hits = store.search(vecs[0], top_k=50, filter={"doc_id": "d0"})
+    assert len(hits) == 10                                # fewer than top_k exist
+    store.delete("d0")
+    assert store.search(vecs[0], top_k=5, filter={"doc_id": "d0"}) == []
+
+
+def test_pipeline_query_filter():
+    from pyutils.embedders.rag import RAGPipeline
+    rag = RAGPipeline(embedder=_StubEmbedder())
+    rag.index(["a", "b", "c"], metadatas=[{"k": 1}, {"k": 2}, {"k": 1}])
+    assert {h["text"] for h in rag.query("q", top_k=5, filter={"k": 1})} == {"a", "c"}
+    assert [len(r) for r in rag.query_batch(["q", "r"], filter={"k": 2})] == [1, 1]
+
+
+# ---------------------------------------------------------------------------
+# Auto index type and background rebuild
+# ---------------------------------------------------------------------------
+
+def test_auto_chooses_by_size_and_budget():
+    store = FAISSStore(dim=64, index_type="auto")
+    assert store._choose_type(10_000) == "flat"
+    assert store._choose_type(500_000) == "hnsw"
+    assert store._choose_type(5_000_000) == "ivf"
+    store.memory_budget = 500_000 * 200                 # too small for hnsw/ivf
+    assert store._choose_type(500_000) == "ivfpq"
+    store.memory_budget = 10_000 * 300
+    assert store._choose_type(10_000) == "flat"
+
+
+def test_auto_store_upgrades_in_background():
+    store = FAISSStore(dim=_APX_DIM, index_type="auto")
+    store.AUTO_FLAT_MAX = 1000
+    vecs = _normed(1500, _APX_DIM, seed=41)
+    store.add([Chunk(f"c{i}", "d", i) for i in range(800)], vecs[:800])
+    store.build()
+    assert store.index_type == "flat"
+    store.add([Chunk(f"c{i}", "d", i) for i in range(800, 1500)], vecs[800:])
+    assert store.wait_for_rebuild(timeout=60)
+    assert store.index_type == "hnsw" and store._index.ntotal == 1500
+    assert store.search(vecs[1234], top_k=1)[0]["text"] == "c1234"
+
+
+def test_rebuild_replays_writes_and_never_blocks_search():
+    import threading
+    store, vecs = _doc_store("flat", n_docs=100)
+    store.build()
+    gate = threading.Event()
+    make_index = store._make_index
+
+    def slow_make_index(*args):                        # hold the rebuild thread
+        gate.wait(timeout=30)
+        return make_index(*args)
+
+    store._make_index = slow_make_index
+    store.rebuild("hnsw")
+    assert store.rebuilding
+    assert store.search(vecs[5], top_k=1)[0]["text"] == "d0_5"   # old index serves
+    store.delete("d0")
+    new = _normed(1, _APX_DIM, seed=42)
+    store.add([Chunk("late", "late", 0)], new)
+    gate.set()
+    assert store.wait_for_rebuild(timeout=60)
+
+    assert store.index_type == "hnsw" and not store.rebuilding
+    assert store._n_tombstones == 0 and store._index.ntotal == 991
+    assert store.search(new[0], top_k=1)[0]["text"] == "late"
+    assert all(h["doc_id"] != "d0" for h in store.search(vecs[5], top_k=20))
+
+
+def test_auto_store_save_load_keeps_mode():
+    store = FAISSStore(dim=_APX_DIM, index_type="auto", memory_budget=10**9)
+    store.add([Chunk("a", "d", 0)], _normed(1, _APX_DIM, seed=43))
+    path = _tmp_dir("faiss-store-")
+    store.save(path)
+    loaded = FAISSStore.load(path)
+    assert loaded.auto and loaded.index_type == "flat"
+    assert loaded.memory_budget == 10**9
+
+
+# ---------------------------------------------------------------------------
+# Index benchmark
+# ---------------------------------------------------------------------------
+
+def test_index_sweep_rows():
+    from pyutils.embedders.bench import index_sweep, synthetic_vectors
+    both = synthetic_vectors(2050, 32, n_clusters=20)
+    np.testing.assert_allclose(np.linalg.norm(both, axis=1), 1.0, rtol=1e-5)
+    sweep = {
+        "flat": ([{}], None, [0]),
+        "ivf": ([{"nlist": 16}], "nprobe", [1, 16]),
+        "hnsw": ([{"hnsw_m": 8}], "hnsw_ef_search", [8, 64]),
+        "ivfpq": ([{"pq_m": 8, "pq_nbits": 4, "nlist": 16}, {"pq_m": 5}], "nprobe", [16]),
+    }
+    rows = index_sweep(both[:2000], both[2000:], k=10, sweep=sweep)
+    assert [(r["index"], r["params"]) for r in rows] == [
+        ("flat", "-"),
+        ("ivf", "nlist=16 nprobe=1"), ("ivf", "nlist=16 nprobe=16"),
+        ("hnsw", "hnsw_m=8 hnsw_ef_search=8"), ("hnsw", "hnsw_m=8 hnsw_ef_search=64"),
+        ("ivfpq", "pq_m=8 pq_nbits=4 nlist=16 nprobe=16"),       # pq_m=5 skipped
+    ]
+    recall = {r["params"]: r["recall"] for r in rows}
+    assert recall["-"] == 1.0 and recall["nlist=16 nprobe=16"] == 1.0
+    assert recall["nlist=16 nprobe=1"] < 1.0
+    assert all(r["p99_ms"] >= r["p50_ms"] > 0 and r["memory_mb"] > 0 for r in rows)
+
+
+
+def test_build_timings_rows():
+    from pyutils.embedders.bench import build_timings, synthetic_vectors
+    both = synthetic_vectors(3020, 32, n_clusters=20)
+    rows = build_timings(both[:3000], both[3000:], index_types=("ivf",),
+                         train_per_list=(None, 20), threads=(1,), nlist=16, nprobe=16)
+    assert [(r["index"], r["train_vectors"], r["threads"]) for r in rows] == [
+        ("ivf", 3000, 1), ("ivf", 320, 1)]
+    assert all(r["recall"] == 1.0 and r["build_s"] > 0 for r in rows)
+
+# ---------------------------------------------------------------------------
+# Persistence
+# ---------------------------------------------------------------------------
+
+def _tmp_dir(prefix):
+    import tempfile
+    return tempfile.mkdtemp(prefix=prefix)
+
+
+def test_save_load_roundtrip_every_index_type():
+    """A loaded store (mmapped or not) answers exactly like the saved one."""
+    queries = _normed(5, _APX_DIM, seed=11)
+    for index_type in ("flat", "ivf", "hnsw", "ivfpq", "sq8", "binary", "binary_hnsw"):
+        store, _ = _approx_store(index_type)
+        store.add([Chunk("héllo ✓", "other", 3, {"lang": "fr"})], queries[:1])
+        path = _tmp_dir("faiss-store-")
+        store.save(path)
+        want = store.search_batch(queries, top_k=5)
+        for mmap in (True, False):
+            loaded = FAISSStore.load(path, mmap=mmap)
+            assert loaded.index_type == index_type and len(loaded) == _APX_N + 1
+            assert loaded.search_batch(queries, top_k=5) == want, index_type
+            assert loaded._chunks[-1] == Chunk("héllo ✓", "other", 3, {"lang": "fr"})
+            assert loaded._chunks[8].metadata is loaded._chunks[9].metadata
+
+
+def test_mmapped_store_accepts_adds():
+    """The first add() after an mmap load copies the index into RAM."""
+    store, _ = _approx_store("flat")
+    path = _tmp_dir("faiss-store-")
+    store.save(path)
+    loaded = FAISSStore.load(path, mmap=True)
+    extra = _normed(3, _APX_DIM, seed=12)
+    loaded.add([Chunk(f"x_{i}", "x", i) for i in range(3)], extra)
+    assert not loaded._mmapped and len(loaded) == _APX_N + 3
+    assert loaded.search(extra[1], top_k=1)[0]["text"] == "x_1"
+    assert len(FAISSStore.load(path)) == _APX_N        # files untouched
+
+
+def test_save_load_empty_store():
+    path = _tmp_dir("faiss-store-")
+    FAISSStore(dim=32, index_type="hnsw").save(path)
+    loaded = FAISSStore.load(path)
+    assert len(loaded) == 0 and loaded.dim == 32
+    assert loaded.search(np.ones(32, np.float32)) == []
+
+
+# ---------------------------------------------------------------------------
+# Build: training sample, threads, blocks
+# ---------------------------------------------------------------------------
+
+def test_gather_rows_matches_vstack():
+    from pyutils.embedders.rag import _gather_rows, _sample_rows
+    pieces = [(None, _normed(n, 8, seed=n)) for n in (5, 1, 40, 17)]
+    rows = _sample_rows(63, 20)
+    assert len(rows) == 20 and np.all(np.diff(rows) > 0)
+    assert np.array_equal(rows, _sample_rows(63, 20))              # fixed seed
+    np.testing.assert_array_equal(
+        _gather_rows(pieces, rows), np.vstack([v for _, v in pieces])[rows])
+    assert np.array_equal(_sample_rows(5, 9), np.arange(5))
+
+
+def test_ivf_build_is_deterministic_and_block_wise():
+    """Training uses a capped fixed-seed sample; adds are split into blocks."""
+    import faiss
+    blocks = []
+
+    def make_index(n_vectors, index_type=None):
+        index = FAISSStore._make_index(store, n_vectors, index_type)
+        add = index.add_with_ids
+        index.add_with_ids = lambda x, ids: (blocks.append(len(x)), add(x, ids))[1]
+        return index
+
+    def build():
+        nonlocal store
+        store = FAISSStore(dim=_APX_DIM, index_type="ivf", nlist=8,
+                           train_per_list=40, n_threads=1)
+        store._BLOCK = 100
+        store._make_index = make_index
+        vectors = _normed(1000, _APX_DIM, seed=5)
+        for start in range(0, 1000, 250):
+            store.add([Chunk(str(i), f"d{i}", 0) for i in range(start, start + 250)],
+                      vectors[start : start + 250])
+        store.build()
+        return store, vectors
+
+    store = None
+    threads = faiss.omp_get_max_threads()
+    a, vectors = build()
+    assert blocks == [100, 100, 50] * 4
+    b, _ = build()
+    assert faiss.omp_get_max_threads() == threads                  # restored
+    assert a._index.ntotal == 1000
+    centroids = a._index.quantizer.reconstruct_n(0, 8)
+    np.testing.assert_array_equal(centroids, b._index.quantizer.reconstruct_n(0, 8))
+    assert a.search(vectors[777], top_k=1)[0]["text"] == "777"
+
+
+# ---------------------------------------------------------------------------
+# Keyword (BM25) and hybrid search
+# ---------------------------------------------------------------------------
+
+def _bm25_reference(texts, live, query, k1=1.2, b=0.75):
+    """Textbook BM25 over the live texts, by brute force."""
+    import math
+    from collections import Counter
+    from pyutils.embedders.sparse import tokenize
+    docs = {i: Counter(tokenize(t)) for i, t in enumerate(texts) if live[i]}
+    avgdl = sum(sum(c.values()) for c in docs.values()) / len(docs)
+    scores = {}
+    for term in dict.fromkeys(tokenize(query)):
+        df = sum(term in c for c in docs.values())
+        if not df:
+            continue
+        idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        for i, c in docs.items():
+            if term in c:
+                dl = sum(c.values())
+                tf = c[term]
+                scores[i] = scores.get(i, 0.0) + idf * tf * (k1 + 1) / (
+                    tf + k1 * (1 - b + b * dl / avgdl))
+    return scores
+
+
+def test_tokenize_keeps_codes_whole_and_split():
+    from pyutils.embedders.sparse import tokenize
+    assert tokenize("Error XR-2210: ECONNREFUSED") == [
+        "error", "xr-2210", "xr", "2210", "econnrefused"]
+
+
+def test_bm25_matches_reference_through_adds_and_deletes():
+    from pyutils.embedders.sparse import BM25Index
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(40)]
+    texts = [" ".join(rng.choice(words, rng.integers(3, 30))) for _ in range(300)]
+    index = BM25Index()
+    for start in range(0, 300, 70):                  # several merges
+        index.add(np.arange(start, min(start + 70, 300)) * 2, texts[start : start + 70])
+        index.search("w1", top_k=1)
+    live = np.ones(300, dtype=bool)
+    live[::7] = False
+    assert index.delete(np.flatnonzero(~live) * 2) == (~live).sum()
+    for query in ("w3", "w5 w5 w17", "w0 w39 nothing"):
+        want = _bm25_reference(texts, live, query)
+        scores, ids = index.search(query, top_k=len(texts))
+        assert len(ids) == len(want)
+        for score, chunk_id in zip(scores, ids):
+            assert abs(score - want[chunk_id // 2]) < 1e-4
+        assert np.all(np.diff(scores) <= 0)
+        top, _ = index.search(query, top_k=5, ids=ids[3:])
+        np.testing.assert_allclose(top, scores[3:8], rtol=1e-6)
+
+    fresh = BM25Index()                              # deletes score like a rebuild
+    fresh.add(np.flatnonzero(live) * 2, [t for t, keep in zip(texts, live) if keep])
+    for query in ("w3", "w5 w17"):
+        for a, b in zip(index.search(query, top_k=300), fresh.search(query, top_k=300)):
+            np.testing.assert_allclose(a, b, rtol=1e-6)
+
+
+def test_store_search_text_filter_delete_compact_and_reload():
+    store = FAISSStore(dim=8, index_type="hnsw", sparse=True)
+    texts = ["printer jam on tray 2", "error XR-2210 at startup",
+             "XR-2210 firmware notes", "unrelated text"]
+    store.add([Chunk(t, f"d{i}", 0, {"lang": "en" if i % 2 else "de"})
+               for i, t in enumerate(texts)], _normed(4, 8))
+    assert [r["doc_id"] for r in store.search_text("xr-2210")] == ["d2", "d1"]  # shorter first
+    assert [r["doc_id"] for r in store.search_text("XR-2210", filter={"lang": "de"})] == ["d2"]
+    assert store.search_text("tray", filter={"lang": "fr"}) == []
+    store.delete("d1")
+    assert [r["doc_id"] for r in store.search_text("xr-2210")] == ["d2"]
+    store.compact()
+    assert [r["doc_id"] for r in store.search_text("xr-2210 tray")] == ["d2", "d0"]
+    path = _tmp_dir("faiss-store-")
+    store.save(path)
+    loaded = FAISSStore.load(path)
+    assert loaded.search_text("xr-2210 tray") == store.search_text("xr-2210 tray")
+    assert FAISSStore(dim=8).sparse is None
+
+
+def test_pipeline_hybrid_finds_exact_codes():
+    from pyutils.embedders.rag import RAGPipeline
+    docs = [f"general notes about topic {i}" for i in range(50)]
+    docs[17] = "fault code ZX-4417 means the fan failed"
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), mode="hybrid")
+    rag.index(docs)
+    assert rag.store.sparse is not None
+    assert rag.query("ZX-4417", top_k=3)[0]["doc_id"] == "doc_17"
+    assert rag.query("ZX-4417", top_k=3, mode="sparse")[0]["doc_id"] == "doc_17"
+    assert all(r["doc_id"] != "doc_17" for r in rag.query("ZX-4417", top_k=3, mode="dense"))
+    # A document at the top of both lists outranks one found by either.
+    fused = rag.query("general notes about topic 3", top_k=5)
+    assert fused[0]["doc_id"] == "doc_3"
+    assert abs(fused[0]["score"] - 2 / 61) < 1e-9
+    assert rag.query_batch(["ZX-4417", "topic 3"], top_k=3) == [
+        rag.query("ZX-4417", top_k=3), rag.query("topic 3", top_k=3)]
+
+    rag.fusion, rag.dense_weight = "weighted", 0.3
+    assert rag.query("ZX-4417", top_k=3)[0]["doc_id"] == "doc_17"
+
+
+def test_pipeline_keyword_modes_need_sparse_store():
+    from pyutils.embedders.rag import RAGPipeline
+    for kwargs in ({"mode": "hybrid", "store": FAISSStore(dim=64)}, {"mode": "bm25"},
+                   {"fusion": "max"}):
+        try:
+            RAGPipeline(embedder=_TextHashEmbedder(), **kwargs)
+            assert False, f"expected ValueError for {kwargs}"
+        except ValueError:
+            pass
+    rag = RAGPipeline(embedder=_TextHashEmbedder())
+    try:
+        rag.query("x", mode="sparse")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Cross-encoder rerank
+# ---------------------------------------------------------------------------
+
+_TINY_RERANKER_DIR = None
+
+
+def _tiny_reranker(**kwargs):
+    """QwenReranker on a 2-layer random Qwen3 causal LM with "yes"/"no" tokens."""
+    global _TINY_RERANKER_DIR
+    from pyutils.embedders.reranker import QwenReranker
+    if _TINY_RERANKER_DIR is None:
+        import tempfile
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+        vocab = {"<pad>": 0, "<unk>": 1, "yes": 2, "no": 3}
+        vocab.update({f"w{i}": i + 4 for i in range(500)})
+        tok = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+        tok.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=tok, pad_token="<pad>", unk_token="<unk>",
+        )
+        config = Qwen3Config(
+            vocab_size=len(vocab), hidden_size=64, intermediate_size=64,
+            num_hidden_layers=2, num_attention_heads=2, num_key_value_heads=1,
+            head_dim=32, max_position_embeddings=4096,
+        )
+        torch.manual_seed(0)
+        _TINY_RERANKER_DIR = tempfile.mkdtemp(prefix="tiny-reranker-")
+        tokenizer.save_pretrained(_TINY_RERANKER_DIR)
+        Qwen3ForCausalLM(config).save_pretrained(_TINY_RERANKER_DIR)
+    return QwenReranker(device="cpu", model_id=_TINY_RERANKER_DIR, **kwargs)
+
+
+def test_reranker_scores_do_not_depend_on_batching():
+    passages = [_words(n, offset=n) for n in (3, 40, 7, 120, 1)]
+    one = _tiny_reranker(batch_size=1).score(_words(5), passages)
+    many = _tiny_reranker(batch_size=4).score(_words(5), passages)
+    assert one.shape == (5,) and np.all((one > 0) & (one < 1))
+    np.testing.assert_allclose(one, many, atol=1e-5)
+
+
+def test_reranker_orders_by_score_and_honours_deadline():
+    import time
+    reranker = _tiny_reranker(batch_size=2)
+    candidates = [{"text": _words(n, offset=3 * n), "doc_id": f"d{n}"} for n in range(1, 8)]
+    ranked = reranker.rerank(_words(4), candidates, top_k=5)
+    want = reranker.score(_words(4), [c["text"] for c in candidates])
+    assert [r["doc_id"] for r in ranked] == [candidates[i]["doc_id"] for i in np.argsort(-want)[:5]]
+    assert "rerank_score" not in candidates[0]                 # inputs untouched
+
+    late = reranker.rerank(_words(4), candidates, top_k=3, deadline=time.perf_counter())
+    assert late == candidates[:3]
+
+
+class _SleepyReranker:
+    """Scores by text length, taking `delay` seconds per batch of two."""
+
+    def __init__(self, delay):
+        from pyutils.embedders.reranker import QwenReranker
+        self.delay = delay
+        self.batch_size = 2
+        self.calls = 0
+        self.rerank = QwenReranker.rerank.__get__(self)
+
+    def _score_batch(self, query, texts, task):
+        import time
+        self.calls += 1
+        time.sleep(self.delay)
+        return np.array([len(t) for t in texts], dtype=np.float32)
+
+
+def test_pipeline_rerank_stage_and_timings():
+    from pyutils.embedders.rag import RAGPipeline
+    reranker = _SleepyReranker(0.0)
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), reranker=reranker, rerank_depth=8)
+    rag.index(["x" * n for n in range(1, 21)])
+    results = rag.query("anything", top_k=3)
+    assert reranker.calls == 4                                 # 8 candidates / 2
+    assert [r["rerank_score"] for r in results] == sorted(
+        (r["rerank_score"] for r in results), reverse=True)
+    assert set(results.timings) == {"encode_ms", "search_ms", "rerank_ms", "total_ms"}
+    assert results.timings["total_ms"] >= results.timings["rerank_ms"]
+    batch = rag.query_batch(["anything", "else"], top_k=3)
+    assert batch[0] == results and batch[1].timings["rerank_ms"] >= 0
+
+    plain = RAGPipeline(embedder=_TextHashEmbedder())
+    plain.index(["a b", "c d"])
+    assert set(plain.query("a", top_k=1).timings) == {"encode_ms", "search_ms", "total_ms"}
+
+
+def test_pipeline_rerank_deadline_returns_partial_ordering():
+    from pyutils.embedders.rag import RAGPipeline
+    reranker = _SleepyReranker(0.05)
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), reranker=reranker,
+                      rerank_depth=20, deadline_ms=120)
+    rag.index(["x" * n for n in range(1, 21)])
+    results = rag.query("anything", top_k=20)
+    scored = [r for r in results if "rerank_score" in r]
+    assert 1 <= reranker.calls <= 2 and len(scored) == 2 * reranker.calls
+    assert results[: len(scored)] == scored                    # scored first
+    assert results.timings["total_ms"] < 200
+
+
+# ---------------------------------------------------------------------------
+# Sharded store
+# ---------------------------------------------------------------------------
+
+def test_sharded_store_matches_single_store():
+    from pyutils.embedders.sharded import ShardedStore
+    vectors = _normed(600, 32, seed=21)
+    chunks = [Chunk(f"chunk {i} about w{i % 7}", f"d{i // 6}", i % 6, {"odd": i % 2})
+              for i in range(600)]
+    queries = _normed(4, 32, seed=22)
+    single = FAISSStore(dim=32, sparse=True)
+    single.add(chunks, vectors)
+    with ShardedStore(n_shards=3, dim=32, sparse=True, threads_per_shard=1) as store:
+        ids = store.add(chunks, vectors)
+        assert len(set(ids.tolist())) == 600 and set(ids % 3) == {0, 1, 2}
+        assert len(store) == 600
+        assert store.search_batch(queries, top_k=7) == single.search_batch(queries, top_k=7)
+        assert (store.search(queries[0], top_k=5, filter={"odd": 1})
+                == single.search(queries[0], top_k=5, filter={"odd": 1}))
+        assert [r["doc_id"] for r in store.search_text("w3", top_k=200)] != []
+
+        assert store.delete("d10") == 6 and len(store) == 594
+        new = store.upsert("d11", [Chunk("fresh", "d11", 0)], queries[:1])
+        assert new % 3 == store.shard_of("d11")
+        assert store.search(queries[0], top_k=1)[0]["text"] == "fresh"
+
+        path = _tmp_dir("sharded-")
+        store.save(path)
+        want = store.search_batch(queries, top_k=5)
+    with ShardedStore.load(path, threads_per_shard=1) as loaded:
+        assert len(loaded) == 589 and loaded.sparse
+        assert loaded.search_batch(queries, top_k=5) == want
+
+
+def test_sharded_index_stream_after_index_with_empty_shard():
+    from pyutils.embedders.rag import RAGPipeline
+    from pyutils.embedders.sharded import ShardedStore
+    with ShardedStore(n_shards=3, dim=64, threads_per_shard=1) as store:
+        rag = RAGPipeline(embedder=_TextHashEmbedder(), store=store)
+        rag.index(["only document"], doc_ids=["d0"])
+        store.build()
+        assert not store.built                           # two shards still empty
+        assert rag.index_stream(f"text {i}" for i in range(40)) == 40
+        assert store.built and len(store) == 41
+        assert rag.query("text 7", top_k=1)[0]["doc_id"] == "doc_7"
+
+
+def test_sharded_trains_on_shares_and_fails_fast_on_dead_shard():
+    from pyutils.embedders.rag import RAGPipeline
+    from pyutils.embedders.sharded import ShardedStore
+    store = ShardedStore(n_shards=2, dim=64, index_type="ivf", nlist=4, nprobe=4,
+                         threads_per_shard=1)
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), store=store)
+    assert rag.index_stream((f"text {i}" for i in range(400)), train_sample=200) == 400
+    assert store.built and rag.query("text 9", top_k=1)[0]["doc_id"] == "doc_9"
+
+    store._workers[1].kill()
+    store._workers[1].join()
+    try:
+        len(store)
+        assert False, "expected RuntimeError"
+    except RuntimeError as e:
+        assert "shard 1 died" in str(e)
+    assert store._workers is None                        # closed
+
+
+def test_pipeline_on_sharded_store():
+    from pyutils.embedders.rag import RAGPipeline
+    from pyutils.embedders.sharded import ShardedStore
+    with ShardedStore(n_shards=2, dim=64, sparse=True, threads_per_shard=1) as store:
+        rag = RAGPipeline(embedder=_TextHashEmbedder(), store=store, mode="hybrid")
+        rag.index([f"note {i}" for i in range(30)] + ["code QP-77 failed"])
+        assert len(rag) == 31
+        assert rag.query("QP-77", top_k=2)[0]["doc_id"] == "doc_30"
+        assert rag.delete("doc_30") == 1
+        try:
+            store.search_batch(np.zeros((1, 8), np.float32))
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+    try:
+        store.search(np.zeros(64, np.float32))
+        assert False, "expected RuntimeError"
+    except RuntimeError:
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Streaming ingestion
+# ---------------------------------------------------------------------------
+
+class _TextHashEmbedder:
+    """One chunk per document, with a vector seeded by the text's crc32."""
+    dim = 64
+
+    def encode(self, texts, is_query=False, task=""):
+        if isinstance(texts, str):
+            texts = [texts]
+        return np.vstack([self._vec(t) for t in texts])
+
+    def encode_documents(self, texts, chunk_tokens=512):
+        return [([t], self._vec(t)[None]) for t in texts]
+
+    def _vec(self, text):
+        import zlib
+        return _normed(1, self.dim, seed=zlib.crc32(text.encode()))[0]
+
+
+def _stream_docs(n):
+    for i in range(n):
+        yield f"d{i}", f"document number {i}", {"part": i % 3}
+
+
+def test_index_stream_matches_index():
+    from pyutils.embedders.rag import RAGPipeline
+    docs = list(_stream_docs(200))
+    eager = RAGPipeline(embedder=_TextHashEmbedder(),
+                        store=FAISSStore(dim=64, index_type="flat"))
+    eager.index([t for _, t, _ in docs], [d for d, _, _ in docs], [m for _, _, m in docs])
+    lazy = RAGPipeline(embedder=_TextHashEmbedder(),
+                       store=FAISSStore(dim=64, index_type="flat"))
+    assert lazy.index_stream(_stream_docs(200), batch_docs=16, block_size=50) == 200
+    assert lazy.store.built and len(lazy) == 200
+    for q in ("document number 7", "document number 150"):
+        assert lazy.query(q, top_k=5) == eager.query(q, top_k=5)
+
+
+def test_index_stream_trains_ivf_on_sample_and_adds_in_blocks():
+    from pyutils.embedders.rag import RAGPipeline
+    store = FAISSStore(dim=64, index_type="ivf", nlist=8, nprobe=8)
+    blocks = []
+    add = store.add
+    store.add = lambda chunks, vecs: (blocks.append(len(vecs)), add(chunks, vecs))[1]
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), store=store)
+    spill = _tmp_dir("rag-spill-")
+    assert rag.index_stream(_stream_docs(1000), block_size=128,
+                            train_sample=400, spill_dir=spill) == 1000
+    assert store.built and store.index_type == "ivf" and len(store) == 1000
+    assert max(blocks) == 128 and sum(blocks) == 1000
+    assert os.listdir(spill) == []                      # spill removed
+    hit = rag.query("document number 999", top_k=1, filter={"part": 0})[0]
+    assert hit["doc_id"] == "d999" and hit["metadata"] == {"part": 0}
+
+
+def test_index_stream_auto_sizes_from_stream_length():
+    from pyutils.embedders.rag import RAGPipeline
+    rag = RAGPipeline(embedder=_TextHashEmbedder(),
+                      store=FAISSStore(dim=64, index_type="auto"))
+    rag.index_stream(f"text {i}" for i in range(300))
+    assert rag.store.index_type == "flat" and len(rag) == 300
+    assert rag.query("text 42", top_k=1)[0]["doc_id"] == "doc_42"
+
+
+def test_index_stream_spill_keeps_metadata_as_given():
+    import datetime
+    from pyutils.embedders.rag import RAGPipeline
+    metas = [{"tags": ("a", "b"), 3: "three"}, {"day": datetime.date(2024, 5, 1)}]
+    rag = RAGPipeline(embedder=_TextHashEmbedder(),
+                      store=FAISSStore(dim=64, index_type="ivf", nlist=4, nprobe=4))
+    rag.index_stream(((f"d{i}", f"text {i}", metas[i % 2]) for i in range(200)),
+                     train_sample=100, spill_dir=_tmp_dir("rag-spill-"))
+    for i in (6, 7):
+        hit = rag.query(f"text {i}", top_k=1)[0]
+        assert hit["doc_id"] == f"d{i}" and hit["metadata"] == metas[i % 2]
+
+
+def test_spill_reservoir_is_uniform_sample():
+    from pyutils.embedders.rag import _spill
+    vectors = _normed(5000, 8, seed=3)
+    chunks = [[Chunk(str(i), f"d{i}", 0)] for i in range(5000)]
+    n, sample = _spill(zip(chunks, (v[None] for v in vectors)), _tmp_dir("spill-"), 8, 500)
+    assert n == 5000 and sample.shape == (500, 8)
+    rows = [int(np.argmax(vectors @ s)) for s in sample]
+    assert len(set(rows)) == 500
+    assert 200 < sum(r >= 2500 for r in rows) < 300     # not just the head
+
+
+def test_train_requires_sample_for_ivf():
+    store = FAISSStore(dim=64, index_type="ivf", nlist=4)
+    assert store.needs_training
+    try:
+        store.train()
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    store.train(_normed(200, 64), n_total=200)
+    assert store.built and not store.needs_training
+
+
+def test_encode_document_batches_matches_encode_documents():
+    embedder = _tiny_embedder(cache=_cache(dim=EMBEDDING_DIM))
+    plain = _tiny_embedder()
+    batches = [[_words(40), _words(7, 3)], [_words(100, 9)], [_words(16, 1), _words(33, 2)]]
+    expected = [plain.encode_documents(b, chunk_tokens=16) for b in batches]
+
+    for _ in range(2):                                  # misses, then cache hits
+        got = list(embedder.encode_document_batches(iter(batches), chunk_tokens=16,
+                                                    workers=2, depth=1))
+        assert len(got) == len(expected)
+        for batch, want in zip(got, expected):
+            for (t1, v1), (t2, v2) in zip(batch, want):
+                assert t1 == t2 and np.allclose(v1, v2, atol=1e-5)
+
+    windows = [[2, 3, 4], [5], list(range(2, 40))]
+    assert plain._decode_windows(windows) == [
+        plain._tokenizer.decode(w, skip_special_tokens=True).strip() for w in windows
+    ]
+
+
+def test_pipelined_index_matches_sequential():
+    from pyutils.embedders.rag import RAGPipeline
+    docs = [_words(20 + 7 * i, i) for i in range(12)]
+    results = []
+    for workers in (0, 2):
+        store = FAISSStore(dim=EMBEDDING_DIM)
+        blocks = []
+        add = store.add
+        store.add = lambda chunks, vecs: (blocks.append(len(vecs)), add(chunks, vecs))[1]
+        rag = RAGPipeline(embedder=_tiny_embedder(), store=store, chunk_tokens=16)
+        rag.index(docs, batch_docs=3, block_size=10, workers=workers)
+        assert all(n >= 10 for n in blocks[:-1]) and sum(blocks) == len(store)
+        results.append([rag.query(_words(5, i), top_k=4) for i in (0, 5)])
+    for seq, pipe in zip(*results):
+        assert [r["text"] for r in seq] == [r["text"] for r in pipe]
+        assert np.allclose([r["score"] for r in seq], [r["score"] for r in pipe], atol=1e-5)
+
+
+def test_index_raises_indexer_errors():
+    from pyutils.embedders.rag import RAGPipeline
+    store = FAISSStore(dim=64)
+    add = store.add
+
+    def failing_add(chunks, vecs):
+        if len(store):
+            raise RuntimeError("disk full")
+        add(chunks, vecs)
+
+    store.add = failing_add
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), store=store)
+    try:
+        rag.index([f"text {i}" for i in range(500)], batch_docs=8, block_size=16)
+        assert False, "expected RuntimeError"
+    except RuntimeError as e:
+        assert str(e) == "disk full"
+    assert len(store) == 16
+
+
+# ---------------------------------------------------------------------------
+# Deduplication
+# ---------------------------------------------------------------------------
+
+def _jitter(vecs, scale, seed):
+    """`vecs` nudged by unit noise times `scale`, re-normalised."""
+    out = vecs + scale * _normed(len(vecs), vecs.shape[1], seed=seed)
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+def test_dedup_folds_exact_and_near_copies():
+    from pyutils.embedders.dedup import normalize
+    assert normalize("  Cookie\tPOLICY\n ") == "cookie policy"
+    base = _normed(6, _APX_DIM, seed=41)
+    store = FAISSStore(dim=_APX_DIM, dedup=True, dedup_threshold=0.95)
+    first = store.add([Chunk(f"passage {i}", "a", i) for i in range(6)], base)
+    assert list(first) == list(range(6))
+
+    chunks = [
+        Chunk("PASSAGE  0", "b", 0),          # exact after normalising
+        Chunk("passage 1, reworded", "b", 1), # near: same meaning
+        Chunk("something new", "b", 2),
+        Chunk("Something new ", "b", 3),      # exact copy of a row in this batch
+        Chunk("new, reworded", "b", 4),       # near copy of a row in this batch
+    ]
+    fresh = _normed(1, _APX_DIM, seed=42)
+    vecs = np.vstack([_normed(1, _APX_DIM, seed=43), _jitter(base[1:2], 0.01, 44),
+                      fresh, fresh, _jitter(fresh, 0.01, 45)])
+    ids = store.add(chunks, vecs)
+    assert list(ids) == [0, 1, 6, 6, 6]
+    assert len(store) == 7
+
+    hit = store.search(base[0], top_k=1)[0]
+    assert hit["doc_id"] == "a" and hit["duplicates"] == [{"doc_id": "b", "chunk_idx": 0}]
+    hit = store.search(fresh[0], top_k=1)[0]
+    assert [d["chunk_idx"] for d in hit["duplicates"]] == [3, 4]
+    assert store.search(base[2], top_k=1)[0]["duplicates"] == []
+    stats = store.dedup_stats()
+    assert stats["chunks_seen"] == 11 and stats["indexed"] == 7
+    assert stats["exact_duplicates"] == 2 and stats["near_duplicates"] == 2
+    assert stats["reduction"] == 4 / 11
+
+    exact_only = FAISSStore(dim=_APX_DIM, dedup=True, dedup_threshold=None)
+    exact_only.add([Chunk(f"passage {i}", "a", i) for i in range(6)], base)
+    assert list(exact_only.add(chunks, vecs)) == [0, 6, 7, 7, 8]
+
+
+def test_dedup_references_follow_deletes_upserts_and_saves():
+    base = _normed(3, _APX_DIM, seed=46)
+    store = FAISSStore(dim=_APX_DIM, index_type="hnsw", dedup=True)
+    store.add([Chunk(f"footer {i}", "a", i) for i in range(3)], base)
+    store.add([Chunk("footer 0", "b", 0), Chunk("own text", "b", 1)],
+              np.vstack([base[:1], _normed(1, _APX_DIM, seed=47)]))
+    store.add([Chunk("footer 0", "c", 5)], base[:1])
+    assert len(store) == 4
+
+    assert store.delete("a") == 3                      # survivor of b's and c's copy
+    assert store.dedup_stats()["orphaned"] == 2
+    assert all(h["doc_id"] != "a" for h in store.search(base[0], top_k=4))
+    store.upsert("a", [Chunk("Footer 0", "a", 0)], base[:1])
+    hit = store.search(base[0], top_k=1)[0]
+    assert hit["doc_id"] == "a" and len(hit["duplicates"]) == 2   # adopted
+
+    assert store.delete("c") == 1                      # one reference, no chunks
+    path = _tmp_dir("faiss-dedup-")
+    store.save(path)
+    loaded = FAISSStore.load(path)
+    assert loaded.search(base[0], top_k=1) == store.search(base[0], top_k=1)
+    assert loaded.dedup_stats() == store.dedup_stats()
+    survivor = loaded._chunks.doc_ids_of("a")[0]
+    assert loaded.add([Chunk("FOOTER 0", "d", 0)], base[:1])[0] == survivor
+
+
+def test_pipeline_dedup_shrinks_index():
+    from pyutils.embedders.rag import RAGPipeline
+    boilerplate = "All rights reserved. Contact support for help."
+    docs = [f"document {i}" for i in range(20)] + [boilerplate] * 20
+    ids = [f"d{i}" for i in range(20)] + [f"b{i}" for i in range(20)]
+    rag = RAGPipeline(embedder=_TextHashEmbedder(), dedup=True)
+    rag.index(docs, ids)
+    assert len(rag) == 21
+    assert rag.store.dedup_stats()["exact_duplicates"] == 19
+    hits = rag.query(boilerplate, top_k=3)
+    assert hits[0]["doc_id"] == "b0" and len(hits[0]["duplicates"]) == 19
+
+    streamed = RAGPipeline(embedder=_TextHashEmbedder(),
+                           store=FAISSStore(dim=64, index_type="ivf", nlist=2, dedup=True))
+    assert streamed.index_stream(zip(ids, docs), block_size=8) == 40
+    assert len(streamed) == 21
+    try:
+        RAGPipeline(embedder=_TextHashEmbedder(), store=FAISSStore(dim=64), dedup=True)
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
 # ---------------------------------------------------------------------------
 # Configuration guards
 # ---------------------------------------------------------------------------
@@ -283,6 +1960,12 @@ class _StubEmbedder:
     def encode_document(self, text, chunk_tokens=512):
         return [text], _normed(1, self.dim, seed=1)
 
+    def encode_documents(self, texts, chunk_tokens=512):
+        return [self.encode_document(t, chunk_tokens) for t in texts]
+
+    def encode_document_stream(self, text, chunk_tokens=512):
+        yield self.encode_document(text, chunk_tokens)
+
 
 def test_injected_store_is_retained():
     """
@@ -290,7 +1973,7 @@ def test_injected_store_is_retained():
     pipeline must keep an injected store with `is not None`, not `or` (which
     would silently fall back to the default flat store).
     """
-    from rag import RAGPipeline
+    from pyutils.embedders.rag import RAGPipeline
     store = FAISSStore(dim=_StubEmbedder.dim, index_type="hnsw")
     rag = RAGPipeline(embedder=_StubEmbedder(), store=store)
     assert rag.store is store